@@ -5,12 +5,38 @@ import os
 from dotenv import load_dotenv
 import logging
 from werkzeug.utils import secure_filename
+from werkzeug.datastructures import MultiDict
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, Field, File, Data, Epilogue
 import mimetypes
 import time
 import tempfile
 import json
-from datetime import datetime, timedelta
-from typing import Dict, Optional
+import threading
+import uuid
+import re
+import shutil
+import zlib
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+from typing import Optional
+
+from shared_state import (
+    CacheBackend, MemoryCacheBackend, MemoryRateLimitStore, MemoryBreakerStore,
+    create_cache_backend, create_rate_limit_store, create_breaker_store
+)
+from text_processing import canonicalize_query, MinHashIndex
+from ingestion import IngestionJobManager, extract_archive
+from operation_tracker import OperationTracker
+from prompt_builder import prepare_generation, rank_score, get_chunk_text
+from reranker import rerank_chunks
+from lexical_index import LexicalIndex, PENDING_PREFIX
+from metadata_filter import MetadataIndex, MetadataFilterError, parse_filter
+from chunk_mirror import ChunkMirror, chunk_id
+from sse import DONE_FRAME, text_frame, event_frame
+from encoding_repair import fix_encoding_issues, EncodingRepairer
+from providers import ProviderRegistry, ProviderError, GeminiProvider, OpenAICompatibleProvider
+from generation_router import GenerationRouter, GenerationTarget, NoProviderAvailable
+from retry_policy import RetryPolicy, RetryBudget
 
 # Carica variabili d'ambiente
 load_dotenv()
@@ -36,16 +62,87 @@ CHUNK_OVERLAP_PERCENT = int(os.getenv('CHUNK_OVERLAP_PERCENT', '10'))
 RESULTS_COUNT = int(os.getenv('RESULTS_COUNT', '25'))
 MIN_RELEVANCE_SCORE = float(os.getenv('MIN_RELEVANCE_SCORE', '0.3'))
 MAX_CHUNKS_FOR_GENERATION = int(os.getenv('MAX_CHUNKS_FOR_GENERATION', '15'))
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '8000'))  # token stimati di contesto documenti
+# Compattazione del contesto: chunk quasi duplicati scartati, chunk adiacenti fusi (0 = disattivata)
+CONTEXT_DEDUP_THRESHOLD = float(os.getenv('CONTEXT_DEDUP_THRESHOLD', '0.9'))
+CONTEXT_SHINGLE_WORDS = int(os.getenv('CONTEXT_SHINGLE_WORDS', '8'))  # parole per shingle (e overlap minimo)
+# /api/chat/ask: avvia la generazione quando sono arrivati almeno N chunk sopra MIN_RELEVANCE_SCORE (0 = attendi tutti i documenti)
+ASK_EARLY_START_CHUNKS = int(os.getenv('ASK_EARLY_START_CHUNKS', str(MAX_CHUNKS_FOR_GENERATION)))
+# Re-ranking locale dei chunk recuperati: score upstream (globale e per documento) + BM25 sui testi
+RERANK_ENABLED = os.getenv('RERANK_ENABLED', 'true').lower() == 'true'
+RERANK_BM25_WEIGHT = float(os.getenv('RERANK_BM25_WEIGHT', '0.4'))
+RERANK_DOC_NORM_WEIGHT = float(os.getenv('RERANK_DOC_NORM_WEIGHT', '0.2'))
+# Indice lessicale locale: interroga solo i migliori N documenti indicizzati (0 = tutti i documenti attivi)
+LEXICAL_PREFILTER_TOP_K = int(os.getenv('LEXICAL_PREFILTER_TOP_K', '0'))
+LEXICAL_INDEX_PATH = os.getenv('LEXICAL_INDEX_PATH', '')  # default: documents_storage/lexical_index.sqlite3
+LEXICAL_MAX_UPLOAD_BYTES = int(os.getenv('LEXICAL_MAX_UPLOAD_BYTES', str(5 * 1024 * 1024)))
+# Enumerazione dei chunk di un documento: chunk per pagina upstream (max 100)
+CHUNK_LIST_PAGE_SIZE = min(int(os.getenv('CHUNK_LIST_PAGE_SIZE', '100')), 100)
+# Mirror locale dei chunk visti: i documenti elencati per intero vengono serviti senza chiamate upstream
+CHUNK_MIRROR_ENABLED = os.getenv('CHUNK_MIRROR_ENABLED', 'true').lower() == 'true'
+CHUNK_MIRROR_PATH = os.getenv('CHUNK_MIRROR_PATH', '')  # default: documents_storage/chunk_mirror
+LOCAL_PAGE_PREFIX = 'local:'  # pageToken delle pagine servite dal mirror locale
 MAX_OUTPUT_TOKENS = int(os.getenv('MAX_OUTPUT_TOKENS', '4096'))
 MAX_CHAT_HISTORY = int(os.getenv('MAX_CHAT_HISTORY', '2'))
 
+# Configurazione fan-out multi-documento (query parallele sui documenti attivi)
+QUERY_FANOUT_WORKERS = int(os.getenv('QUERY_FANOUT_WORKERS', '8'))
+QUERY_DOCUMENT_TIMEOUT = float(os.getenv('QUERY_DOCUMENT_TIMEOUT', '15'))  # secondi per singolo documento
+QUERY_FANOUT_DEADLINE = float(os.getenv('QUERY_FANOUT_DEADLINE', '30'))  # secondi per l'intero fan-out
+DOCUMENT_CATALOG_TTL = int(os.getenv('DOCUMENT_CATALOG_TTL', '60'))  # secondi prima di riallineare il catalogo
+
+# Stato condiviso tra worker: 'memory' (per processo), 'sqlite' (file locale condiviso) o 'redis'
+QUERY_CACHE_BACKEND = os.getenv('QUERY_CACHE_BACKEND', 'memory').lower()
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'memory').lower()
+CIRCUIT_BREAKER_BACKEND = os.getenv('CIRCUIT_BREAKER_BACKEND', 'memory').lower()
+# Ricerca di query quasi duplicate (0 = disattivata, es. 0.85 per attivarla)
+QUERY_SIMILARITY_THRESHOLD = float(os.getenv('QUERY_SIMILARITY_THRESHOLD', '0'))
+SHARED_STATE_PATH = os.getenv('SHARED_STATE_PATH', os.path.join(tempfile.gettempdir(), 'google_file_search_state.sqlite3'))
+# Cache delle risposte generate (stesso prompt, modello e configurazione): 0 = disattivata
+GENERATION_CACHE_TTL = int(os.getenv('GENERATION_CACHE_TTL', '600'))
+
 # Configurazione provider di generazione
 GENERATION_PROVIDER = os.getenv('GENERATION_PROVIDER', 'gemini').lower()
 GENERATION_MODEL = os.getenv('GENERATION_MODEL', DEFAULT_MODEL)
 GENERATION_API_KEY = os.getenv('GENERATION_API_KEY', GEMINI_API_KEY)
+# Provider di riserva: usato su 429/503, errori di connessione o circuit breaker aperto del primario (vuoto = nessuno)
+GENERATION_FALLBACK_PROVIDER = os.getenv('GENERATION_FALLBACK_PROVIDER', '').lower()
+GENERATION_FALLBACK_MODEL = os.getenv('GENERATION_FALLBACK_MODEL', '')
+GENERATION_FALLBACK_API_KEY = os.getenv('GENERATION_FALLBACK_API_KEY', '')
+# Hedging: se il primario non risponde entro questo percentile delle sue latenze recenti parte anche la riserva (0 = disattivato)
+GENERATION_HEDGE_PERCENTILE = float(os.getenv('GENERATION_HEDGE_PERCENTILE', '0'))
+GENERATION_HEDGE_MIN_DELAY = float(os.getenv('GENERATION_HEDGE_MIN_DELAY', '2'))
+
+# Politica di retry comune a tutte le chiamate upstream (backoff con jitter, Retry-After, budget globale)
+RETRY_MAX_ATTEMPTS = int(os.getenv('RETRY_MAX_ATTEMPTS', '3'))
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', '0.5'))
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', '20'))
+# Crediti di retry per richiesta (0.2 = al massimo un retry ogni 5 richieste) più una riserva al secondo
+RETRY_BUDGET_RATIO = float(os.getenv('RETRY_BUDGET_RATIO', '0.2'))
+RETRY_BUDGET_MIN_PER_SECOND = float(os.getenv('RETRY_BUDGET_MIN_PER_SECOND', '1'))
 BASE_URL = 'https://generativelanguage.googleapis.com/v1beta'
 UPLOAD_BASE_URL = 'https://generativelanguage.googleapis.com/upload/v1beta'
 
+# Upload in streaming verso Google senza file temporaneo (attivabile anche per richiesta con ?stream=1)
+UPLOAD_STREAMING = os.getenv('UPLOAD_STREAMING', 'false').lower() == 'true'
+UPLOAD_STREAM_CHUNK_SIZE = int(os.getenv('UPLOAD_STREAM_CHUNK_SIZE', str(256 * 1024)))
+
+# Caricamento massivo: upload paralleli verso Google e numero massimo di file per job
+BULK_UPLOAD_WORKERS = int(os.getenv('BULK_UPLOAD_WORKERS', '4'))
+BULK_UPLOAD_MAX_FILES = int(os.getenv('BULK_UPLOAD_MAX_FILES', '5000'))
+BULK_UPLOAD_MAX_BYTES = int(os.getenv('BULK_UPLOAD_MAX_BYTES', str(1024 ** 3)))  # byte estratti dagli archivi per job
+BULK_UPLOAD_SAVE_INTERVAL = float(os.getenv('BULK_UPLOAD_SAVE_INTERVAL', '1'))  # secondi tra i salvataggi dello stato dei job
+
+# Tracker delle operazioni: intervalli di polling upstream (backoff adattivo) e attese lato client
+OPERATION_POLL_MIN_INTERVAL = float(os.getenv('OPERATION_POLL_MIN_INTERVAL', '1'))
+OPERATION_POLL_MAX_INTERVAL = float(os.getenv('OPERATION_POLL_MAX_INTERVAL', '15'))
+OPERATION_LONG_POLL_MAX = float(os.getenv('OPERATION_LONG_POLL_MAX', '30'))
+OPERATION_STREAM_HEARTBEAT = float(os.getenv('OPERATION_STREAM_HEARTBEAT', '15'))
+OPERATION_STREAM_MAX_NAMES = int(os.getenv('OPERATION_STREAM_MAX_NAMES', '50'))  # operazioni per stream SSE
+# Operazioni abbandonate (chiuse con errore) dopo N polling falliti di fila o oltre l'età massima in secondi
+OPERATION_POLL_MAX_FAILURES = int(os.getenv('OPERATION_POLL_MAX_FAILURES', '5'))
+OPERATION_MAX_AGE = float(os.getenv('OPERATION_MAX_AGE', str(24 * 3600)))
+
 # Dimensione massima file: 100MB
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024
 # Upload folder temporaneo
@@ -55,6 +152,39 @@ app.config['DOCUMENTS_STORAGE'] = os.path.join(os.path.dirname(os.path.dirname(_
 # Crea la cartella se non esiste
 os.makedirs(app.config['DOCUMENTS_STORAGE'], exist_ok=True)
 
+# Indice lessicale dei testi visti (upload, query, elenco chunk), persistito accanto ai documenti
+lexical_index = LexicalIndex(LEXICAL_INDEX_PATH or os.path.join(app.config['DOCUMENTS_STORAGE'], 'lexical_index.sqlite3'))
+# Mirror locale dei chunk visti (colonne append-only lette via mmap)
+chunk_mirror = ChunkMirror(CHUNK_MIRROR_PATH or os.path.join(app.config['DOCUMENTS_STORAGE'], 'chunk_mirror')) if CHUNK_MIRROR_ENABLED else None
+# Gli aggiornamenti di indice lessicale e mirror avvengono in background, uno alla volta
+local_index_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='local-index')
+
+def update_local_index(fn, *args):
+    """Accoda un aggiornamento dell'indice lessicale o del mirror (fuori dal percorso della richiesta)"""
+    def run():
+        try:
+            fn(*args)
+        except Exception as e:
+            logger.warning(f"Aggiornamento indice locale fallito: {str(e)}")
+    local_index_executor.submit(run)
+
+def remember_chunks(document_name: str, chunks: list):
+    """Registra i chunk di una risposta upstream nell'indice lessicale e nel mirror locale"""
+    update_local_index(lexical_index.add_texts, document_name, [get_chunk_text(c) for c in chunks])
+    if chunk_mirror is not None:
+        update_local_index(chunk_mirror.append, document_name, chunks)
+
+def is_text_mime_type(mime_type: str) -> bool:
+    """File il cui contenuto può essere indicizzato così com'è (non PDF, Word e altri formati binari)"""
+    return mime_type.startswith('text/') or mime_type in ('application/json', 'application/xml')
+
+def read_text_for_index(file_path: str, mime_type: str) -> Optional[str]:
+    """Testo di un file da indicizzare (None se non è testuale)"""
+    if not is_text_mime_type(mime_type):
+        return None
+    with open(file_path, 'rb') as f:
+        return f.read(LEXICAL_MAX_UPLOAD_BYTES).decode('utf-8', errors='ignore')
+
 # MIME types permessi (solo documenti testuali - File Search Store non supporta immagini)
 ALLOWED_MIME_TYPES = {
     'application/pdf', 'text/plain', 'text/html', 'text/markdown',
@@ -63,142 +193,414 @@ ALLOWED_MIME_TYPES = {
     'text/csv', 'application/json'
 }
 
-# Cache in-memory per query con TTL
+# Cache per query con TTL
 class QueryCache:
-    """Cache semplice in-memory per risultati query con Time-To-Live"""
-    def __init__(self, ttl_seconds=300):  # Default: 5 minuti
-        self.cache = {}
+    """
+    Cache per risultati query con Time-To-Live.
+    I valori vengono serializzati in forma compatta (JSON compresso con zlib) e
+    delegati a un backend: in-memory LRU per processo oppure condiviso (SQLite/Redis)
+    tra tutti i worker gunicorn dello stesso host.
+    """
+    def __init__(self, ttl_seconds=300, max_entries=1000, max_bytes=50 * 1024 * 1024,  # Default: 5 minuti
+                 backend: Optional[CacheBackend] = None, namespace='query'):
+        self.backend = backend or MemoryCacheBackend(max_entries=max_entries, max_bytes=max_bytes)
         self.ttl = ttl_seconds
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+    
+    def _key(self, key):
+        return f"{self.namespace}:{key}"
+    
+    @staticmethod
+    def _serialize(value) -> bytes:
+        return zlib.compress(json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+    
+    @staticmethod
+    def _deserialize(payload: bytes):
+        return json.loads(zlib.decompress(payload).decode('utf-8'))
     
     def get(self, key):
         """Recupera valore dalla cache se non scaduto"""
-        if key in self.cache:
-            value, timestamp = self.cache[key]
-            if time.time() - timestamp < self.ttl:
-                logger.debug(f"Cache HIT per query: {key[:50]}...")
-                return value
-            else:
-                # Scaduto, rimuovi
-                del self.cache[key]
-                logger.debug(f"Cache EXPIRED per query: {key[:50]}...")
-        return None
+        try:
+            payload = self.backend.get(self._key(key))
+        except Exception as e:
+            logger.warning(f"Errore lettura cache: {str(e)}")
+            payload = None
+        
+        if payload is None:
+            self.misses += 1
+            return None
+        
+        self.hits += 1
+        logger.debug(f"Cache HIT per query: {key[:50]}...")
+        return self._deserialize(payload)
     
     def set(self, key, value):
-        """Memorizza valore in cache con timestamp"""
-        self.cache[key] = (value, time.time())
-        logger.debug(f"Cache SET per query: {key[:50]}...")
+        """Memorizza valore in cache con scadenza"""
+        try:
+            self.backend.set(self._key(key), self._serialize(value), self.ttl)
+            logger.debug(f"Cache SET per query: {key[:50]}...")
+        except Exception as e:
+            # La cache è un'ottimizzazione: un errore del backend non deve bloccare la richiesta
+            logger.warning(f"Errore scrittura cache: {str(e)}")
     
     def clear(self):
         """Svuota cache"""
-        self.cache.clear()
+        self.backend.clear()
         logger.info("Cache svuotata")
     
     def size(self):
         """Ritorna numero elementi in cache"""
-        return len(self.cache)
+        return self.backend.stats().get('entries', 0)
+    
+    def stats(self) -> dict:
+        """Ritorna contatori del processo e occupazione del backend"""
+        stats = {'hits': self.hits, 'misses': self.misses}
+        stats.update(self.backend.stats())
+        return stats
 
 # Inizializza cache globale
-query_cache = QueryCache(ttl_seconds=int(os.getenv('QUERY_CACHE_TTL', '300')))
+query_cache = QueryCache(
+    ttl_seconds=int(os.getenv('QUERY_CACHE_TTL', '300')),
+    backend=create_cache_backend(
+        QUERY_CACHE_BACKEND,
+        path=SHARED_STATE_PATH,
+        redis_url=os.getenv('REDIS_URL', 'redis://localhost:6379/0'),
+        max_entries=int(os.getenv('QUERY_CACHE_MAX_ENTRIES', '1000')),
+        max_bytes=int(os.getenv('QUERY_CACHE_MAX_BYTES', str(50 * 1024 * 1024)))
+    )
+)
+
+# Cache delle risposte generate, chiave = impronta di prompt + modello + generationConfig
+generation_cache = QueryCache(
+    ttl_seconds=GENERATION_CACHE_TTL,
+    backend=create_cache_backend(
+        QUERY_CACHE_BACKEND,
+        path=SHARED_STATE_PATH,
+        redis_url=os.getenv('REDIS_URL', 'redis://localhost:6379/0'),
+        max_entries=int(os.getenv('GENERATION_CACHE_MAX_ENTRIES', '500')),
+        max_bytes=int(os.getenv('GENERATION_CACHE_MAX_BYTES', str(20 * 1024 * 1024))),
+        name='generation_cache'
+    ),
+    namespace='generation'
+)
+
+# Indice MinHash delle query recenti per servire dalla cache domande quasi identiche
+query_similarity_index = MinHashIndex(max_entries=int(os.getenv('QUERY_CACHE_MAX_ENTRIES', '1000')))
 
-# Rate limiter in-memory
+# Rate limiter
 class RateLimiter:
-    """Rate limiter semplice basato su token bucket"""
-    def __init__(self, max_requests=10, time_window=60):
+    """
+    Rate limiter basato su token bucket: max_requests per time_window per client.
+    Ogni controllo è O(1); lo stato dei client è delegato a uno store
+    (in-memory per processo oppure SQLite condiviso tra i worker).
+    """
+    def __init__(self, max_requests=10, time_window=60, store=None):
         self.max_requests = max_requests
         self.time_window = time_window  # secondi
-        self.requests = {}  # {ip: [(timestamp, ...), ...]}
+        self.refill_rate = max_requests / time_window  # token al secondo
+        # Dopo time_window di inattività il bucket è di nuovo pieno: lo stato si può eliminare
+        self.store = store or MemoryRateLimitStore(idle_seconds=time_window)
     
     def is_allowed(self, identifier):
         """Verifica se la richiesta è permessa"""
-        now = time.time()
-        
-        # Pulisci richieste vecchie
-        if identifier in self.requests:
-            self.requests[identifier] = [
-                ts for ts in self.requests[identifier]
-                if now - ts < self.time_window
-            ]
-        else:
-            self.requests[identifier] = []
+        try:
+            allowed, _ = self.store.consume(identifier, self.max_requests, self.refill_rate)
+        except Exception as e:
+            # Store condiviso non disponibile: meglio lasciar passare che bloccare il servizio
+            logger.warning(f"Rate limiter non disponibile: {str(e)}")
+            return True
         
-        # Controlla limite
-        if len(self.requests[identifier]) >= self.max_requests:
+        if not allowed:
             logger.warning(f"Rate limit exceeded per {identifier}")
-            return False
-        
-        # Aggiungi nuova richiesta
-        self.requests[identifier].append(now)
-        return True
+        return allowed
     
     def get_remaining(self, identifier):
         """Ritorna richieste rimanenti"""
-        now = time.time()
-        if identifier not in self.requests:
-            return self.max_requests
-        
-        recent = [ts for ts in self.requests[identifier] if now - ts < self.time_window]
-        return max(0, self.max_requests - len(recent))
+        return int(self.store.peek(identifier, self.max_requests, self.refill_rate))
 
 # Inizializza rate limiter
+RATE_LIMIT_WINDOW = int(os.getenv('RATE_LIMIT_WINDOW', '60'))
 rate_limiter = RateLimiter(
     max_requests=int(os.getenv('RATE_LIMIT_MAX', '30')),
-    time_window=int(os.getenv('RATE_LIMIT_WINDOW', '60'))
+    time_window=RATE_LIMIT_WINDOW,
+    store=create_rate_limit_store(RATE_LIMIT_BACKEND, path=SHARED_STATE_PATH, idle_seconds=RATE_LIMIT_WINDOW)
 )
 
-# Session requests per connection pooling
+# Retry delle chiamate upstream: un solo livello, condiviso da endpoint, provider e ingestion
+retry_policy = RetryPolicy(
+    max_attempts=RETRY_MAX_ATTEMPTS,
+    base_delay=RETRY_BASE_DELAY,
+    max_delay=RETRY_MAX_DELAY,
+    budget=RetryBudget(ratio=RETRY_BUDGET_RATIO, min_per_second=RETRY_BUDGET_MIN_PER_SECOND)
+)
+
+# Session requests per connection pooling (i retry sono gestiti da retry_policy, non dall'adapter)
 http_session = requests.Session()
 adapter = requests.adapters.HTTPAdapter(
     pool_connections=10,
-    pool_maxsize=20,
-    max_retries=3
+    pool_maxsize=max(20, QUERY_FANOUT_WORKERS),  # Almeno una connessione per ogni worker del fan-out
+    max_retries=0
 )
 http_session.mount('https://', adapter)
 http_session.mount('http://', adapter)
 
+# Pool di thread condiviso per il fan-out delle query (limita la concorrenza per processo)
+fanout_executor = ThreadPoolExecutor(max_workers=QUERY_FANOUT_WORKERS, thread_name_prefix='query-fanout')
+
 # Circuit Breaker per gestione rate limit
 class CircuitBreaker:
-    """Circuit breaker per gestire rate limit 429"""
-    def __init__(self, failure_threshold=5, timeout=60):
+    """
+    Circuit breaker per gestire rate limit 429 su una singola operazione/modello.
+    Lo stato vive in uno store (in-memory o condiviso tra i worker): in HALF_OPEN
+    viene lasciata passare una sola chiamata di prova alla volta.
+    """
+    def __init__(self, key='default', failure_threshold=5, timeout=60, probe_timeout=30, store=None):
+        self.key = key
         self.failure_threshold = failure_threshold
-        self.timeout = timeout  # secondi
-        self.failure_count = 0
-        self.last_failure_time: Optional[datetime] = None
-        self.state = 'CLOSED'  # CLOSED, OPEN, HALF_OPEN
+        self.timeout = timeout  # secondi in OPEN prima della chiamata di prova
+        self.probe_timeout = probe_timeout  # secondi dopo i quali una prova senza esito viene ripetuta
+        self.store = store or MemoryBreakerStore()
+    
+    @property
+    def state(self) -> str:
+        """Stato corrente: CLOSED, OPEN, HALF_OPEN"""
+        return self.store.get(self.key)['state']
     
     def call_allowed(self) -> bool:
         """Verifica se la chiamata è permessa"""
-        if self.state == 'CLOSED':
+        try:
+            allowed, previous = self.store.acquire(self.key, self.timeout, self.probe_timeout)
+        except Exception as e:
+            logger.warning(f"Circuit breaker {self.key} non disponibile: {str(e)}")
             return True
         
-        if self.state == 'OPEN':
-            # Verifica se è passato il timeout
-            if self.last_failure_time and datetime.now() - self.last_failure_time > timedelta(seconds=self.timeout):
-                self.state = 'HALF_OPEN'
-                logger.info("Circuit breaker: OPEN -> HALF_OPEN (timeout scaduto)")
-                return True
-            return False
-        
-        # HALF_OPEN: permette una chiamata di test
-        return True
+        if allowed and previous != 'CLOSED':
+            logger.info(f"Circuit breaker {self.key}: {previous} -> HALF_OPEN (chiamata di prova)")
+        return allowed
     
     def record_success(self):
         """Registra una chiamata riuscita"""
-        self.failure_count = 0
-        if self.state == 'HALF_OPEN':
-            self.state = 'CLOSED'
-            logger.info("Circuit breaker: HALF_OPEN -> CLOSED (successo)")
+        try:
+            previous = self.store.record_success(self.key)
+        except Exception as e:
+            logger.warning(f"Circuit breaker {self.key} non disponibile: {str(e)}")
+            return
+        
+        if previous != 'CLOSED':
+            logger.info(f"Circuit breaker {self.key}: {previous} -> CLOSED (successo)")
     
     def record_failure(self):
         """Registra una chiamata fallita"""
-        self.failure_count += 1
-        self.last_failure_time = datetime.now()
+        try:
+            state, failures = self.store.record_failure(self.key, self.failure_threshold)
+        except Exception as e:
+            logger.warning(f"Circuit breaker {self.key} non disponibile: {str(e)}")
+            return
+        
+        if state == 'OPEN':
+            logger.warning(f"Circuit breaker {self.key}: OPEN (troppi errori: {failures})")
+
+class CircuitBreakerRegistry:
+    """Un circuit breaker per ogni coppia operazione upstream / modello, con store comune"""
+    def __init__(self, failure_threshold=5, timeout=60, probe_timeout=30, store=None):
+        self.failure_threshold = failure_threshold
+        self.timeout = timeout
+        self.probe_timeout = probe_timeout
+        self.store = store or MemoryBreakerStore()
+        self.breakers = {}
+        self.lock = threading.Lock()
+    
+    def get(self, operation: str, model: str = '') -> CircuitBreaker:
+        """Ritorna il breaker per operazione e modello (creato al primo utilizzo)"""
+        key = f"{operation}:{model}"
+        with self.lock:
+            if key not in self.breakers:
+                self.breakers[key] = CircuitBreaker(
+                    key=key,
+                    failure_threshold=self.failure_threshold,
+                    timeout=self.timeout,
+                    probe_timeout=self.probe_timeout,
+                    store=self.store
+                )
+            return self.breakers[key]
+
+# Registro globale dei circuit breaker
+circuit_breakers = CircuitBreakerRegistry(
+    failure_threshold=int(os.getenv('CIRCUIT_BREAKER_THRESHOLD', '5')),
+    timeout=int(os.getenv('CIRCUIT_BREAKER_TIMEOUT', '60')),
+    store=create_breaker_store(CIRCUIT_BREAKER_BACKEND, path=SHARED_STATE_PATH)
+)
+
+# Catalogo documenti in-memory
+class DocumentCatalog:
+    """
+    Catalogo in-memory dei documenti del File Search Store.
+    Scorre tutte le pagine (nextPageToken) e si riallinea allo scadere del TTL
+    oppure quando upload, eliminazioni o operazioni completate modificano lo store.
+    Mantiene allineato l'indice dei customMetadata usato dai filtri sulle query.
+    """
+    def __init__(self, ttl_seconds=60, page_size=20):
+        self.ttl = ttl_seconds
+        self.page_size = page_size  # Max 20 per Google API
+        self.documents = {}  # {document_name: document}
+        self.last_refresh = 0.0
+        self.stale = True
+        self.lock = threading.Lock()
+        self.metadata_index = MetadataIndex()
+    
+    def _fetch_all(self) -> dict:
+        """Scarica l'elenco completo dei documenti seguendo tutte le pagine"""
+        url = f"{BASE_URL}/{FILE_SEARCH_STORE_NAME}/documents"
+        documents = {}
+        page_token = ''
+        pages = 0
+        
+        while True:
+            params = {'pageSize': self.page_size}
+            if page_token:
+                params['pageToken'] = page_token
+            
+            response = retry_policy.send(
+                lambda: http_session.get(url, headers=get_headers(), params=params, timeout=QUERY_DOCUMENT_TIMEOUT),
+                'listDocuments'
+            )
+            response.raise_for_status()
+            
+            data = response.json()
+            for doc in data.get('documents', []):
+                documents[doc.get('name')] = doc
+            pages += 1
+            
+            page_token = data.get('nextPageToken', '')
+            if not page_token:
+                break
         
-        if self.failure_count >= self.failure_threshold:
-            self.state = 'OPEN'
-            logger.warning(f"Circuit breaker: OPEN (troppi errori: {self.failure_count})")
+        logger.info(f"Catalogo documenti aggiornato: {len(documents)} documenti in {pages} pagine")
+        return documents
+    
+    def _is_fresh(self) -> bool:
+        return not self.stale and time.time() - self.last_refresh < self.ttl
+    
+    def refresh(self, force=False):
+        """Riallinea il catalogo con lo store (un solo refresh alla volta)"""
+        with self.lock:
+            if not force and self._is_fresh():
+                return
+            try:
+                self.documents = self._fetch_all()
+                self.metadata_index.rebuild(self.documents.values())
+                self.last_refresh = time.time()
+                self.stale = False
+            except requests.exceptions.RequestException as e:
+                # Con un catalogo già caricato continuiamo a servire i dati precedenti
+                if not self.last_refresh:
+                    raise
+                logger.warning(f"Aggiornamento catalogo fallito, uso dati precedenti: {str(e)}")
+    
+    def get_documents(self) -> list:
+        """Ritorna tutti i documenti noti, aggiornando il catalogo se necessario"""
+        if not self._is_fresh():
+            self.refresh()
+        return list(self.documents.values())
+    
+    def get_active_documents(self, metadata_filter: tuple = None) -> list:
+        """Ritorna solo i documenti in STATE_ACTIVE (e, se indicato, che soddisfano il filtro metadati compilato)"""
+        documents = [doc for doc in self.get_documents() if doc.get('state') == 'STATE_ACTIVE']
+        if metadata_filter is None:
+            return documents
+        matching = self.metadata_index.matching(metadata_filter, [doc.get('name') for doc in documents])
+        return [doc for doc in documents if doc.get('name') in matching]
+    
+    def get_document(self, document_name: str) -> Optional[dict]:
+        """Ritorna un documento del catalogo (None se sconosciuto)"""
+        if not self._is_fresh():
+            self.refresh()
+        return self.documents.get(document_name)
+    
+    def upsert(self, document: dict):
+        """Aggiunge o aggiorna un documento senza riscaricare il catalogo"""
+        with self.lock:
+            self.documents[document.get('name')] = document
+            self.metadata_index.upsert(document)
+    
+    def remove(self, document_name: str):
+        """Rimuove un documento senza riscaricare il catalogo"""
+        with self.lock:
+            self.documents.pop(document_name, None)
+            self.metadata_index.remove(document_name)
+    
+    def invalidate(self):
+        """Forza il riallineamento alla prossima lettura"""
+        self.stale = True
+        logger.debug("Catalogo documenti invalidato")
+    
+    def size(self):
+        """Ritorna numero documenti in catalogo"""
+        return len(self.documents)
+
+# Inizializza catalogo globale
+document_catalog = DocumentCatalog(ttl_seconds=DOCUMENT_CATALOG_TTL)
 
-# Istanza globale del circuit breaker
-gemini_circuit_breaker = CircuitBreaker(failure_threshold=5, timeout=60)
+def fetch_operation(operation_name: str) -> dict:
+    """GET upstream dello stato di un'operazione"""
+    response = retry_policy.send(
+        lambda: http_session.get(f"{BASE_URL}/{operation_name}", headers=get_headers(), timeout=QUERY_DOCUMENT_TIMEOUT),
+        'getOperation'
+    )
+    response.raise_for_status()
+    return response.json()
+
+def on_operation_done(operation_data: dict):
+    """Aggiorna il catalogo al completamento di un'operazione di upload"""
+    if 'error' in operation_data:
+        logger.warning(f"Operazione completata con errore: {operation_data['error']}")
+        return
+    
+    logger.info(f"Operazione completata con successo: {operation_data.get('name')}")
+    
+    # Inserisci il documento se la risposta lo contiene, altrimenti riallinea
+    document = operation_data.get('response', {})
+    if document.get('name') and document.get('state'):
+        document_catalog.upsert(document)
+    else:
+        document_catalog.invalidate()
+    
+    # Il testo registrato durante l'upload passa al documento definitivo
+    # (la risposta di uploadToFileSearchStore indica il documento creato in documentName)
+    document_name = document.get('documentName') or document.get('name')
+    if document_name and operation_data.get('name'):
+        update_local_index(lexical_index.rename, PENDING_PREFIX + operation_data['name'], document_name)
+        update_local_index(lexical_index.prune_pending)
+
+# Tracker delle operazioni di upload (polling upstream in background con backoff adattivo)
+operation_tracker = OperationTracker(
+    fetch_fn=fetch_operation,
+    on_done=on_operation_done,
+    min_interval=OPERATION_POLL_MIN_INTERVAL,
+    max_interval=OPERATION_POLL_MAX_INTERVAL,
+    max_failures=OPERATION_POLL_MAX_FAILURES,
+    max_age_seconds=OPERATION_MAX_AGE
+)
+
+def on_upload_started(operation_data: dict):
+    """Registra una nuova operazione di upload e riallinea il catalogo"""
+    if operation_data.get('name'):
+        operation_tracker.register(operation_data['name'], operation_data)
+    # Il nuovo documento comparirà nello store: riallinea il catalogo alla prossima query
+    document_catalog.invalidate()
+
+# Gestore dei job di caricamento massivo (stato su file, leggibile da tutti i worker)
+ingestion_manager = IngestionJobManager(
+    # Il job ritenta i 429 con la propria backpressure: l'upload non ritenta a sua volta
+    upload_fn=lambda path, filename, metadata: upload_file_to_store(path, filename, metadata, max_attempts=1),
+    jobs_dir=os.path.join(app.config['UPLOAD_FOLDER'], 'bulk_ingestion'),
+    max_workers=BULK_UPLOAD_WORKERS,
+    retry_policy=retry_policy,
+    on_uploaded=on_upload_started,
+    save_interval=BULK_UPLOAD_SAVE_INTERVAL
+)
 
 def get_headers():
     """Restituisce gli headers per le richieste API"""
@@ -206,41 +608,6 @@ def get_headers():
         'x-goog-api-key': GEMINI_API_KEY
     }
 
-def fix_encoding_issues(text: str) -> str:
-    """
-    Corregge problemi comuni di encoding UTF-8 mal interpretato come Latin-1
-    """
-    if not text:
-        return text
-    
-    # Mappa dei caratteri comuni mal codificati
-    replacements = {
-        'â¬': '€',     # Euro
-        'Ã ': 'à',     # a con accento grave
-        'Ã¨': 'è',     # e con accento grave
-        'Ã©': 'é',     # e con accento acuto
-        'Ã¬': 'ì',     # i con accento grave
-        'Ã²': 'ò',     # o con accento grave
-        'Ã¹': 'ù',     # u con accento grave
-        'Ã': 'À',      # A con accento grave
-        'Ã': 'È',      # E con accento grave
-        'Ã': 'É',      # E con accento acuto
-        'Ã': 'Ì',      # I con accento grave
-        'Ã': 'Ò',      # O con accento grave
-        'Ã': 'Ù',      # U con accento grave
-        'â': '"',      # Virgolette
-        'â': '"',      # Virgolette
-        'â': "'",      # Apostrofo
-        'â¦': '...',   # Ellipsis
-        'â': '–',      # En dash
-        'â': '—',      # Em dash
-    }
-    
-    for wrong, correct in replacements.items():
-        text = text.replace(wrong, correct)
-    
-    return text
-
 def validate_query_text(query: str) -> tuple[bool, Optional[str]]:
     """
     Valida il testo della query
@@ -315,6 +682,18 @@ def validate_metadata(metadata_keys: list, metadata_values: list) -> tuple[bool,
     
     return True, None
 
+def parse_metadata_filter(expression) -> tuple[Optional[tuple], Optional[str]]:
+    """
+    Compila il filtro metadati opzionale di una query
+    Returns: (filtro compilato o None, error_message)
+    """
+    if expression is None or expression == '':
+        return None, None
+    try:
+        return parse_filter(expression), None
+    except MetadataFilterError as e:
+        return None, str(e)
+
 def validate_config():
     """Valida la configurazione dell'applicazione"""
     if not GEMINI_API_KEY:
@@ -323,6 +702,56 @@ def validate_config():
         raise ValueError("FILE_SEARCH_STORE_NAME non configurato")
     logger.info(f"Configurazione valida. Store: {FILE_SEARCH_STORE_NAME}")
 
+# Provider di generazione: un'istanza (e un pool di connessioni) per provider e per processo
+def provider_credentials(name: str, default_model: str) -> tuple:
+    """Chiave API e modello di un provider OpenAI-compatibile, come primario o come riserva"""
+    if name == GENERATION_PROVIDER:
+        return GENERATION_API_KEY, GENERATION_MODEL
+    return GENERATION_FALLBACK_API_KEY, GENERATION_FALLBACK_MODEL or default_model
+
+generation_providers = ProviderRegistry()
+# Con un provider di riserva il primario non ritenta su 429/503: il failover è più rapido del backoff
+generation_providers.register('gemini', lambda: GeminiProvider(
+    http_session, BASE_URL, get_headers, DEFAULT_MODEL, retry_policy=retry_policy,
+    max_attempts=1 if GENERATION_FALLBACK_PROVIDER and GENERATION_PROVIDER == 'gemini' else None
+))
+generation_providers.register('deepseek', lambda: OpenAICompatibleProvider(
+    'deepseek', *provider_credentials('deepseek', 'deepseek-chat'), base_url='https://api.deepseek.com',
+    retry_policy=retry_policy
+))
+generation_providers.register('openai', lambda: OpenAICompatibleProvider(
+    'openai', *provider_credentials('openai', 'gpt-4o-mini'), retry_policy=retry_policy
+))
+
+def generation_target(requested_model: str = None) -> tuple:
+    """
+    Provider e modello da usare per la generazione
+    Con Gemini vale il modello richiesto dal client (default GENERATION_MODEL), con gli altri provider GENERATION_MODEL
+    """
+    provider = generation_providers.get(GENERATION_PROVIDER)
+    if provider.name == 'gemini':
+        return provider, requested_model or GENERATION_MODEL
+    return provider, GENERATION_MODEL
+
+def generation_targets(requested_model: str = None) -> list:
+    """Provider primario e (se configurato) di riserva, in ordine di preferenza"""
+    targets = [GenerationTarget(*generation_target(requested_model))]
+    if GENERATION_FALLBACK_PROVIDER:
+        fallback = generation_providers.get(GENERATION_FALLBACK_PROVIDER)
+        target = GenerationTarget(fallback, GENERATION_FALLBACK_MODEL or fallback.default_model)
+        # Stesso provider come riserva ha senso solo con un modello diverso
+        if target != targets[0]:
+            targets.append(target)
+    return targets
+
+# Failover e hedging tra i provider; i circuit breaker restano per operazione e modello
+generation_router = GenerationRouter(
+    generation_targets,
+    circuit_breakers.get,
+    hedge_percentile=GENERATION_HEDGE_PERCENTILE,
+    hedge_min_delay=GENERATION_HEDGE_MIN_DELAY
+)
+
 def call_generation_provider(messages: list, max_tokens: int = None, temperature: float = 0.7) -> str:
     """
     Chiama il provider di generazione configurato (Gemini, DeepSeek, OpenAI, etc.)
@@ -335,83 +764,154 @@ def call_generation_provider(messages: list, max_tokens: int = None, temperature
     Returns:
         Il testo della risposta generata
     """
-    max_tokens = max_tokens or MAX_OUTPUT_TOKENS
+    candidates = generation_router.acquire('generateContent')
+    generation, _ = generation_router.generate(
+        'generateContent', candidates, messages,
+        max_tokens=max_tokens or MAX_OUTPUT_TOKENS,
+        temperature=temperature
+    )
+    return generation.text
+
+def query_single_document(doc: dict, query_text: str, results_count: int) -> list:
+    """
+    Interroga un singolo documento del File Search Store
+    Returns: lista di chunk annotati con il documento sorgente
+    """
+    doc_name = doc.get('name')
+    query_url = f"{BASE_URL}/{doc_name}:query"
     
-    if GENERATION_PROVIDER == 'deepseek':
-        # DeepSeek API (compatibile OpenAI)
-        import openai
-        client = openai.OpenAI(
-            api_key=GENERATION_API_KEY,
-            base_url="https://api.deepseek.com"
-        )
-        
-        # Converti formato messaggi
-        deepseek_messages = []
-        for msg in messages:
-            deepseek_messages.append({
-                'role': msg.get('role'),
-                'content': msg.get('content', '')
-            })
-        
-        response = client.chat.completions.create(
-            model=GENERATION_MODEL,
-            messages=deepseek_messages,
-            max_tokens=max_tokens,
-            temperature=temperature
-        )
-        
-        return response.choices[0].message.content
+    query_payload = {
+        'query': query_text,
+        'resultsCount': results_count
+    }
     
-    elif GENERATION_PROVIDER == 'openai':
-        # OpenAI API
-        import openai
-        client = openai.OpenAI(api_key=GENERATION_API_KEY)
-        
-        openai_messages = []
-        for msg in messages:
-            openai_messages.append({
-                'role': msg.get('role'),
-                'content': msg.get('content', '')
-            })
-        
-        response = client.chat.completions.create(
-            model=GENERATION_MODEL,
-            messages=openai_messages,
-            max_tokens=max_tokens,
-            temperature=temperature
-        )
-        
-        return response.choices[0].message.content
+    query_response = retry_policy.send(
+        lambda: http_session.post(query_url, headers=get_headers(), json=query_payload, timeout=QUERY_DOCUMENT_TIMEOUT),
+        'queryDocument'
+    )
+    query_response.raise_for_status()
     
-    else:  # default: gemini
-        # Gemini API (logica esistente)
-        contents = []
-        for msg in messages:
-            contents.append({
-                'role': msg.get('role'),
-                'parts': [{'text': msg.get('content', '')}]
-            })
-        
-        generate_url = f"{BASE_URL}/models/{GENERATION_MODEL}:generateContent"
-        payload = {
-            'contents': contents,
-            'generationConfig': {
-                'temperature': temperature,
-                'topK': 40,
-                'topP': 0.95,
-                'maxOutputTokens': max_tokens,
-            }
-        }
-        
-        response = http_session.post(generate_url, headers=get_headers(), json=payload, timeout=60)
-        response.raise_for_status()
-        
-        result = response.json()
-        candidates = result.get('candidates', [])
-        if not candidates:
-            raise ValueError('Nessuna risposta generata dal modello')
-        
-        return candidates[0].get('content', {}).get('parts', [{}])[0].get('text', '')
+    chunks = query_response.json().get('relevantChunks', [])
+    
+    # Aggiungi informazioni sul documento sorgente
+    for chunk in chunks:
+        chunk['source_document'] = doc.get('displayName', doc_name)
+    
+    return chunks
+
+def iter_documents_parallel(documents: list, query_text: str, chunks_per_document: int):
+    """
+    Interroga più documenti in parallelo con concorrenza limitata (QUERY_FANOUT_WORKERS)
+    e restituisce (documento, chunk) man mano che le risposte arrivano.
+    Allo scadere di QUERY_FANOUT_DEADLINE, o se il consumatore smette di leggere,
+    i documenti ancora in attesa vengono scartati.
+    """
+    futures = {
+        fanout_executor.submit(query_single_document, doc, query_text, chunks_per_document): doc
+        for doc in documents
+    }
+    
+    try:
+        for future in as_completed(futures, timeout=QUERY_FANOUT_DEADLINE):
+            doc = futures[future]
+            try:
+                chunks = future.result()
+            except Exception as e:
+                logger.warning(f"Errore query su documento {doc.get('name')}: {str(e)}")
+                continue
+            
+            logger.info(f"  - {doc.get('displayName')}: {len(chunks)} chunks recuperati")
+            remember_chunks(doc.get('name'), chunks)
+            yield doc, chunks
+    except FuturesTimeoutError:
+        logger.warning(f"Deadline fan-out ({QUERY_FANOUT_DEADLINE}s) superata, uso i risultati parziali")
+    finally:
+        pending = [future for future in futures if not future.done()]
+        for future in pending:
+            future.cancel()
+        if pending:
+            logger.info(f"Fan-out interrotto: {len(pending)} documenti senza risposta")
+
+def query_documents_parallel(documents: list, query_text: str, chunks_per_document: int) -> list:
+    """
+    Interroga più documenti in parallelo e unisce i risultati (anche parziali)
+    """
+    all_chunks = []
+    for _, chunks in iter_documents_parallel(documents, query_text, chunks_per_document):
+        all_chunks.extend(chunks)
+    return all_chunks
+
+def chunks_per_document_for(results_count: int, documents_count: int) -> int:
+    """
+    Calcola chunks per documento: distribuisci RESULTS_COUNT tra i documenti
+    Con 25 chunks e 5 documenti = 5 chunks per documento
+    Con 25 chunks e 10 documenti = 3 chunks per documento (arrotonda up)
+    """
+    return max(3, (results_count + documents_count - 1) // documents_count)
+
+def select_query_documents(query_text: str, documents: list) -> list:
+    """Documenti da interrogare: preselezione con l'indice lessicale se LEXICAL_PREFILTER_TOP_K > 0"""
+    if LEXICAL_PREFILTER_TOP_K <= 0 or len(documents) <= LEXICAL_PREFILTER_TOP_K:
+        return documents
+    try:
+        selected = lexical_index.select_documents(query_text, documents, LEXICAL_PREFILTER_TOP_K)
+    except Exception as e:
+        logger.warning(f"Indice lessicale non disponibile, interrogo tutti i documenti: {str(e)}")
+        return documents
+    if len(selected) < len(documents):
+        logger.info(f"Preselezione lessicale: {len(selected)}/{len(documents)} documenti da interrogare")
+    return selected
+
+def rank_retrieved_chunks(query_text: str, chunks: list, limit: int) -> list:
+    """
+    Ordina i chunk recuperati e tiene i primi `limit`: con il re-ranking attivo
+    per rerankScore (score upstream calibrato per documento + BM25), altrimenti
+    per chunkRelevanceScore
+    """
+    if RERANK_ENABLED:
+        ranked = rerank_chunks(query_text, chunks, bm25_weight=RERANK_BM25_WEIGHT, doc_norm_weight=RERANK_DOC_NORM_WEIGHT)
+    else:
+        ranked = sorted(chunks, key=lambda x: x.get('chunkRelevanceScore', 0), reverse=True)
+    return ranked[:limit]
+
+def retrieval_cache_lookup(query_text: str, document_name: Optional[str], results_count: int, metadata_filter: tuple = None) -> tuple:
+    """
+    Cerca il risultato di una query nella cache, per chiave canonica
+    (maiuscole, spazi, punteggiatura e accenti non contano) e, se attiva,
+    per similarità con query quasi identiche.
+    Returns: (cache_key, canonical_query, cache_scope, risultato in cache o None)
+    """
+    canonical_query = canonicalize_query(query_text)
+    cache_scope = f"{document_name}:{results_count}"
+    if metadata_filter is not None:
+        # Filtro compilato: espressioni equivalenti (spazi, maiuscole dei valori) condividono la voce
+        cache_scope += f":{zlib.crc32(repr(metadata_filter).encode('utf-8')):08x}"
+    cache_key = f"{canonical_query}:{cache_scope}"
+    cached_result = query_cache.get(cache_key)
+    if cached_result:
+        logger.info("Risultato recuperato da cache")
+        # La voce può essere stata salvata da una variante della query (maiuscole, punteggiatura)
+        return cache_key, canonical_query, cache_scope, dict(cached_result, query=query_text)
+    
+    # Ricerca di una query quasi identica già in cache (opzionale)
+    if QUERY_SIMILARITY_THRESHOLD > 0:
+        match = query_similarity_index.query(canonical_query, scope=cache_scope, threshold=QUERY_SIMILARITY_THRESHOLD)
+        if match:
+            similar_key, similarity = match
+            cached_result = query_cache.get(similar_key)
+            if cached_result:
+                logger.info(f"Risultato recuperato da cache per query simile (similarità {similarity:.2f})")
+                return cache_key, canonical_query, cache_scope, dict(cached_result, query=query_text, cache_similarity=round(similarity, 3))
+            # Voce scaduta o rimossa dalla cache: non serve più nell'indice
+            query_similarity_index.discard(similar_key)
+    
+    return cache_key, canonical_query, cache_scope, None
+
+def retrieval_cache_store(cache_key: str, canonical_query: str, cache_scope: str, result_data: dict):
+    """Salva in cache il risultato di una query (e lo indicizza per similarità)"""
+    query_cache.set(cache_key, result_data)
+    if QUERY_SIMILARITY_THRESHOLD > 0:
+        query_similarity_index.add(cache_key, canonical_query, scope=cache_scope)
 
 @app.route('/')
 def index():
@@ -436,6 +936,19 @@ def get_config():
         logger.error(f"Errore nel recupero configurazione: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """Restituisce le statistiche delle cache (query e risposte generate) e dei retry upstream"""
+    return jsonify({
+        'success': True,
+        'query_cache': query_cache.stats(),
+        'generation_cache': generation_cache.stats(),
+        'retry_policy': retry_policy.stats(),
+        'lexical_index': lexical_index.stats(),
+        'metadata_index': document_catalog.metadata_index.stats(),
+        'chunk_mirror': chunk_mirror.stats() if chunk_mirror is not None else None
+    })
+
 @app.route('/api/documents', methods=['GET'])
 def list_documents():
     """Elenca tutti i documenti nel File Search Store"""
@@ -452,7 +965,7 @@ def list_documents():
             params['pageToken'] = page_token
         
         logger.info(f"Recupero documenti da: {url}")
-        response = http_session.get(url, headers=headers, params=params)
+        response = retry_policy.send(lambda: http_session.get(url, headers=headers, params=params), 'listDocuments')
         response.raise_for_status()
         
         data = response.json()
@@ -478,9 +991,155 @@ def list_documents():
         logger.error(f"Errore imprevisto: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def build_upload_metadata(form, filename: str) -> tuple[Optional[dict], Optional[str]]:
+    """
+    Costruisce i metadati per uploadToFileSearchStore dai campi del form
+    (displayName, mimeType, chunkSize, metadataKeys[], metadataValues[])
+    Returns: (metadata, error_message)
+    """
+    # Recupera metadati opzionali
+    display_name = form.get('displayName', filename)
+    mime_type = form.get('mimeType', '')
+    chunk_size = int(form.get('chunkSize', DEFAULT_CHUNK_SIZE))  # Default dal .env
+    
+    # VALIDAZIONE CHUNK SIZE (limite API Google: 1-512)
+    if chunk_size < 1 or chunk_size > 512:
+        return None, f'Chunk size deve essere tra 1 e 512 (ricevuto: {chunk_size})'
+    
+    # Inferisci MIME type se non fornito
+    if not mime_type:
+        mime_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    
+    # VALIDAZIONE MIME TYPE
+    is_valid, error = validate_mime_type(mime_type, filename)
+    if not is_valid:
+        return None, error
+    
+    # Metadati custom (opzionale)
+    custom_metadata = {}
+    metadata_keys = form.getlist('metadataKeys[]')
+    metadata_values = form.getlist('metadataValues[]')
+    
+    logger.info(f"Metadati ricevuti - Keys: {metadata_keys}, Values: {metadata_values}")
+    
+    # VALIDAZIONE METADATI
+    if metadata_keys or metadata_values:
+        is_valid, error = validate_metadata(metadata_keys, metadata_values)
+        if not is_valid:
+            logger.error(f"Validazione metadati fallita: {error}")
+            return None, error
+    
+    # Filtra e aggiungi solo metadati non vuoti
+    for key, value in zip(metadata_keys, metadata_values):
+        if key and key.strip() and value and value.strip():
+            custom_metadata[key.strip()] = value.strip()
+    
+    logger.info(f"Metadati custom validati: {custom_metadata}")
+    
+    # Prepara i metadati del documento come JSON
+    metadata = {
+        'displayName': display_name.strip()[:100],  # Max 100 caratteri e senza spazi extra
+        'mimeType': mime_type
+    }
+    
+    if custom_metadata:
+        metadata['customMetadata'] = [
+            {'key': k, 'stringValue': v} for k, v in custom_metadata.items()
+        ]
+    
+    # CONFIGURAZIONE CHUNKING per divisione ottimale del documento
+    # La configurazione segue la struttura corretta dell'API Google
+    chunk_overlap = min(int(chunk_size * CHUNK_OVERLAP_PERCENT / 100), 100)  # Overlap dal .env, max 100
+    
+    metadata['chunkingConfig'] = {
+        'whiteSpaceConfig': {
+            'maxTokensPerChunk': chunk_size,      # Dimensione massima chunk in token
+            'maxOverlapTokens': chunk_overlap     # Token di sovrapposizione tra chunks
+        }
+    }
+    
+    logger.info(f"Chunking config: max_tokens={chunk_size}, overlap={chunk_overlap}")
+    
+    return metadata, None
+
+def upload_file_to_store(file_path: str, filename: str, metadata: dict, max_attempts: int = None) -> dict:
+    """
+    Invia un file su disco a uploadToFileSearchStore (max_attempts: tentativi della politica di retry)
+    Returns: l'operazione (Long-Running Operation) restituita da Google
+    """
+    # URL per upload
+    url = f"{UPLOAD_BASE_URL}/{FILE_SEARCH_STORE_NAME}:uploadToFileSearchStore"
+    
+    headers = get_headers()
+    
+    # Apri il file salvato e invialo (non usare stream che carica in memoria)
+    with open(file_path, 'rb') as f:
+        files = {
+            'metadata': (None, json.dumps(metadata), 'application/json'),
+            'file': (secure_filename(filename), f, metadata['mimeType'])
+        }
+        
+        logger.info(f"Caricamento file: {filename} ({metadata['mimeType']})")
+        logger.info(f"Display name: {metadata['displayName']}")
+        logger.info(f"Metadata: {json.dumps(metadata)}")
+        
+        def send():
+            # A ogni tentativo il file viene riletto dall'inizio
+            f.seek(0)
+            return http_session.post(url, headers=headers, files=files)
+        
+        # Effettua l'upload - restituisce un'operazione
+        # (non idempotente: si ritenta solo se la richiesta non è partita, altrimenti si rischia un documento duplicato)
+        response = retry_policy.send(send, 'uploadToFileSearchStore', max_attempts, idempotent=False)
+        response.raise_for_status()
+    
+    operation_data = response.json()
+    text = read_text_for_index(file_path, metadata['mimeType'])
+    if text and operation_data.get('name'):
+        # Completo solo se il file non è stato troncato a LEXICAL_MAX_UPLOAD_BYTES
+        update_local_index(lexical_index.add_texts, PENDING_PREFIX + operation_data['name'], [text],
+                           os.path.getsize(file_path) <= LEXICAL_MAX_UPLOAD_BYTES)
+    return operation_data
+
+def upload_response(operation_data: dict):
+    """Risposta comune degli endpoint di upload"""
+    operation_name = operation_data.get('name', '')
+    
+    logger.info(f"Upload avviato. Operation: {operation_name}")
+    
+    on_upload_started(operation_data)
+    
+    return jsonify({
+        'success': True,
+        'operation': operation_data,
+        'operationName': operation_name,
+        'message': 'Upload avviato con successo. L\'elaborazione è in corso.'
+    })
+
+def upload_request_error(e: requests.exceptions.RequestException):
+    """Risposta di errore comune per gli errori HTTP durante l'upload"""
+    logger.error(f"Errore durante upload: {str(e)}")
+    error_detail = str(e)
+    if hasattr(e, 'response') and e.response is not None:
+        try:
+            error_detail = e.response.json()
+            logger.error(f"Dettagli errore API: {error_detail}")
+        except:
+            error_detail = e.response.text
+            logger.error(f"Risposta errore API (testo): {error_detail}")
+    return jsonify({
+        'success': False,
+        'error': 'Errore durante il caricamento',
+        'details': error_detail
+    }), 500
+
 @app.route('/api/documents/upload', methods=['POST'])
 def upload_document():
     """Carica un documento nel File Search Store (Long-Running Operation)"""
+    # Modalità streaming: il body non deve essere letto da request.files/request.form
+    if (UPLOAD_STREAMING or request.args.get('stream') == '1') and request.mimetype == 'multipart/form-data':
+        return upload_document_streaming()
+    
     temp_file_path = None
     try:
         # Verifica presenza file
@@ -491,136 +1150,318 @@ def upload_document():
         if file.filename == '':
             return jsonify({'success': False, 'error': 'Nome file vuoto'}), 400
         
-        # Recupera metadati opzionali
-        display_name = request.form.get('displayName', file.filename)
-        mime_type = request.form.get('mimeType', '')
-        chunk_size = int(request.form.get('chunkSize', DEFAULT_CHUNK_SIZE))  # Default dal .env
-        
-        # VALIDAZIONE CHUNK SIZE (limite API Google: 1-512)
-        if chunk_size < 1 or chunk_size > 512:
-            return jsonify({'success': False, 'error': f'Chunk size deve essere tra 1 e 512 (ricevuto: {chunk_size})'}), 400
-        
-        # Inferisci MIME type se non fornito
-        if not mime_type:
-            mime_type = mimetypes.guess_type(file.filename)[0] or 'application/octet-stream'
-        
-        # VALIDAZIONE MIME TYPE
-        is_valid, error = validate_mime_type(mime_type, file.filename)
-        if not is_valid:
+        metadata, error = build_upload_metadata(request.form, file.filename)
+        if error:
             return jsonify({'success': False, 'error': error}), 400
         
-        # Metadati custom (opzionale)
-        custom_metadata = {}
-        metadata_keys = request.form.getlist('metadataKeys[]')
-        metadata_values = request.form.getlist('metadataValues[]')
-        
-        logger.info(f"Metadati ricevuti - Keys: {metadata_keys}, Values: {metadata_values}")
-        
-        # VALIDAZIONE METADATI
-        if metadata_keys or metadata_values:
-            is_valid, error = validate_metadata(metadata_keys, metadata_values)
-            if not is_valid:
-                logger.error(f"Validazione metadati fallita: {error}")
-                return jsonify({'success': False, 'error': error}), 400
-        
-        # Filtra e aggiungi solo metadati non vuoti
-        for key, value in zip(metadata_keys, metadata_values):
-            if key and key.strip() and value and value.strip():
-                custom_metadata[key.strip()] = value.strip()
-        
-        logger.info(f"Metadati custom validati: {custom_metadata}")
-        
         # SALVA FILE TEMPORANEAMENTE SU DISCO (non in memoria)
         temp_file_path = os.path.join(app.config['UPLOAD_FOLDER'], f"upload_{int(time.time())}_{secure_filename(file.filename)}")
         file.save(temp_file_path)
         logger.info(f"File salvato temporaneamente: {temp_file_path}")
         
-        # URL per upload
-        url = f"{UPLOAD_BASE_URL}/{FILE_SEARCH_STORE_NAME}:uploadToFileSearchStore"
+        return upload_response(upload_file_to_store(temp_file_path, file.filename, metadata))
         
-        headers = get_headers()
+    except requests.exceptions.RequestException as e:
+        return upload_request_error(e)
+    except Exception as e:
+        logger.error(f"Errore imprevisto durante upload: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        # PULIZIA FILE TEMPORANEO (anche se ci sono stati errori)
+        if temp_file_path and os.path.exists(temp_file_path):
+            try:
+                os.remove(temp_file_path)
+                logger.info(f"File temporaneo eliminato: {temp_file_path}")
+            except Exception as cleanup_error:
+                logger.warning(f"Errore nella pulizia del file temporaneo: {cleanup_error}")
+
+def iter_multipart_events(stream, boundary: bytes):
+    """
+    Decodifica incrementale di un body multipart letto a blocchi da uno stream.
+    Genera gli eventi di werkzeug (Field, File, Data, Epilogue) senza mai
+    tenere in memoria più di un blocco di UPLOAD_STREAM_CHUNK_SIZE byte.
+    """
+    decoder = MultipartDecoder(boundary)
+    while True:
+        event = decoder.next_event()
+        if isinstance(event, NeedData):
+            if decoder.complete:
+                raise ValueError('Body multipart incompleto')
+            decoder.receive_data(stream.read(UPLOAD_STREAM_CHUNK_SIZE) or None)
+            continue
+        yield event
+        if isinstance(event, Epilogue):
+            return
+
+def upload_document_streaming():
+    """
+    Upload in streaming: il body multipart in arrivo viene inoltrato a
+    uploadToFileSearchStore man mano che viene letto (chunked transfer),
+    senza file temporaneo. I campi del form devono precedere il file.
+    """
+    try:
+        boundary = request.mimetype_params.get('boundary', '')
+        if not boundary:
+            return jsonify({'success': False, 'error': 'Boundary multipart mancante'}), 400
+        
+        events = iter_multipart_events(request.stream, boundary.encode('latin-1'))
+        
+        # Leggi i campi del form fino all'inizio della parte 'file'
+        fields = MultiDict()
+        file_event = None
+        current_field = None
+        field_data = bytearray()
+        for event in events:
+            if isinstance(event, Field):
+                current_field = event.name
+                field_data.clear()
+            elif isinstance(event, File):
+                if event.name == 'file':
+                    file_event = event
+                    break
+                current_field = None  # Altre parti file: ignorate
+            elif isinstance(event, Data) and current_field is not None:
+                field_data.extend(event.data)
+                if not event.more_data:
+                    fields.add(current_field, field_data.decode('utf-8'))
+                    current_field = None
+        
+        if file_event is None:
+            return jsonify({'success': False, 'error': 'Nessun file fornito'}), 400
+        if not file_event.filename:
+            return jsonify({'success': False, 'error': 'Nome file vuoto'}), 400
         
-        # Prepara i metadati del documento come JSON
-        metadata = {
-            'displayName': display_name.strip()[:100],  # Max 100 caratteri e senza spazi extra
-            'mimeType': mime_type
-        }
+        metadata, error = build_upload_metadata(fields, file_event.filename)
+        if error:
+            return jsonify({'success': False, 'error': error}), 400
         
-        if custom_metadata:
-            metadata['customMetadata'] = [
-                {'key': k, 'stringValue': v} for k, v in custom_metadata.items()
-            ]
+        upstream_boundary = uuid.uuid4().hex
+        filename = secure_filename(file_event.filename)
+        head = (
+            f"--{upstream_boundary}\r\n"
+            'Content-Disposition: form-data; name="metadata"\r\n'
+            "Content-Type: application/json\r\n\r\n"
+            f"{json.dumps(metadata)}\r\n"
+            f"--{upstream_boundary}\r\n"
+            f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            f"Content-Type: {metadata['mimeType']}\r\n\r\n"
+        ).encode('utf-8')
+        
+        transferred = {'bytes': 0}
+        # Copia (limitata) del contenuto dei file testuali per l'indice lessicale
+        index_text = bytearray() if is_text_mime_type(metadata['mimeType']) else None
+        
+        def body():
+            """Body multipart verso Google generato durante la lettura della richiesta"""
+            yield head
+            for event in events:
+                if not isinstance(event, Data):
+                    break
+                if event.data:
+                    transferred['bytes'] += len(event.data)
+                    if index_text is not None and len(index_text) < LEXICAL_MAX_UPLOAD_BYTES:
+                        index_text.extend(event.data[:LEXICAL_MAX_UPLOAD_BYTES - len(index_text)])
+                    yield event.data
+                if not event.more_data:
+                    break
+            yield f"\r\n--{upstream_boundary}--\r\n".encode('utf-8')
+            
+            # Consuma il resto della richiesta: i campi dopo il file non possono più essere usati
+            ignored = [event.name for event in events if isinstance(event, Field)]
+            if ignored:
+                logger.warning(f"Upload streaming: campi ricevuti dopo il file ignorati: {ignored}")
         
-        # CONFIGURAZIONE CHUNKING per divisione ottimale del documento
-        # La configurazione segue la struttura corretta dell'API Google
-        chunk_overlap = min(int(chunk_size * CHUNK_OVERLAP_PERCENT / 100), 100)  # Overlap dal .env, max 100
+        url = f"{UPLOAD_BASE_URL}/{FILE_SEARCH_STORE_NAME}:uploadToFileSearchStore"
+        headers = get_headers()
+        headers['Content-Type'] = f'multipart/form-data; boundary={upstream_boundary}'
         
-        metadata['chunkingConfig'] = {
-            'whiteSpaceConfig': {
-                'maxTokensPerChunk': chunk_size,      # Dimensione massima chunk in token
-                'maxOverlapTokens': chunk_overlap     # Token di sovrapposizione tra chunks
-            }
-        }
+        logger.info(f"Caricamento file in streaming: {file_event.filename} ({metadata['mimeType']})")
+        logger.info(f"Metadata: {json.dumps(metadata)}")
         
-        logger.info(f"Chunking config: max_tokens={chunk_size}, overlap={chunk_overlap}")
+        # Un generatore come body produce Transfer-Encoding: chunked (letto una sola volta: nessun retry)
+        response = retry_policy.send(lambda: http_session.post(url, headers=headers, data=body()), 'uploadToFileSearchStore', max_attempts=1, idempotent=False)
+        response.raise_for_status()
         
-        # Apri il file salvato e invialo (non usare stream che carica in memoria)
-        with open(temp_file_path, 'rb') as f:
-            files = {
-                'metadata': (None, json.dumps(metadata), 'application/json'),
-                'file': (secure_filename(file.filename), f, mime_type)
-            }
-            
-            logger.info(f"Caricamento file: {file.filename} ({mime_type})")
-            logger.info(f"Display name: {display_name}")
-            logger.info(f"Metadata: {json.dumps(metadata)}")
-            
-            # Effettua l'upload - restituisce un'operazione
-            response = http_session.post(url, headers=headers, files=files)
-            response.raise_for_status()
+        logger.info(f"Upload streaming completato: {transferred['bytes']} byte inoltrati")
         
         operation_data = response.json()
-        operation_name = operation_data.get('name', '')
+        if index_text and operation_data.get('name'):
+            update_local_index(lexical_index.add_texts, PENDING_PREFIX + operation_data['name'],
+                               [index_text.decode('utf-8', errors='ignore')], transferred['bytes'] <= LEXICAL_MAX_UPLOAD_BYTES)
+        return upload_response(operation_data)
         
-        logger.info(f"Upload avviato. Operation: {operation_name}")
+    except requests.exceptions.RequestException as e:
+        return upload_request_error(e)
+    except ValueError as e:
+        logger.error(f"Body multipart non valido: {str(e)}")
+        return jsonify({'success': False, 'error': f'Richiesta multipart non valida: {str(e)}'}), 400
+    except Exception as e:
+        logger.error(f"Errore imprevisto durante upload streaming: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/documents/bulk-upload', methods=['POST'])
+def bulk_upload_documents():
+    """
+    Caricamento massivo: accetta più file (files[]) e/o archivi zip/tar (archive).
+    I file vengono caricati in background da un pool di worker con concorrenza
+    limitata; l'avanzamento si legge da /api/documents/bulk-upload/<job_id>.
+    chunkSize e metadati custom del form valgono per tutti i file.
+    L'intera richiesta resta soggetta a MAX_CONTENT_LENGTH (100MB, altrimenti 413):
+    oltre quella dimensione i file vanno inviati in più richieste.
+    """
+    job_dir = None
+    try:
+        files = [f for f in request.files.getlist('files[]') + request.files.getlist('files') if f.filename]
+        archives = request.files.getlist('archive')
+        if not files and not archives:
+            return jsonify({'success': False, 'error': 'Nessun file fornito'}), 400
+        
+        # Limite sul numero di file verificato prima di scrivere qualunque cosa su disco
+        if len(files) > BULK_UPLOAD_MAX_FILES:
+            return jsonify({'success': False, 'error': f'Troppi file (max {BULK_UPLOAD_MAX_FILES})'}), 400
+        
+        job_id, job_dir = ingestion_manager.new_job_dir()
+        
+        # Salva i file della richiesta nella cartella del job (la richiesta termina prima dell'upload)
+        received = []
+        for file in files:
+            path = os.path.join(job_dir, f"{len(received):05d}_{secure_filename(file.filename) or 'file'}")
+            file.save(path)
+            received.append((path, file.filename))
+        
+        # Limiti condivisi tra tutti gli archivi del job: oltre il limite la richiesta viene rifiutata
+        extracted_bytes = 0
+        for archive in archives:
+            archive_path = os.path.join(job_dir, f"archive_{secure_filename(archive.filename) or 'upload'}")
+            archive.save(archive_path)
+            extract_dir = os.path.join(job_dir, f"extract_{len(received):05d}")
+            os.makedirs(extract_dir, exist_ok=True)
+            extracted = extract_archive(
+                archive_path, extract_dir,
+                max_files=BULK_UPLOAD_MAX_FILES - len(received),
+                max_bytes=BULK_UPLOAD_MAX_BYTES - extracted_bytes
+            )
+            extracted_bytes += sum(os.path.getsize(path) for path, _ in extracted)
+            received.extend(extracted)
+            os.remove(archive_path)
+        
+        # Validazione per file: displayName e mimeType vengono ricavati dal nome di ciascun file
+        shared_form = MultiDict([(k, v) for k, v in request.form.items(multi=True) if k not in ('displayName', 'mimeType')])
+        items = []
+        skipped = []
+        for path, filename in received:
+            metadata, error = build_upload_metadata(shared_form, filename)
+            if error:
+                skipped.append((filename, error))
+                os.remove(path)
+            else:
+                items.append((path, filename, metadata))
+        
+        status = ingestion_manager.submit(job_id, job_dir, items, skipped)
+        job_dir = None  # Da qui la cartella è gestita dal job
         
         return jsonify({
             'success': True,
-            'operation': operation_data,
-            'operationName': operation_name,
-            'message': 'Upload avviato con successo. L\'elaborazione è in corso.'
-        })
+            'job_id': job_id,
+            'job': status,
+            'message': f'Caricamento avviato: {len(items)} file in coda, {len(skipped)} scartati'
+        }), 202
         
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Errore durante upload: {str(e)}")
-        error_detail = str(e)
-        if hasattr(e, 'response') and e.response is not None:
-            try:
-                error_detail = e.response.json()
-                logger.error(f"Dettagli errore API: {error_detail}")
-            except:
-                error_detail = e.response.text
-                logger.error(f"Risposta errore API (testo): {error_detail}")
-        return jsonify({
-            'success': False,
-            'error': 'Errore durante il caricamento',
-            'details': error_detail
-        }), 500
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
-        logger.error(f"Errore imprevisto durante upload: {str(e)}")
+        logger.error(f"Errore imprevisto durante caricamento massivo: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
     finally:
-        # PULIZIA FILE TEMPORANEO (anche se ci sono stati errori)
-        if temp_file_path and os.path.exists(temp_file_path):
-            try:
-                os.remove(temp_file_path)
-                logger.info(f"File temporaneo eliminato: {temp_file_path}")
-            except Exception as cleanup_error:
-                logger.warning(f"Errore nella pulizia del file temporaneo: {cleanup_error}")
+        if job_dir:
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+@app.route('/api/documents/bulk-upload/<job_id>', methods=['GET'])
+def get_bulk_upload_status(job_id):
+    """Avanzamento aggregato di un job di caricamento massivo"""
+    if not re.fullmatch(r'[0-9a-f]{32}', job_id):
+        return jsonify({'success': False, 'error': 'Job id non valido'}), 400
+    
+    status = ingestion_manager.get_status(job_id)
+    if status is None:
+        return jsonify({'success': False, 'error': 'Job non trovato'}), 404
+    
+    return jsonify({'success': True, 'job': status})
+
+def operation_result(operation_data: dict) -> dict:
+    """Formato di risposta comune per lo stato di un'operazione"""
+    done = operation_data.get('done', False)
+    
+    result = {
+        'success': True,
+        'operation': operation_data,
+        'done': done
+    }
+    
+    if done:
+        if 'error' in operation_data:
+            result['error'] = operation_data['error']
+        else:
+            result['document'] = operation_data.get('response', {})
+    
+    return result
+
+@app.route('/api/operations/stream', methods=['GET'])
+def stream_operations():
+    """
+    Canale SSE unico per lo stato di più operazioni (?names=op1,op2 oppure ?name=op1&name=op2).
+    Invia un evento a ogni cambiamento e chiude lo stream quando tutte sono completate.
+    """
+    names = [n for n in request.args.getlist('name') if n]
+    for value in request.args.getlist('names'):
+        names.extend(n for n in value.split(',') if n)
+    if not names:
+        return jsonify({'success': False, 'error': 'Operation name mancante'}), 400
+    if len(names) > OPERATION_STREAM_MAX_NAMES:
+        return jsonify({'success': False, 'error': f'Troppe operazioni (max {OPERATION_STREAM_MAX_NAMES})'}), 400
+    
+    # Operazioni avviate da un altro worker: verificale upstream prima di registrarle
+    for name in names:
+        if operation_tracker.get(name) is not None:
+            continue
+        try:
+            operation_tracker.refresh(name)
+        except requests.exceptions.RequestException as e:
+            status = getattr(getattr(e, 'response', None), 'status_code', None)
+            logger.error(f"Operazione {name} non verificabile: {str(e)}")
+            return jsonify({
+                'success': False,
+                'error': f'Operazione non trovata: {name}' if status == 404 else 'Errore nel controllo dello stato'
+            }), 404 if status == 404 else 500
+    
+    def generate():
+        version = 0
+        # Ultimo stato inviato per ogni operazione: il tracker dimentica le operazioni
+        # concluse dopo retention_seconds, mentre lo stream può restare aperto più a lungo
+        states = {}
+        while True:
+            version, changed = operation_tracker.wait_for_changes(names, version, timeout=OPERATION_STREAM_HEARTBEAT)
+            if not changed:
+                # Commento SSE: mantiene viva la connessione attraverso proxy e load balancer
+                yield ": keepalive\n\n"
+                continue
+            states.update(changed)
+            for name, operation_data in changed.items():
+                event = operation_result(operation_data)
+                event['operationName'] = name
+                yield f"data: {json.dumps(event)}\n\n"
+            if all((states.get(name) or {}).get('done') for name in names):
+                yield f"data: {json.dumps({'done': True})}\n\n"
+                return
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream')
 
 @app.route('/api/operations/<path:operation_name>', methods=['GET'])
 def get_operation_status(operation_name):
-    """Recupera lo stato di un'operazione di upload"""
+    """
+    Recupera lo stato di un'operazione di upload dal tracker lato server.
+    Con ?wait=N (secondi) attende fino a N secondi un cambiamento di stato (long-poll).
+    """
     try:
         # Validazione
         if not operation_name or operation_name == 'undefined':
@@ -631,36 +1472,22 @@ def get_operation_status(operation_name):
             }), 400
         
         # L'operation name è già completo (es: fileSearchStores/.../upload/operations/...)
-        url = f"{BASE_URL}/{operation_name}"
-        headers = get_headers()
+        operation_data = operation_tracker.get(operation_name)
+        if operation_data is None:
+            # Prima richiesta per questa operazione in questo worker: una sola chiamata upstream
+            logger.info(f"Controllo stato operazione: {operation_name}")
+            operation_data = operation_tracker.refresh(operation_name)
         
-        logger.info(f"Controllo stato operazione: {operation_name}")
-        
-        response = http_session.get(url, headers=headers)
-        response.raise_for_status()
-        
-        operation_data = response.json()
-        done = operation_data.get('done', False)
-        
-        result = {
-            'success': True,
-            'operation': operation_data,
-            'done': done
-        }
-        
-        if done:
-            if 'error' in operation_data:
-                result['error'] = operation_data['error']
-                logger.warning(f"Operazione completata con errore: {operation_data['error']}")
-            else:
-                result['document'] = operation_data.get('response', {})
-                logger.info(f"Operazione completata con successo")
+        wait = min(float(request.args.get('wait', 0) or 0), OPERATION_LONG_POLL_MAX)
+        if wait > 0 and not operation_data.get('done'):
+            _, changed = operation_tracker.wait_for_changes([operation_name], operation_tracker.version, timeout=wait)
+            operation_data = changed.get(operation_name, operation_data)
         
-        return jsonify(result)
+        return jsonify(operation_result(operation_data))
         
     except requests.exceptions.RequestException as e:
         logger.error(f"Errore nel controllo operazione: {str(e)}")
-        error_detail = e.response.json() if hasattr(e, 'response') and e.response.content else str(e)
+        error_detail = e.response.json() if getattr(e, 'response', None) is not None and e.response.content else str(e)
         return jsonify({
             'success': False,
             'error': 'Errore nel controllo dello stato',
@@ -683,11 +1510,16 @@ def delete_document(document_name):
         
         logger.info(f"Eliminazione documento: {document_name}")
         
-        response = http_session.delete(url, headers=headers, params=params)
+        response = retry_policy.send(lambda: http_session.delete(url, headers=headers, params=params), 'deleteDocument')
         response.raise_for_status()
         
         logger.info(f"Documento eliminato con successo")
         
+        document_catalog.remove(document_name)
+        update_local_index(lexical_index.remove, document_name)
+        if chunk_mirror is not None:
+            update_local_index(chunk_mirror.remove, document_name)
+        
         return jsonify({
             'success': True,
             'message': 'Documento eliminato con successo'
@@ -738,85 +1570,55 @@ def query_documents():
         if not is_valid:
             return jsonify({'success': False, 'error': error}), 400
         
+        # Filtro opzionale sui customMetadata (solo per la ricerca su tutti i documenti)
+        metadata_filter, error = parse_metadata_filter(None if document_name else data.get('metadata_filter'))
+        if error:
+            return jsonify({'success': False, 'error': error}), 400
+        
         logger.info(f"Query ricevuta: {query_text}")
         
-        # Cache check
-        cache_key = f"{query_text}:{document_name}:{results_count}"
-        cached_result = query_cache.get(cache_key)
+        # Cache check su chiave canonica (e opzionalmente per similarità)
+        cache_key, canonical_query, cache_scope, cached_result = retrieval_cache_lookup(query_text, document_name, results_count, metadata_filter)
         if cached_result:
-            logger.info("Risultato recuperato da cache")
             return jsonify(cached_result)
         
         # Se non è specificato un documento, cerchiamo in tutti i documenti attivi
         if not document_name:
-            # Prima otteniamo la lista dei documenti attivi
-            list_url = f"{BASE_URL}/{FILE_SEARCH_STORE_NAME}/documents"
-            list_response = http_session.get(list_url, headers=get_headers())
-            list_response.raise_for_status()
-            
-            documents_data = list_response.json()
-            documents = documents_data.get('documents', [])
-            
-            # Filtra solo documenti attivi
-            active_documents = [doc for doc in documents if doc.get('state') == 'STATE_ACTIVE']
+            # Documenti attivi dal catalogo in-memory (tutte le pagine, aggiornato per TTL),
+            # ristretti dal filtro metadati prima di qualunque chiamata upstream
+            active_documents = document_catalog.get_active_documents(metadata_filter)
             
             if not active_documents:
                 return jsonify({
                     'success': False,
-                    'error': 'Nessun documento attivo trovato'
+                    'error': 'Nessun documento attivo corrisponde al filtro metadati' if metadata_filter else 'Nessun documento attivo trovato'
                 }), 404
             
-            # Calcola chunks per documento: distribuisci RESULTS_COUNT tra i documenti
-            # Con 25 chunks e 5 documenti = 5 chunks per documento
-            # Con 25 chunks e 10 documenti = 3 chunks per documento (arrotonda up)
-            chunks_per_document = max(3, (results_count + len(active_documents) - 1) // len(active_documents))
-            logger.info(f"Query su {len(active_documents)} documenti attivi, {chunks_per_document} chunks per documento")
+            # Preselezione dei documenti candidati con l'indice lessicale locale (se attiva)
+            query_targets = select_query_documents(query_text, active_documents)
+            chunks_per_document = chunks_per_document_for(results_count, len(query_targets))
+            logger.info(f"Query su {len(query_targets)}/{len(active_documents)} documenti attivi, {chunks_per_document} chunks per documento")
             
-            # Interroga tutti i documenti attivi e aggrega i risultati
-            all_chunks = []
-            for doc in active_documents:
-                doc_name = doc.get('name')
-                query_url = f"{BASE_URL}/{doc_name}:query"
-                
-                query_payload = {
-                    'query': query_text,
-                    'resultsCount': chunks_per_document
-                }
-                
-                try:
-                    query_response = http_session.post(query_url, headers=get_headers(), json=query_payload)
-                    query_response.raise_for_status()
-                    
-                    result = query_response.json()
-                    chunks = result.get('relevantChunks', [])
-                    
-                    # Aggiungi informazioni sul documento sorgente
-                    for chunk in chunks:
-                        chunk['source_document'] = doc.get('displayName', doc_name)
-                    
-                    all_chunks.extend(chunks)
-                    logger.info(f"  - {doc.get('displayName')}: {len(chunks)} chunks recuperati")
-                except Exception as e:
-                    logger.warning(f"Errore query su documento {doc_name}: {str(e)}")
-                    continue
-            
-            # Ordina per rilevanza (assumendo che abbiano un campo score)
-            all_chunks.sort(key=lambda x: x.get('chunkRelevanceScore', 0), reverse=True)
+            # Interroga i documenti in parallelo e aggrega i risultati
+            all_chunks = query_documents_parallel(query_targets, query_text, chunks_per_document)
             
-            # Limita al numero richiesto
-            all_chunks = all_chunks[:results_count]
+            # Ordina per rilevanza (re-ranking locale) e limita al numero richiesto
+            all_chunks = rank_retrieved_chunks(query_text, all_chunks, results_count)
             
-            logger.info(f"Totale chunks aggregati: {len(all_chunks)}, top score: {all_chunks[0].get('chunkRelevanceScore', 0):.2f} se disponibile")
+            top_score = rank_score(all_chunks[0]) if all_chunks else 0
+            logger.info(f"Totale chunks aggregati: {len(all_chunks)}, top score: {top_score:.2f}")
             
             result_data = {
                 'success': True,
                 'relevant_chunks': all_chunks,
                 'query': query_text,
-                'documents_searched': len(active_documents)
+                'documents_searched': len(query_targets)
             }
+            if metadata_filter is not None:
+                result_data['metadata_filter'] = data.get('metadata_filter')
             
             # Salva in cache
-            query_cache.set(cache_key, result_data)
+            retrieval_cache_store(cache_key, canonical_query, cache_scope, result_data)
             
             return jsonify(result_data)
         
@@ -829,14 +1631,18 @@ def query_documents():
                 'resultsCount': results_count
             }
             
-            query_response = http_session.post(query_url, headers=get_headers(), json=query_payload)
+            query_response = retry_policy.send(
+                lambda: http_session.post(query_url, headers=get_headers(), json=query_payload),
+                'queryDocument'
+            )
             query_response.raise_for_status()
             
             result = query_response.json()
+            remember_chunks(document_name, result.get('relevantChunks', []))
             
             return jsonify({
                 'success': True,
-                'relevant_chunks': result.get('relevantChunks', []),
+                'relevant_chunks': rank_retrieved_chunks(query_text, result.get('relevantChunks', []), results_count),
                 'query': query_text
             })
         
@@ -852,18 +1658,35 @@ def query_documents():
         logger.error(f"Errore imprevisto: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+# Parametri di generazione condivisi da /generate e /generate-stream (fanno parte della chiave di cache)
+GENERATION_CONFIG = {
+    'temperature': 0.7,
+    'topK': 40,
+    'topP': 0.95,
+    'maxOutputTokens': 8192,  # Aumentato per risposte più lunghe (era 2048)
+}
+
+def generation_cache_key(model: str, prompt: str) -> str:
+    """Impronta stabile (uguale in ogni worker) di prompt finale, modello e configurazione di generazione"""
+    fingerprint = json.dumps(
+        {'model': model, 'prompt': prompt, 'generationConfig': GENERATION_CONFIG},
+        sort_keys=True, ensure_ascii=False, separators=(',', ':')
+    )
+    return hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()
+
 @app.route('/api/chat/generate', methods=['POST'])
 def generate_response():
     """
-    Endpoint per generare una risposta usando Gemini (Generation Phase)
-    Prende i chunk rilevanti e genera una risposta coerente
+    Endpoint per generare una risposta con il provider configurato (Generation Phase)
+    Prende i chunk rilevanti e genera una risposta coerente; su 429/503 passa al provider di riserva
     """
     try:
         data = request.json
         query_text = data.get('query')
         relevant_chunks = data.get('relevant_chunks', [])
         chat_history = data.get('chat_history', [])  # Per conversazioni multi-turn
-        model = data.get('model', DEFAULT_MODEL)  # Default dal .env
+        # Modello del provider primario (con Gemini quello richiesto, default dal .env)
+        _, model = generation_target(data.get('model'))
         
         if not query_text:
             return jsonify({
@@ -876,195 +1699,173 @@ def generate_response():
         if not is_valid:
             return jsonify({'success': False, 'error': error}), 400
         
-        # CONTROLLO CIRCUIT BREAKER
-        if not gemini_circuit_breaker.call_allowed():
-            logger.warning("Circuit breaker APERTO - troppe richieste fallite a Gemini API")
-            return jsonify({
-                'success': False,
-                'error': 'Servizio temporaneamente non disponibile. Riprova tra qualche minuto.',
-                'circuit_breaker_status': 'OPEN'
-            }), 503
-        
         logger.info(f"Generazione risposta per: {query_text}")
         
-        # Filtra chunk per generazione basandoci sulla rilevanza
-        # Usa solo chunk con score alto o limita il numero
-        high_score_chunks = [
-            chunk for chunk in relevant_chunks 
-            if chunk.get('chunkRelevanceScore', 0) >= MIN_RELEVANCE_SCORE
-        ]
+        # Selezione dei chunk entro il budget di token e costruzione del prompt
+        generation = prepare_generation(
+            query_text, relevant_chunks, chat_history,
+            min_score=MIN_RELEVANCE_SCORE,
+            max_chunks=MAX_CHUNKS_FOR_GENERATION,
+            token_budget=CONTEXT_TOKEN_BUDGET,
+            max_history=MAX_CHAT_HISTORY,
+            dedup_threshold=CONTEXT_DEDUP_THRESHOLD,
+            shingle_words=CONTEXT_SHINGLE_WORDS
+        )
+        chunks_to_use = generation['chunks_to_use']
+        user_prompt = generation['prompt']
         
-        # Se non ci sono chunk con score alto, usa comunque i migliori disponibili
-        if not high_score_chunks and relevant_chunks:
-            logger.warning(f"Nessun chunk supera MIN_RELEVANCE_SCORE={MIN_RELEVANCE_SCORE}, uso i migliori {MAX_CHUNKS_FOR_GENERATION} disponibili")
-            chunks_to_use = relevant_chunks[:MAX_CHUNKS_FOR_GENERATION]
-        else:
-            # Se abbiamo troppi chunk anche dopo il filtro, prendi i top N
-            chunks_to_use = high_score_chunks[:MAX_CHUNKS_FOR_GENERATION]
-        
-        logger.info(f"Chunk recuperati: {len(relevant_chunks)}, Score >= {MIN_RELEVANCE_SCORE}: {len(high_score_chunks)}, Usati per generazione: {len(chunks_to_use)}")
-        
-        # Costruisci il contesto dai chunk rilevanti
-        context_parts = []
-        if chunks_to_use:
-            context_parts.append("CONTESTO DOCUMENTI:\n\n")
-            for i, chunk in enumerate(chunks_to_use, 1):
-                chunk_text = chunk.get('chunk', {}).get('data', {}).get('stringValue', '')
-                source = chunk.get('source_document', 'documento')
-                context_parts.append(f"[Frammento {i} da {source}]:\n{chunk_text}\n\n")
-        
-        # System instruction compatto
-        system_instruction = """Sei un assistente AI che risponde basandosi SOLO sui documenti forniti. 
-Rispondi in modo chiaro, conciso ed estrai solo le informazioni rilevanti."""
-        
-        # STRATEGIA OTTIMIZZATA: Invia solo le DOMANDE dell'utente (non le risposte)
-        # Estrai solo le domande dell'utente dalla cronologia
-        user_questions = [msg.get('text', '') for msg in chat_history if msg.get('role') == 'user']
-        
-        # Limita al numero massimo configurato
-        max_history_messages = MAX_CHAT_HISTORY * 2
-        recent_questions = user_questions[-max_history_messages:] if len(user_questions) > max_history_messages else user_questions
-        
-        # Rimuovi duplicati
-        unique_questions = []
-        seen = set()
-        for q in recent_questions:
-            if q and q not in seen:
-                unique_questions.append(q)
-                seen.add(q)
-        
-        # Costruisci un singolo prompt
-        user_prompt = system_instruction + "\n\n"
-        
-        # Aggiungi il contesto dei documenti
-        user_prompt += ''.join(context_parts)
-        
-        # Aggiungi cronologia domande precedenti (se ci sono)
-        if unique_questions:
-            user_prompt += "\n\nCONTESTO CONVERSAZIONE - Domande precedenti dell'utente:\n"
-            for i, q in enumerate(unique_questions, 1):
-                user_prompt += f"{i}. {q}\n"
-            user_prompt += "\n"
-        
-        # Aggiungi la domanda corrente
-        user_prompt += f"DOMANDA CORRENTE: {query_text}\n\nRISPOSTA:"
-        
-        # Costruisci contents con un singolo messaggio user
-        contents = [{
-            'role': 'user',
-            'parts': [{'text': user_prompt}]
-        }]
-        
-        # Chiamata all'API Gemini
-        generate_url = f"{BASE_URL}/models/{model}:generateContent"
+        logger.info(f"Chunk recuperati: {len(relevant_chunks)}, Dopo compattazione: {generation['compacted_count']}, Score >= {MIN_RELEVANCE_SCORE}: {generation['high_score_count']}, Usati per generazione: {len(chunks_to_use)} (~{generation['context_tokens']}/{CONTEXT_TOKEN_BUDGET} token di contesto)")
         
-        payload = {
-            'contents': contents,
-            'generationConfig': {
-                'temperature': 0.7,
-                'topK': 40,
-                'topP': 0.95,
-                'maxOutputTokens': 8192,  # Aumentato per risposte più lunghe (era 2048)
-            }
-        }
+        # CACHE DELLE RISPOSTE: stesso prompt, modello e configurazione -> stessa risposta
+        cache_key = generation_cache_key(model, user_prompt)
+        cached = generation_cache.get(cache_key) if GENERATION_CACHE_TTL > 0 else None
+        if cached is not None:
+            logger.info(f"Risposta servita dalla cache di generazione ({cache_key[:12]})")
+            return jsonify({
+                'success': True,
+                'response': cached['response'],
+                'query': query_text,
+                'model': model,
+                'chunks_used': len(chunks_to_use),
+                'chunks_filtered': chunks_to_use,
+                'cached': True
+            })
         
-        # Esegui la chiamata al modello con retries su 429 (rate limit)
-        max_retries = 3
-        delay = 1
-        response = None
-        for attempt in range(max_retries):
-            try:
-                response = http_session.post(generate_url, headers=get_headers(), json=payload, timeout=60)
-                response.raise_for_status()
-                
-                # REGISTRA SUCCESSO NEL CIRCUIT BREAKER
-                gemini_circuit_breaker.record_success()
-                break
-            except requests.exceptions.HTTPError as he:
-                status = he.response.status_code if he.response is not None else None
-                # Se riceviamo 429 (Too Many Requests), ritentiamo con backoff
-                if status == 429:
-                    # REGISTRA FALLIMENTO NEL CIRCUIT BREAKER
-                    gemini_circuit_breaker.record_failure()
-                    
-                    if attempt < max_retries - 1:
-                        logger.warning(f"429 from Gemini API, retry {attempt+1}/{max_retries} after {delay}s")
-                        time.sleep(delay)
-                        delay *= 2
-                        continue
-                # Non gestito qui: rilancia per essere catturato più in basso
-                raise
-        
-        if response is None:
-            raise RuntimeError('Nessuna risposta dal servizio di generazione')
-
-        result = response.json()
-        
-        # Estrai il testo della risposta
-        candidates = result.get('candidates', [])
+        # CONTROLLO CIRCUIT BREAKER (per operazione e modello): i provider con breaker aperto vengono saltati
+        candidates = generation_router.acquire('generateContent', data.get('model'))
         if not candidates:
+            logger.warning("Circuit breaker APERTO - troppe richieste fallite ai provider di generazione")
             return jsonify({
                 'success': False,
-                'error': 'Nessuna risposta generata dal modello'
-            }), 500
+                'error': 'Servizio temporaneamente non disponibile. Riprova tra qualche minuto.',
+                'circuit_breaker_status': 'OPEN'
+            }), 503
         
-        response_text = candidates[0].get('content', {}).get('parts', [{}])[0].get('text', '')
+        # Chiamata al provider (failover sul provider di riserva su 429/503 ed errori di connessione)
+        result, target = generation_router.generate(
+            'generateContent', candidates,
+            [{'role': 'user', 'content': user_prompt}],
+            max_tokens=GENERATION_CONFIG['maxOutputTokens'],
+            temperature=GENERATION_CONFIG['temperature']
+        )
         
         # Correggi problemi di encoding
-        response_text = fix_encoding_issues(response_text)
+        response_text = fix_encoding_issues(result.text)
+        
+        # Memorizza solo risposte complete (niente troncamenti o blocchi di sicurezza)
+        if GENERATION_CACHE_TTL > 0 and response_text and (result.finish_reason or 'STOP') == 'STOP':
+            generation_cache.set(generation_cache_key(target.model, user_prompt), {'response': response_text})
         
         return jsonify({
             'success': True,
             'response': response_text,
             'query': query_text,
-            'model': model,
+            'model': target.model,
+            'provider': target.provider.name,
             'chunks_used': len(chunks_to_use),
             'chunks_filtered': chunks_to_use  # Restituisce solo i chunks effettivamente usati
         })
         
-    except requests.exceptions.RequestException as e:
+    except ProviderError as e:
         logger.error(f"Errore durante generazione: {str(e)}")
-        # Se l'errore proviene dall'API esterna, proviamo ad estrarre lo status code
-        status_code = None
-        try:
-            status_code = e.response.status_code
-        except Exception:
-            status_code = None
-
-        error_detail = None
-        try:
-            error_detail = e.response.json() if hasattr(e, 'response') and e.response.content else str(e)
-        except Exception:
-            error_detail = str(e)
-
-        # Se l'API esterna ha restituito 429 (rate limit), inoltriamo 429 al client con dettagli
-        if status_code == 429:
+        # Se il servizio esterno ha restituito 429 (rate limit), inoltriamo 429 al client con dettagli
+        if e.status_code == 429:
             return jsonify({
                 'success': False,
                 'error': 'Rate limit raggiunto presso il servizio di generazione (429)',
-                'details': error_detail
+                'details': str(e)
             }), 429
 
         return jsonify({
             'success': False,
             'error': 'Errore durante la generazione della risposta',
-            'details': error_detail
+            'details': str(e)
         }), 500
     except Exception as e:
         logger.error(f"Errore imprevisto: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def stream_generation(candidates: list, user_prompt: str):
+    """
+    Generazione in streaming tramite il router dei provider (failover e hedging
+    fino al primo frammento). Genera gli eventi SSE (text, warning, done, error)
+    e memorizza nella cache di generazione le risposte complete.
+    """
+    deltas = generation_router.stream(
+        'streamGenerateContent', candidates,
+        [{'role': 'user', 'content': user_prompt}],
+        max_tokens=GENERATION_CONFIG['maxOutputTokens'],
+        temperature=GENERATION_CONFIG['temperature']
+    )
+    try:
+        logger.info(f"Streaming, prompt di {len(user_prompt)} caratteri")
+
+        chunk_count = 0
+        event_count = 0
+        response_parts = []  # testo inviato, per la cache di generazione
+        finish_reason = None
+        # Riparazione encoding incrementale: sequenze spezzate tra due eventi vengono unite
+        repairer = EncodingRepairer()
+
+        for delta in deltas:
+            event_count += 1
+
+            # Invia un messaggio di avviso al frontend se la risposta non termina normalmente
+            if delta.finish_reason:
+                finish_reason = delta.finish_reason
+                if finish_reason != 'STOP':
+                    logger.warning(f"⚠️ Streaming terminato con finishReason: {finish_reason}")
+                    yield event_frame({'warning': f'Risposta incompleta: {finish_reason}'})
+
+            # Correggi problemi di encoding (una sequenza incompleta resta in attesa del chunk successivo)
+            text_chunk = repairer.feed(delta.text) if delta.text else ''
+            if text_chunk:
+                chunk_count += 1
+                response_parts.append(text_chunk)
+                yield text_frame(text_chunk)
+
+        tail = repairer.flush()
+        if tail:
+            chunk_count += 1
+            response_parts.append(tail)
+            yield text_frame(tail)
+
+        target = deltas.target
+        logger.info(f"Streaming completato da {target.provider.name}/{target.model}: {event_count} eventi ricevuti, {chunk_count} chunks testo inviati, finishReason: {finish_reason}")
+        # Memorizza solo risposte complete (con la chiave del modello che ha risposto)
+        if GENERATION_CACHE_TTL > 0 and response_parts and finish_reason == 'STOP':
+            generation_cache.set(generation_cache_key(target.model, user_prompt), {'response': ''.join(response_parts)})
+        # Segnala fine dello streaming
+        yield DONE_FRAME
+
+    except NoProviderAvailable as e:
+        logger.warning(str(e))
+        yield event_frame({'error': 'Servizio temporaneamente non disponibile. Riprova tra qualche minuto.', 'circuit_breaker_status': 'OPEN'})
+    except ProviderError as pe:
+        # Il router ha già registrato il fallimento nel circuit breaker
+        logger.error(f"Errore streaming: {str(pe)}")
+        yield event_frame({'error': 'Errore durante la generazione'})
+    except Exception as e:
+        logger.error(f"Errore streaming: {str(e)}")
+        yield event_frame({'error': str(e)})
+
+def replay_generation(cached: dict):
+    """Riproduce come eventi SSE una risposta presa dalla cache di generazione"""
+    yield text_frame(cached['response'])
+    yield event_frame({'done': True, 'cached': True})
+
 @app.route('/api/chat/generate-stream', methods=['POST'])
 def generate_response_stream():
     """
-    Endpoint per generare una risposta in streaming usando Gemini
+    Endpoint per generare una risposta in streaming con il provider configurato (GENERATION_PROVIDER)
     Invia i chunk di testo man mano che vengono generati (SSE)
     """
     data = request.json
     query_text = data.get('query')
     relevant_chunks = data.get('relevant_chunks', [])
     chat_history = data.get('chat_history', [])
-    model = data.get('model', DEFAULT_MODEL)  # Default dal .env
+    # Con Gemini il modello richiesto dal client (default dal .env), altrimenti GENERATION_MODEL
+    _, model = generation_target(data.get('model'))
     
     # Validazione input
     if not query_text:
@@ -1074,8 +1875,31 @@ def generate_response_stream():
     if not is_valid:
         return jsonify({'success': False, 'error': error}), 400
     
-    # Controllo circuit breaker
-    if not gemini_circuit_breaker.call_allowed():
+    # Selezione dei chunk entro il budget di token e costruzione del prompt
+    generation = prepare_generation(
+        query_text, relevant_chunks, chat_history,
+        min_score=MIN_RELEVANCE_SCORE,
+        max_chunks=MAX_CHUNKS_FOR_GENERATION,
+        token_budget=CONTEXT_TOKEN_BUDGET,
+        max_history=MAX_CHAT_HISTORY,
+        dedup_threshold=CONTEXT_DEDUP_THRESHOLD,
+        shingle_words=CONTEXT_SHINGLE_WORDS
+    )
+    chunks_to_use = generation['chunks_to_use']
+    user_prompt = generation['prompt']
+    
+    logger.info(f"Streaming - Chunk recuperati: {len(relevant_chunks)}, Dopo compattazione: {generation['compacted_count']}, Score >= {MIN_RELEVANCE_SCORE}: {generation['high_score_count']}, Usati: {len(chunks_to_use)}")
+    
+    # Cache delle risposte: una risposta già generata viene riprodotta come eventi SSE
+    cache_key = generation_cache_key(model, user_prompt)
+    cached = generation_cache.get(cache_key) if GENERATION_CACHE_TTL > 0 else None
+    if cached is not None:
+        logger.info(f"Streaming - risposta servita dalla cache di generazione ({cache_key[:12]})")
+        return Response(replay_generation(cached), mimetype='text/event-stream')
+    
+    # Controllo circuit breaker (per operazione e modello): i provider con breaker aperto vengono saltati
+    candidates = generation_router.acquire('streamGenerateContent', data.get('model'))
+    if not candidates:
         return jsonify({
             'success': False,
             'error': 'Servizio temporaneamente non disponibile. Riprova tra qualche minuto.',
@@ -1084,202 +1908,120 @@ def generate_response_stream():
     
     def generate():
         """Generatore per lo streaming SSE"""
+        logger.info(f"User prompt totale: {len(user_prompt)} caratteri, ~{generation['prompt_tokens']} token (contesto: ~{generation['context_tokens']}/{CONTEXT_TOKEN_BUDGET}, domande: {len(generation['questions'])})")
+        
+        yield from stream_generation(candidates, user_prompt)
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+
+@app.route('/api/chat/ask', methods=['POST'])
+def ask_stream():
+    """
+    Endpoint unico retrieval + generazione in streaming (SSE)
+    Interroga i documenti attivi e avvia la generazione appena sono arrivati
+    abbastanza chunk rilevanti, senza far passare i chunk dal client.
+    Eventi: retrieval (metadati e fonti usate), text, warning, done, error
+    """
+    # Rate limiting (una chiamata /ask sostituisce /query + /generate-stream)
+    client_ip = request.remote_addr
+    if not rate_limiter.is_allowed(client_ip):
+        return jsonify({
+            'success': False,
+            'error': 'Troppe richieste. Riprova tra un minuto.'
+        }), 429
+    
+    data = request.json or {}
+    query_text = data.get('query')
+    document_name = data.get('document_name')  # Opzionale: nome specifico del documento
+    results_count = data.get('results_count', RESULTS_COUNT)
+    chat_history = data.get('chat_history', [])
+    _, model = generation_target(data.get('model'))
+    
+    if not query_text:
+        return jsonify({'success': False, 'error': 'Query text è obbligatorio'}), 400
+    
+    is_valid, error = validate_query_text(query_text)
+    if not is_valid:
+        return jsonify({'success': False, 'error': error}), 400
+    
+    metadata_filter, error = parse_metadata_filter(None if document_name else data.get('metadata_filter'))
+    if error:
+        return jsonify({'success': False, 'error': error}), 400
+    
+    logger.info(f"Ask ricevuta: {query_text}")
+    
+    def generate():
         try:
-            # Filtra chunk per generazione basandoci sulla rilevanza
-            high_score_chunks = [
-                chunk for chunk in relevant_chunks 
-                if chunk.get('chunkRelevanceScore', 0) >= MIN_RELEVANCE_SCORE
-            ]
-            
-            # Se non ci sono chunk con score alto, usa comunque i migliori disponibili
-            if not high_score_chunks and relevant_chunks:
-                logger.warning(f"Streaming - Nessun chunk supera MIN_RELEVANCE_SCORE={MIN_RELEVANCE_SCORE}, uso i migliori {MAX_CHUNKS_FOR_GENERATION} disponibili")
-                chunks_to_use = relevant_chunks[:MAX_CHUNKS_FOR_GENERATION]
+            # RETRIEVAL: cache oppure fan-out con avvio anticipato della generazione
+            cache_key, canonical_query, cache_scope, cached_result = retrieval_cache_lookup(query_text, document_name, results_count, metadata_filter)
+            early_start = False
+            if cached_result:
+                relevant_chunks = cached_result.get('relevant_chunks', [])
+                documents_searched = cached_result.get('documents_searched', 1)
             else:
-                chunks_to_use = high_score_chunks[:MAX_CHUNKS_FOR_GENERATION]
-            
-            logger.info(f"Streaming - Chunk recuperati: {len(relevant_chunks)}, Score >= {MIN_RELEVANCE_SCORE}: {len(high_score_chunks)}, Usati: {len(chunks_to_use)}")
-            
-            # Debug: mostra la struttura del primo chunk
-            if chunks_to_use:
-                logger.info(f"Esempio chunk per streaming: {json.dumps(chunks_to_use[0], indent=2)[:500]}")
-            
-            # Costruisci il contesto
-            context_parts = []
-            if chunks_to_use:
-                context_parts.append("CONTESTO DOCUMENTI:\n\n")
-                for i, chunk in enumerate(chunks_to_use, 1):
-                    # Supporta entrambi i formati: nidificato e piatto
-                    chunk_text = chunk.get('chunk', {}).get('data', {}).get('stringValue', '') or chunk.get('stringValue', '')
-                    source = chunk.get('source_document', 'documento')
-                    if chunk_text:
-                        context_parts.append(f"[Frammento {i} da {source}]:\n{chunk_text}\n\n")
-                        logger.debug(f"Chunk {i}: {len(chunk_text)} caratteri")
-            
-            logger.info(f"Contesto costruito: {len(context_parts)} parti, totale {sum(len(p) for p in context_parts)} caratteri")
-            
-            # System instruction compatto
-            system_instruction = """Sei un assistente AI che risponde basandosi SOLO sui documenti forniti. 
-Rispondi in modo chiaro, conciso ed estrai solo le informazioni rilevanti."""
-            
-            # STRATEGIA OTTIMIZZATA: Invia solo le DOMANDE dell'utente (non le risposte)
-            # Questo riduce drasticamente i token usati mantenendo il contesto della conversazione
-            
-            # Estrai solo le domande dell'utente dalla cronologia (ignora le risposte dell'assistant)
-            user_questions = [msg.get('text', '') for msg in chat_history if msg.get('role') == 'user']
-            
-            # Limita al numero massimo configurato
-            max_history_messages = MAX_CHAT_HISTORY * 2  # Moltiplica per 2 perché contiamo solo user
-            recent_questions = user_questions[-max_history_messages:] if len(user_questions) > max_history_messages else user_questions
-            
-            # Rimuovi duplicati (a volte il frontend invia la stessa domanda 2 volte)
-            unique_questions = []
-            seen = set()
-            for q in recent_questions:
-                if q and q not in seen:
-                    unique_questions.append(q)
-                    seen.add(q)
-            
-            logger.info(f"Chat history: {len(user_questions)} domande utente totali, usando le ultime {len(unique_questions)} uniche")
-            
-            # Costruisci un singolo prompt con: system instruction + contesto + domande precedenti + domanda corrente
-            user_prompt = system_instruction + "\n\n"
-            
-            # Aggiungi il contesto dei documenti
-            user_prompt += ''.join(context_parts)
-            
-            # Aggiungi cronologia domande precedenti (se ci sono)
-            if unique_questions:
-                user_prompt += "\n\nCONTESTO CONVERSAZIONE - Domande precedenti dell'utente:\n"
-                for i, q in enumerate(unique_questions, 1):
-                    user_prompt += f"{i}. {q}\n"
-                user_prompt += "\n"
-            
-            # Aggiungi la domanda corrente
-            user_prompt += f"DOMANDA CORRENTE: {query_text}\n\nRISPOSTA:"
-            
-            logger.info(f"User prompt totale: {len(user_prompt)} caratteri (contesto: {sum(len(p) for p in context_parts)}, domande: {len(unique_questions)})")
-            
-            # Costruisci contents con un singolo messaggio user
-            contents = [{
-                'role': 'user',
-                'parts': [{'text': user_prompt}]
-            }]
-            
-            # Chiamata streaming all'API Gemini
-            # IMPORTANTE: Aggiungi alt=sse per ricevere Server-Sent Events
-            stream_url = f"{BASE_URL}/models/{model}:streamGenerateContent?alt=sse"
-            payload = {
-                'contents': contents,
-                'generationConfig': {
-                    'temperature': 0.7,
-                    'topK': 40,
-                    'topP': 0.95,
-                    'maxOutputTokens': 8192,  # Aumentato per risposte più lunghe (era 2048)
-                }
-            }
-            
-            # Stream con requests - con retry su 503
-            logger.info(f"Chiamata API streaming a {stream_url}")
-            logger.info(f"Payload prompt length: {len(user_prompt)} caratteri")
-            
-            max_retries = 3
-            delay = 2
-            response = None
-            
-            for attempt in range(max_retries):
-                try:
-                    response = http_session.post(stream_url, headers=get_headers(), json=payload, stream=True, timeout=60)
-                    logger.info(f"Risposta API status: {response.status_code} (attempt {attempt+1})")
-                    
-                    # Se riceviamo 503 o 429, ritentiamo
-                    if response.status_code in [503, 429]:
-                        if attempt < max_retries - 1:
-                            logger.warning(f"{response.status_code} from Gemini API, retry {attempt+1}/{max_retries} after {delay}s")
-                            response.close()
-                            time.sleep(delay)
-                            delay *= 2
-                            continue
-                    
-                    response.raise_for_status()
-                    gemini_circuit_breaker.record_success()
-                    break
-                except requests.exceptions.RequestException as e:
-                    if attempt < max_retries - 1:
-                        logger.warning(f"Request error, retry {attempt+1}/{max_retries} after {delay}s: {str(e)}")
-                        time.sleep(delay)
-                        delay *= 2
-                        continue
-                    raise
-            
-            if response is None:
-                raise RuntimeError('Nessuna risposta dal servizio dopo tutti i retry')
+                if document_name:
+                    documents = [document_catalog.get_document(document_name) or {'name': document_name}]
+                    chunks_per_document = results_count
+                else:
+                    documents = document_catalog.get_active_documents(metadata_filter)
+                    if not documents:
+                        yield event_frame({'error': 'Nessun documento attivo corrisponde al filtro metadati' if metadata_filter else 'Nessun documento attivo trovato'})
+                        return
+                    documents = select_query_documents(query_text, documents)
+                    chunks_per_document = chunks_per_document_for(results_count, len(documents))
+                documents_searched = len(documents)
+                
+                relevant_chunks = []
+                high_score_count = 0
+                answered = 0
+                for _, chunks in iter_documents_parallel(documents, query_text, chunks_per_document):
+                    answered += 1
+                    relevant_chunks.extend(chunks)
+                    high_score_count += sum(1 for c in chunks if c.get('chunkRelevanceScore', 0) >= MIN_RELEVANCE_SCORE)
+                    if 0 < ASK_EARLY_START_CHUNKS <= high_score_count and answered < len(documents):
+                        # Abbastanza contesto: i documenti ancora in attesa vengono scartati
+                        early_start = True
+                        break
+                
+                relevant_chunks = rank_retrieved_chunks(query_text, relevant_chunks, results_count)
+                logger.info(f"Ask - {len(relevant_chunks)} chunks da {answered}/{documents_searched} documenti{' (avvio anticipato)' if early_start else ''}")
+                
+                # Solo un retrieval completo sui documenti attivi va in cache (stesso formato di /api/chat/query)
+                if not early_start and not document_name:
+                    retrieval_cache_store(cache_key, canonical_query, cache_scope, {
+                        'success': True,
+                        'relevant_chunks': relevant_chunks,
+                        'query': query_text,
+                        'documents_searched': documents_searched
+                    })
             
-            chunk_count = 0
-            raw_chunk_count = 0
+            # GENERAZIONE: stessa pipeline di /api/chat/generate-stream
+            generation = prepare_generation(
+                query_text, relevant_chunks, chat_history,
+                min_score=MIN_RELEVANCE_SCORE,
+                max_chunks=MAX_CHUNKS_FOR_GENERATION,
+                token_budget=CONTEXT_TOKEN_BUDGET,
+                max_history=MAX_CHAT_HISTORY,
+                dedup_threshold=CONTEXT_DEDUP_THRESHOLD,
+                shingle_words=CONTEXT_SHINGLE_WORDS
+            )
+            chunks_to_use = generation['chunks_to_use']
+            user_prompt = generation['prompt']
             
-            # DEBUG: Leggi il contenuto grezzo per vedere il formato
-            logger.info("Inizio lettura streaming...")
+            yield event_frame({'retrieval': {'query': query_text, 'documents_searched': documents_searched, 'chunks_retrieved': len(relevant_chunks), 'chunks_used': len(chunks_to_use), 'early_start': early_start, 'cached': bool(cached_result), 'chunks_filtered': chunks_to_use}})
             
-            # Gemini restituisce SSE format: "data: {...json...}\n"
-            for line in response.iter_lines(decode_unicode=True):
-                raw_chunk_count += 1
-                logger.debug(f"Raw line #{raw_chunk_count}: {line[:200] if line else 'EMPTY'}")
-                
-                if line and line.startswith('data: '):
-                    try:
-                        # Rimuovi il prefisso "data: " e parsa il JSON
-                        json_str = line[6:]  # Salta "data: "
-                        chunk_data = json.loads(json_str)
-                        logger.debug(f"Parsed JSON keys: {list(chunk_data.keys())}")
-                        
-                        # Estrai il testo dal chunk
-                        candidates = chunk_data.get('candidates', [])
-                        if candidates:
-                            candidate = candidates[0]
-                            logger.info(f"Candidates trovati: {len(candidates)}, keys: {list(candidate.keys())}")
-                            
-                            # Controlla se c'è un finishReason
-                            if 'finishReason' in candidate:
-                                finish_reason = candidate.get('finishReason')
-                                logger.warning(f"⚠️ Streaming terminato con finishReason: {finish_reason}")
-                                # Invia un messaggio di avviso al frontend se non è STOP normale
-                                if finish_reason != 'STOP':
-                                    yield f"data: {json.dumps({'warning': f'Risposta incompleta: {finish_reason}'})}\n\n"
-                            
-                            if 'content' in candidate:
-                                parts = candidate.get('content', {}).get('parts', [])
-                                logger.info(f"Parts trovati: {len(parts)}")
-                                if parts and 'text' in parts[0]:
-                                    text_chunk = parts[0]['text']
-                                    logger.info(f"Text chunk estratto: {repr(text_chunk[:100])}")
-                                    # Invia anche chunk vuoti/whitespace - il frontend li gestirà
-                                    if text_chunk:
-                                        # Correggi problemi di encoding
-                                        text_chunk = fix_encoding_issues(text_chunk)
-                                        chunk_count += 1
-                                        logger.info(f"✓ Inviato chunk {chunk_count}: {text_chunk[:50]}...")
-                                        # Invia il chunk come SSE
-                                        yield f"data: {json.dumps({'text': text_chunk})}\n\n"
-                                else:
-                                    logger.info(f"No text in parts: {parts}")
-                            else:
-                                logger.info(f"No content in candidate, keys: {list(candidate.keys())}")
-                    except (json.JSONDecodeError, IndexError, KeyError) as e:
-                        logger.warning(f"Errore parsing chunk streaming: {str(e)}, line: {line[:100]}")
-                        continue
+            generation_key = generation_cache_key(model, user_prompt)
+            cached = generation_cache.get(generation_key) if GENERATION_CACHE_TTL > 0 else None
+            if cached is not None:
+                logger.info(f"Ask - risposta servita dalla cache di generazione ({generation_key[:12]})")
+                yield from replay_generation(cached)
+                return
             
-            logger.info(f"Streaming completato: {raw_chunk_count} raw chunks ricevuti, {chunk_count} chunks testo inviati")
-            # Segnala fine dello streaming
-            yield f"data: {json.dumps({'done': True})}\n\n"
-                
-        except requests.exceptions.HTTPError as he:
-            if he.response and he.response.status_code == 429:
-                gemini_circuit_breaker.record_failure()
-            yield f"data: {json.dumps({'error': 'Errore durante la generazione'})}\n\n"
+            candidates = generation_router.acquire('streamGenerateContent', data.get('model'))
+            yield from stream_generation(candidates, user_prompt)
         except Exception as e:
-            logger.error(f"Errore streaming: {str(e)}")
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+            logger.error(f"Errore ask: {str(e)}")
+            yield event_frame({'error': str(e)})
     
     return Response(stream_with_context(generate()), mimetype='text/event-stream')
 
@@ -1293,12 +2035,146 @@ def chunks_page():
     """Pagina per visualizzare i chunks dei documenti"""
     return render_template('chunks.html')
 
+def get_document_info(document_name: str) -> Optional[dict]:
+    """Metadati di un documento dal catalogo; un documento non ancora in catalogo viene scaricato una volta e aggiunto"""
+    document = document_catalog.get_document(document_name)
+    if document is None:
+        response = retry_policy.send(
+            lambda: http_session.get(f"{BASE_URL}/{document_name}", headers=get_headers(), timeout=QUERY_DOCUMENT_TIMEOUT),
+            'getDocument'
+        )
+        response.raise_for_status()
+        document = response.json()
+        document_catalog.upsert(document)
+    return document
+
+def fetch_chunk_page(document_name: str, page_size: int, page_token: str = '') -> tuple:
+    """
+    Una pagina dell'elenco chunk upstream (ordine del documento)
+    Returns: (chunks nel formato del frontend, nextPageToken o '')
+    """
+    params = {'pageSize': page_size}
+    if page_token:
+        params['pageToken'] = page_token
+    response = retry_policy.send(
+        lambda: http_session.get(f"{BASE_URL}/{document_name}/chunks", headers=get_headers(), params=params, timeout=QUERY_DOCUMENT_TIMEOUT),
+        'listChunks'
+    )
+    response.raise_for_status()
+    data = response.json()
+    chunks = [{'chunk': chunk, 'source_document': document_name} for chunk in data.get('chunks', [])]
+    remember_chunks(document_name, chunks)
+    return chunks, data.get('nextPageToken', '')
+
+def local_chunk_page(document_name: str, page_size: int, page_token: str = '') -> tuple:
+    """
+    Una pagina dell'elenco chunk servita dal mirror locale (pageToken 'local:<posizione>')
+    Returns: (chunks nel formato del frontend, nextPageToken o '')
+    """
+    start = int(page_token[len(LOCAL_PAGE_PREFIX):]) if page_token else 0
+    chunks, next_start = chunk_mirror.page(document_name, start, page_size)
+    return chunks, f"{LOCAL_PAGE_PREFIX}{next_start}" if next_start is not None else ''
+
+def ndjson_line(payload: dict) -> str:
+    """Una riga NDJSON (un oggetto JSON per riga)"""
+    return json.dumps(payload, ensure_ascii=False) + '\n'
+
+@app.route('/api/documents/<path:document_name>/chunks', methods=['GET'])
+def list_document_chunks(document_name):
+    """
+    Enumerazione completa dei chunk di un documento, nell'ordine del documento,
+    seguendo la paginazione upstream (nextPageToken).
+    
+    Query params:
+    - pageSize: chunk per pagina (max 100, default CHUNK_LIST_PAGE_SIZE)
+    - pageToken: riprende dalla pagina indicata
+    - stream: 'true' per ricevere in NDJSON tutte le pagine da pageToken in poi
+      (riga 'document', una riga per chunk, riga finale 'done' o 'error' con il
+      pageToken da cui riprendere); memoria costante, una pagina alla volta
+    - refresh: 'true' per rileggere da upstream un documento già nel mirror locale
+    
+    Un documento elencato per intero in streaming viene marcato completo nel
+    mirror: le richieste successive sono servite in locale (pageToken 'local:N').
+    """
+    try:
+        page_size = max(1, min(int(request.args.get('pageSize', CHUNK_LIST_PAGE_SIZE)), 100))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'pageSize deve essere un numero intero'}), 400
+    page_token = request.args.get('pageToken', '')
+    stream = request.args.get('stream', 'false').lower() == 'true'
+    refresh = request.args.get('refresh', 'false').lower() == 'true'
+    local = chunk_mirror is not None and not refresh and (
+        page_token.startswith(LOCAL_PAGE_PREFIX) or (not page_token and chunk_mirror.is_complete(document_name))
+    )
+    fetch_page = local_chunk_page if local else fetch_chunk_page
+    source = 'local' if local else 'upstream'
+    
+    try:
+        # Prima pagina prima della risposta: gli errori upstream tornano con il loro status
+        chunks, next_page_token = fetch_page(document_name, page_size, page_token)
+        try:
+            document_info = get_document_info(document_name)
+        except requests.exceptions.RequestException as doc_error:
+            logger.warning(f"Impossibile recuperare metadati documento: {doc_error}")
+            document_info = None
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Errore durante elenco chunks: {e}")
+        status = e.response.status_code if getattr(e, 'response', None) is not None else 500
+        return jsonify({
+            'success': False,
+            'error': f'Errore nel recupero dei chunks: {str(e)}'
+        }), status if status in (400, 403, 404) else 500
+    except ValueError:
+        return jsonify({'success': False, 'error': 'pageToken non valido'}), 400
+    
+    if not stream:
+        return jsonify({
+            'success': True,
+            'chunks': chunks,
+            'nextPageToken': next_page_token,
+            'document': document_info,
+            'source': source
+        })
+    
+    def generate():
+        nonlocal chunks, next_page_token
+        yield ndjson_line({'document': document_info, 'source': source})
+        total = 0
+        resume_token = page_token
+        # Elenco completo da upstream: solo gli id (in ordine) per marcare il documento nel mirror
+        listed_ids = [] if chunk_mirror is not None and not local and not page_token else None
+        full_listing = not local and not page_token
+        while True:
+            for chunk in chunks:
+                yield ndjson_line(chunk)
+                if listed_ids is not None:
+                    listed_ids.append(chunk_id(chunk))
+            total += len(chunks)
+            if not next_page_token:
+                break
+            resume_token = next_page_token
+            try:
+                chunks, next_page_token = fetch_page(document_name, page_size, resume_token)
+            except requests.exceptions.RequestException as e:
+                logger.error(f"Elenco chunks interrotto dopo {total} chunks: {e}")
+                yield ndjson_line({'error': f'Errore nel recupero dei chunks: {str(e)}', 'totalCount': total, 'pageToken': resume_token})
+                return
+        logger.info(f"Elenco chunks completato ({source}): {total} chunks di {document_name}")
+        if listed_ids is not None:
+            update_local_index(chunk_mirror.mark_complete, document_name, listed_ids)
+        if full_listing:
+            # Tutti i chunk sono passati dall'indice lessicale: la preselezione può escludere il documento
+            update_local_index(lexical_index.mark_complete, document_name)
+        yield ndjson_line({'done': True, 'totalCount': total})
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 @app.route('/api/documents/<path:document_name>/chunks', methods=['POST'])
 def get_document_chunks(document_name):
     """
-    Recupera tutti i chunks di un documento specifico tramite query.
-    L'API Google non ha un endpoint diretto per listare chunks,
-    quindi usiamo il metodo query con una stringa generica.
+    Cerca i chunks di un documento specifico tramite query (ordinati per rilevanza).
+    Per l'elenco completo nell'ordine del documento usare GET sullo stesso
+    endpoint (list_document_chunks).
     
     Body params:
     - query: stringa di ricerca (opzionale, default: "*" per tutti i chunks)
@@ -1324,26 +2200,23 @@ def get_document_chunks(document_name):
         logger.info(f"Query chunks su documento: {document_name}")
         logger.info(f"Query: '{query_string}', Max results: {results_count}")
         
-        response = http_session.post(url, headers=headers, json=payload)
+        response = retry_policy.send(lambda: http_session.post(url, headers=headers, json=payload), 'queryDocument')
         response.raise_for_status()
         
         response_data = response.json()
         relevant_chunks = response_data.get('relevantChunks', [])
         
         logger.info(f"Recuperati {len(relevant_chunks)} chunks")
+        remember_chunks(document_name, relevant_chunks)
         
         # Debug: log della struttura del primo chunk
         if relevant_chunks:
             logger.info(f"Esempio chunk: {json.dumps(relevant_chunks[0], indent=2)}")
         
-        # Recupera informazioni del documento per includere i metadati
+        # Metadati del documento dal catalogo in-memory (nessuna GET per richiesta)
         document_info = None
         try:
-            doc_url = f"{BASE_URL}/{document_name}"
-            doc_response = http_session.get(doc_url, headers=headers)
-            doc_response.raise_for_status()
-            document_info = doc_response.json()
-            logger.info(f"Metadati documento recuperati: {document_info.get('displayName', 'N/A')}")
+            document_info = get_document_info(document_name)
         except Exception as doc_error:
             logger.warning(f"Impossibile recuperare metadati documento: {doc_error}")
         
@@ -1371,7 +2244,7 @@ def get_document_chunks(document_name):
             'chunks': formatted_chunks,
             'totalCount': len(formatted_chunks),
             'document': document_info,
-            'note': 'I chunks sono ordinati per rilevanza. Per vedere tutti i chunks, usa query generiche come "*" o "document".'
+            'note': 'I chunks sono ordinati per rilevanza. Per l\'elenco completo in ordine usa GET sullo stesso endpoint (pageToken / stream).'
         })
         
     except requests.exceptions.RequestException as e:
@@ -0,0 +1,232 @@
+"""
+Copia locale dei chunk visti dal backend (documento, id chunk, testo, metadati)
+in formato colonnare append-only sotto documents_storage.
+
+File nella cartella del mirror:
+- keys.bin   colonna "documento\\nid chunk" (UTF-8)
+- text.bin   colonna dei testi (UTF-8)
+- meta.bin   colonna dei metadati del chunk (JSON compatto)
+- index.bin  record a larghezza fissa: offset e lunghezza nelle tre colonne, flag
+
+Si scrive solo in coda e sotto lock di file (più worker gunicorn): prima le
+colonne, poi i record di indice, così ogni record completo punta a dati già
+scritti; un record troncato (crash durante la scrittura) viene ignorato in
+lettura ed eliminato dalla scrittura successiva. Ogni processo tiene in memoria
+la mappa documento -> chunk -> offset e la riallinea leggendo solo i record
+aggiunti dopo l'ultima lettura. Le colonne sono lette tramite mmap: testi e
+metadati sono memoryview sulla mappa (confronti senza copie), decodificati solo
+quando un chunk viene restituito.
+
+Un chunk già presente con testo e metadati identici non viene riscritto.
+L'eliminazione di un documento è un record tombstone (lo spazio non viene
+recuperato); un documento elencato per intero viene marcato completo, con
+l'ordine dei chunk nel documento, e da quel momento può essere servito in locale.
+
+fcntl.flock è una chiamata bloccante: con i worker gevent i metodi pubblici
+girano nel threadpool dell'hub (@blocking_io, vedi shared_state).
+"""
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: nessun lock tra processi (server di sviluppo a processo singolo)
+    fcntl = None
+
+from prompt_builder import get_chunk_text
+from shared_state import blocking_io
+
+# key_off, key_len, text_off, text_len, meta_off, meta_len, flag
+RECORD = struct.Struct('<QIQIQII')
+FLAG_CHUNK = 0
+FLAG_REMOVED = 1  # documento eliminato: i chunk precedenti non valgono più
+FLAG_COMPLETE = 2  # elenco completo del documento (meta = id dei chunk in ordine)
+
+COLUMNS = ('keys', 'text', 'meta')
+
+
+def chunk_id(chunk: dict) -> str:
+    """Nome upstream del chunk; senza nome, impronta del testo"""
+    name = chunk.get('chunk', {}).get('name')
+    return name or f"crc32:{zlib.crc32(get_chunk_text(chunk).encode('utf-8')):08x}"
+
+
+def chunk_metadata(chunk: dict) -> dict:
+    """Campi del chunk upstream oltre a nome e testo (customMetadata, state, date...)"""
+    return {key: value for key, value in chunk.get('chunk', {}).items() if key not in ('name', 'data')}
+
+
+class ChunkMirror:
+    """Mirror colonnare append-only dei chunk con indice degli offset e lettura via mmap"""
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.files = {name: open(os.path.join(directory, f'{name}.bin'), 'a+b') for name in COLUMNS + ('index',)}
+        self.maps = {}
+        self.documents = {}  # {documento: {id chunk: (text_off, text_len, meta_off, meta_len)}}
+        self.complete = {}  # {documento: [id chunk in ordine]}
+        self.index_position = 0
+        self.lock = threading.RLock()
+        with self.lock:
+            self._sync()
+
+    @contextmanager
+    def _file_lock(self):
+        if fcntl is None:
+            yield
+            return
+        fileno = self.files['index'].fileno()
+        fcntl.flock(fileno, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fileno, fcntl.LOCK_UN)
+
+    def _size(self, column: str) -> int:
+        return os.fstat(self.files[column].fileno()).st_size
+
+    def _view(self, column: str, offset: int, length: int) -> memoryview:
+        """Fetta di una colonna dalla mappa mmap (rimappata se il file è cresciuto)"""
+        if length == 0:
+            return memoryview(b'')
+        current = self.maps.get(column)
+        if current is None or len(current) < offset + length:
+            # La mappa precedente non viene chiusa: può avere memoryview ancora in uso
+            current = mmap.mmap(self.files[column].fileno(), self._size(column), access=mmap.ACCESS_READ)
+            self.maps[column] = current
+        return memoryview(current)[offset:offset + length]
+
+    def _sync(self):
+        """Applica i record di indice aggiunti dopo l'ultima lettura (anche da altri processi)"""
+        size = self._size('index')
+        size -= (size - self.index_position) % RECORD.size  # record incompleto in coda
+        if size <= self.index_position:
+            return
+        index = self.files['index']
+        index.seek(self.index_position)
+        data = index.read(size - self.index_position)
+        self.index_position = size
+
+        for key_off, key_len, text_off, text_len, meta_off, meta_len, flag in RECORD.iter_unpack(data):
+            key = bytes(self._view('keys', key_off, key_len)).decode('utf-8')
+            if flag == FLAG_CHUNK:
+                document, cid = key.split('\n', 1)
+                self.documents.setdefault(document, {})[cid] = (text_off, text_len, meta_off, meta_len)
+            elif flag == FLAG_REMOVED:
+                self.documents.pop(key, None)
+                self.complete.pop(key, None)
+            elif flag == FLAG_COMPLETE:
+                self.complete[key] = json.loads(bytes(self._view('meta', meta_off, meta_len)))
+
+    def _append(self, entries: list):
+        """Scrive in coda le colonne e poi i record di indice: entries = [(key, text, meta, flag)]"""
+        with self._file_lock():
+            # Record troncato da un crash: va tolto prima di scriverne altri
+            index_size = self._size('index')
+            if index_size % RECORD.size:
+                self.files['index'].truncate(index_size - index_size % RECORD.size)
+            self._sync()
+
+            offsets = {column: self._size(column) for column in COLUMNS}
+            buffers = {column: bytearray() for column in COLUMNS}
+            records = bytearray()
+            for key, text, meta, flag in entries:
+                record = []
+                for column, value in zip(COLUMNS, (key, text, meta)):
+                    record += [offsets[column] + len(buffers[column]), len(value)]
+                    buffers[column] += value
+                records += RECORD.pack(*record, flag)
+
+            for column in COLUMNS:
+                if buffers[column]:
+                    self.files[column].write(buffers[column])
+                    self.files[column].flush()
+            self.files['index'].write(records)
+            self.files['index'].flush()
+            self._sync()
+
+    @blocking_io
+    def append(self, document: str, chunks: list) -> int:
+        """
+        Aggiunge i chunk di un documento (formato upstream {'chunk': {...}})
+        Returns: numero di chunk nuovi o modificati scritti
+        """
+        with self.lock:
+            self._sync()
+            known = self.documents.get(document, {})
+            entries = []
+            seen = set()
+            for chunk in chunks:
+                cid = chunk_id(chunk)
+                if cid in seen:
+                    continue
+                seen.add(cid)
+                text = get_chunk_text(chunk).encode('utf-8')
+                meta = json.dumps(chunk_metadata(chunk), ensure_ascii=False, separators=(',', ':'), sort_keys=True).encode('utf-8')
+                position = known.get(cid)
+                if position is not None and self._view('text', *position[:2]) == text and self._view('meta', *position[2:]) == meta:
+                    continue
+                entries.append((f'{document}\n{cid}'.encode('utf-8'), text, meta, FLAG_CHUNK))
+            if entries:
+                self._append(entries)
+            return len(entries)
+
+    @blocking_io
+    def mark_complete(self, document: str, chunk_ids: list):
+        """Registra che il documento è stato elencato per intero, con i chunk nell'ordine del documento"""
+        with self.lock:
+            meta = json.dumps(chunk_ids, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            self._append([(document.encode('utf-8'), b'', meta, FLAG_COMPLETE)])
+
+    @blocking_io
+    def remove(self, document: str):
+        """Dimentica i chunk di un documento eliminato"""
+        with self.lock:
+            self._sync()
+            if document in self.documents or document in self.complete:
+                self._append([(document.encode('utf-8'), b'', b'', FLAG_REMOVED)])
+
+    @blocking_io
+    def is_complete(self, document: str) -> bool:
+        with self.lock:
+            self._sync()
+            return document in self.complete
+
+    @blocking_io
+    def page(self, document: str, start: int, size: int) -> tuple:
+        """
+        Chunk di un documento da start (ordine del documento se completo, altrimenti di arrivo)
+        Returns: (chunk nel formato upstream, indice della pagina successiva o None)
+        """
+        with self.lock:
+            self._sync()
+            positions = self.documents.get(document, {})
+            order = self.complete.get(document) or list(positions)
+            chunks = []
+            for cid in order[start:start + size]:
+                position = positions.get(cid)
+                if position is None:
+                    continue
+                chunk = json.loads(bytes(self._view('meta', *position[2:])) or b'{}')
+                chunk['name'] = cid
+                chunk['data'] = {'stringValue': str(self._view('text', *position[:2]), 'utf-8')}
+                chunks.append({'chunk': chunk, 'source_document': document})
+            end = start + size
+            return chunks, (end if end < len(order) else None)
+
+    @blocking_io
+    def stats(self) -> dict:
+        with self.lock:
+            self._sync()
+            return {
+                'documents': len(self.documents),
+                'complete_documents': len(self.complete),
+                'chunks': sum(len(chunks) for chunks in self.documents.values()),
+                'bytes': sum(self._size(column) for column in COLUMNS + ('index',))
+            }
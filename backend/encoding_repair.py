@@ -0,0 +1,114 @@
+"""
+Riparazione del testo UTF-8 interpretato come Windows-1252/Latin-1 (mojibake,
+es. "perchÃ©" -> "perché", "â€™" -> "’").
+
+La tabella viene generata codificando in UTF-8 e decodificando in cp1252 i
+caratteri che compaiono nei testi (lettere accentate, punteggiatura
+tipografica, simboli): niente chiavi scritte a mano, che nel sorgente si
+confondono. Tutte le sostituzioni avvengono con una sola regex compilata.
+Le varianti con lo spazio normale al posto di quello non separabile ("Ã " per
+"à") compaiono anche in testo corretto (portoghese, vietnamita, "Â" maiuscola):
+vengono applicate solo se nello stesso testo (o stream) c'è un'altra sequenza
+errata.
+Per lo streaming, EncodingRepairer trattiene la coda di un chunk che può essere
+l'inizio di una sequenza spezzata tra due eventi SSE.
+"""
+import re
+
+# Caratteri da riparare: Latin-1 (accentate, simboli) e punteggiatura tipografica di cp1252
+_TARGET_CHARS = (
+    [chr(c) for c in range(0xA0, 0x100)]
+    + list('€‚ƒ„…†‡ˆ‰Š‹ŒŽ‘’“”•–—˜™š›œžŸ')
+)
+
+
+def _mojibake_variants(char: str) -> set:
+    """Forme errate di un carattere: byte UTF-8 letti come cp1252 (o Latin-1 per i byte non definiti)"""
+    raw = char.encode('utf-8')
+    cp1252 = ''.join(
+        bytes([b]).decode('cp1252', errors='ignore') or chr(b)
+        for b in raw
+    )
+    return {cp1252, raw.decode('latin-1')}
+
+
+def _build_tables() -> tuple:
+    table = {}
+    space_table = {}
+    for char in _TARGET_CHARS:
+        for wrong in _mojibake_variants(char):
+            if wrong != char:
+                table[wrong] = char
+                # Lo spazio non separabile (secondo byte di "à") viene spesso normalizzato in spazio
+                if wrong.endswith('\xa0'):
+                    space_table[wrong[:-1] + ' '] = char
+    return table, space_table
+
+
+REPAIR_TABLE, SPACE_REPAIR_TABLE = _build_tables()
+_ALL_REPAIRS = {**REPAIR_TABLE, **SPACE_REPAIR_TABLE}
+
+
+def _compile(table: dict):
+    # Le chiavi più lunghe prima, così "â€™" non viene spezzata da una chiave più corta
+    return re.compile('|'.join(re.escape(key) for key in sorted(table, key=len, reverse=True)))
+
+
+_REPAIR_RE = _compile(REPAIR_TABLE)
+_REPAIR_ALL_RE = _compile(_ALL_REPAIRS)
+# Prefissi propri delle chiavi: una coda di chunk che ne è uno può continuare nel chunk successivo
+_PREFIXES = {key[:i] for key in _ALL_REPAIRS for i in range(1, len(key))}
+_MAX_PREFIX = max(len(key) for key in _ALL_REPAIRS) - 1
+
+
+def _repair(text: str, mojibake_seen: bool) -> tuple:
+    """Ritorna (testo riparato, True se il testo conteneva sequenze errate certe)"""
+    fixed, count = _REPAIR_RE.subn(lambda m: REPAIR_TABLE[m.group()], text)
+    if count or mojibake_seen:
+        fixed = _REPAIR_ALL_RE.sub(lambda m: _ALL_REPAIRS[m.group()], text)
+    return fixed, count > 0
+
+
+def fix_encoding_issues(text: str) -> str:
+    """Corregge il testo UTF-8 mal interpretato come cp1252/Latin-1"""
+    if not text:
+        return text
+    return _repair(text, False)[0]
+
+
+class EncodingRepairer:
+    """
+    Riparazione incrementale per i chunk di uno stream: una sequenza errata
+    spezzata tra due chunk viene riparata quando arriva la parte mancante.
+    """
+
+    def __init__(self):
+        self.pending = ''
+        self.mojibake_seen = False  # abilita le varianti con lo spazio per il resto dello stream
+
+    def feed(self, text: str) -> str:
+        """Ritorna il testo riparato pronto da inviare (può trattenere gli ultimi caratteri)"""
+        text = self.pending + text
+        hold = 0
+        for size in range(min(_MAX_PREFIX, len(text)), 0, -1):
+            if text[-size:] in _PREFIXES:
+                hold = size
+                break
+        if hold:
+            self.pending = text[-hold:]
+            text = text[:-hold]
+        else:
+            self.pending = ''
+        return self._fix(text)
+
+    def flush(self) -> str:
+        """Fine stream: ritorna i caratteri trattenuti"""
+        text, self.pending = self.pending, ''
+        return self._fix(text)
+
+    def _fix(self, text: str) -> str:
+        if not text:
+            return text
+        fixed, seen = _repair(text, self.mojibake_seen)
+        self.mojibake_seen = self.mojibake_seen or seen
+        return fixed
@@ -0,0 +1,306 @@
+"""
+Instradamento delle chiamate di generazione tra provider primario e di riserva.
+
+Il provider primario (GENERATION_PROVIDER) viene chiamato per primo; se risponde
+429/503, se la connessione fallisce o se il suo circuit breaker è aperto la
+richiesta passa al provider di riserva (GENERATION_FALLBACK_PROVIDER). Nello
+streaming il passaggio è possibile solo finché non è arrivato il primo
+frammento: da lì in poi la risposta appartiene al provider che l'ha iniziata.
+
+Con l'hedging attivo, se il primario non ha prodotto il primo frammento entro
+il percentile configurato delle sue latenze recenti, parte in parallelo anche
+la chiamata di riserva e si usa quella che risponde per prima: durante un
+rallentamento upstream la coda della latenza resta limitata.
+"""
+import logging
+import math
+import queue
+import threading
+import time
+from collections import deque, namedtuple
+from typing import Callable, Iterator, Optional
+
+from providers import ProviderError
+
+logger = logging.getLogger(__name__)
+
+# Provider e modello di un tentativo di generazione
+GenerationTarget = namedtuple('GenerationTarget', 'provider model')
+
+# Status per cui si passa al provider successivo (oltre agli errori di connessione)
+FAILOVER_STATUS_CODES = (429, 503)
+
+# Fine dello stream di un tentativo (nella coda dell'hedging)
+_END = object()
+
+
+class NoProviderAvailable(Exception):
+    """Tutti i provider di generazione hanno il circuit breaker aperto"""
+
+
+def should_failover(error: Exception) -> bool:
+    """Errore che giustifica il passaggio al provider successivo (e conta per il circuit breaker)"""
+    return isinstance(error, ProviderError) and (
+        error.status_code is None or error.status_code in FAILOVER_STATUS_CODES
+    )
+
+
+class LatencyTracker:
+    """Ultime latenze osservate (finestra scorrevole) con calcolo del percentile"""
+
+    def __init__(self, window: int = 200):
+        self.samples = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, p: float) -> Optional[float]:
+        """Percentile (nearest rank) delle latenze nella finestra, None se vuota"""
+        with self.lock:
+            values = sorted(self.samples)
+        if not values:
+            return None
+        rank = math.ceil(p / 100 * len(values))
+        return values[min(max(rank, 1), len(values)) - 1]
+
+    def __len__(self):
+        return len(self.samples)
+
+
+class GenerationRouter:
+    """
+    Sceglie il provider per ogni chiamata di generazione e gestisce failover e hedging.
+    targets_fn(requested_model) ritorna i GenerationTarget in ordine di preferenza,
+    breaker_fn(operation, model) il circuit breaker del tentativo.
+    """
+
+    def __init__(self, targets_fn: Callable[[Optional[str]], list], breaker_fn: Callable,
+                 hedge_percentile: float = 0, hedge_min_delay: float = 2.0,
+                 hedge_min_samples: int = 20, latency_window: int = 200):
+        self.targets_fn = targets_fn
+        self.breaker_fn = breaker_fn
+        self.hedge_percentile = hedge_percentile  # 0 = hedging disattivato
+        self.hedge_min_delay = hedge_min_delay  # secondi: soglia minima e soglia finché i campioni sono pochi
+        self.hedge_min_samples = hedge_min_samples
+        self.latency_window = latency_window
+        self.latencies = {}  # {operazione: LatencyTracker del primo frammento del primario}
+        self.lock = threading.Lock()
+
+    def tracker(self, operation: str) -> LatencyTracker:
+        with self.lock:
+            if operation not in self.latencies:
+                self.latencies[operation] = LatencyTracker(self.latency_window)
+            return self.latencies[operation]
+
+    def hedge_delay(self, operation: str) -> Optional[float]:
+        """Secondi dopo i quali parte la chiamata di riserva (None se l'hedging è disattivato)"""
+        if self.hedge_percentile <= 0:
+            return None
+        tracker = self.tracker(operation)
+        if len(tracker) < self.hedge_min_samples:
+            return self.hedge_min_delay
+        return max(self.hedge_min_delay, tracker.percentile(self.hedge_percentile))
+
+    def acquire(self, operation: str, requested_model: str = None) -> list:
+        """
+        Provider in ordine di preferenza, a partire dal primo con il circuit breaker chiuso
+        Returns: [(GenerationTarget, breaker)]; solo il primo ha già ottenuto il permesso
+        dal breaker, i successivi lo chiedono al momento del failover o dell'hedging
+        (una chiamata di prova in HALF_OPEN non viene consumata se non servono)
+        """
+        targets = [(target, self.breaker_fn(operation, target.model)) for target in self.targets_fn(requested_model)]
+        for index, (target, breaker) in enumerate(targets):
+            if breaker.call_allowed():
+                return targets[index:]
+            logger.warning(f"Circuit breaker aperto per {target.provider.name}/{target.model}: provider saltato")
+        return []
+
+    def stream(self, operation: str, candidates: list, messages: list, **params) -> 'RoutedStream':
+        """Frammenti della risposta dal primo provider che risponde (vedi RoutedStream)"""
+        def start(target):
+            return target.provider.stream(messages, model=target.model, **params)
+        return RoutedStream(self, operation, candidates, start)
+
+    def generate(self, operation: str, candidates: list, messages: list, **params) -> tuple:
+        """
+        Risposta completa con failover e hedging
+        Returns: (Generation, GenerationTarget del provider che ha risposto)
+        """
+        def start(target):
+            yield target.provider.generate(messages, model=target.model, **params)
+        routed = RoutedStream(self, operation, candidates, start)
+        results = list(routed)
+        if not results:
+            raise ProviderError('Nessuna risposta dal servizio di generazione')
+        return results[0], routed.target
+
+
+class RoutedStream:
+    """
+    Iterabile sui frammenti del provider vincente. Dopo il primo frammento
+    target e breaker indicano il provider che sta rispondendo.
+    """
+
+    def __init__(self, router: GenerationRouter, operation: str, candidates: list,
+                 start: Callable[[GenerationTarget], Iterator]):
+        self.router = router
+        self.operation = operation
+        self.candidates = candidates
+        self.start = start
+        self.target = None
+        self.breaker = None
+        self.hedged = False
+
+    def __iter__(self):
+        if not self.candidates:
+            raise NoProviderAvailable('Nessun provider di generazione disponibile (circuit breaker aperti)')
+        if self.router.hedge_percentile > 0 and len(self.candidates) > 1:
+            deltas = self._hedged()
+        else:
+            deltas = self._sequential()
+        try:
+            yield from deltas
+        except Exception as e:
+            # Errore dopo l'inizio della risposta: nessun failover, ma conta per il breaker
+            if self.breaker is not None and should_failover(e):
+                self.breaker.record_failure()
+            raise
+
+    def _allowed(self, index: int) -> bool:
+        """Permesso del breaker per un candidato successivo al primo (già concesso da acquire)"""
+        if index == 0:
+            return True
+        target, breaker = self.candidates[index]
+        if breaker.call_allowed():
+            return True
+        logger.warning(f"Circuit breaker aperto per {target.provider.name}/{target.model}: provider saltato")
+        return False
+
+    def _failed(self, index: int, error: Exception):
+        target, breaker = self.candidates[index]
+        if should_failover(error):
+            breaker.record_failure()
+        logger.warning(f"Generazione da {target.provider.name}/{target.model} fallita ({getattr(error, 'status_code', None)}): {str(error)}")
+
+    def _won(self, index: int, started: float):
+        target, breaker = self.candidates[index]
+        breaker.record_success()
+        if index == 0:
+            self.router.tracker(self.operation).record(time.monotonic() - started)
+        else:
+            logger.info(f"Risposta dal provider di riserva {target.provider.name}/{target.model}{' (hedging)' if self.hedged else ''}")
+        self.target, self.breaker = target, breaker
+
+    def _sequential(self):
+        """Un provider alla volta: il successivo solo se il precedente fallisce prima del primo frammento"""
+        last_error = None
+        for index, (target, _) in enumerate(self.candidates):
+            if not self._allowed(index):
+                continue
+            started = time.monotonic()
+            deltas = self.start(target)
+            try:
+                first = next(deltas, _END)
+            except Exception as e:
+                if not should_failover(e):
+                    raise
+                self._failed(index, e)
+                last_error = e
+                continue
+            self._won(index, started)
+            if first is not _END:
+                yield first
+                yield from deltas
+            return
+        raise last_error
+
+    def _pump(self, index: int, events: queue.Queue, cancel: threading.Event):
+        """Thread di un tentativo: inoltra i frammenti nella coda finché non viene annullato"""
+        try:
+            deltas = self.start(self.candidates[index][0])
+            try:
+                for delta in deltas:
+                    if cancel.is_set():
+                        return
+                    events.put((index, delta, None))
+            finally:
+                deltas.close()
+            events.put((index, _END, None))
+        except Exception as e:
+            events.put((index, None, e))
+
+    def _hedged(self):
+        """Primario subito, riserva dopo la soglia di hedging (o subito se il primario fallisce)"""
+        delay = self.router.hedge_delay(self.operation)
+        events = queue.Queue()
+        cancels = {}  # {indice del candidato: evento di annullamento}
+        starts = {}
+        failed = set()
+        pending = list(range(len(self.candidates)))  # candidati non ancora avviati
+        running = 0
+
+        def launch() -> Optional[int]:
+            """Avvia il prossimo candidato con il breaker chiuso; None se non ce ne sono"""
+            while pending:
+                index = pending.pop(0)
+                if not self._allowed(index):
+                    continue
+                cancels[index] = threading.Event()
+                starts[index] = time.monotonic()
+                threading.Thread(target=self._pump, args=(index, events, cancels[index]), daemon=True).start()
+                return index
+            return None
+
+        try:
+            launch()
+            running = 1
+            winner = None
+            first = None
+            while winner is None:
+                timeout = None
+                if len(cancels) == 1 and pending:
+                    timeout = max(0.0, starts[0] + delay - time.monotonic())
+                try:
+                    index, delta, error = events.get(timeout=timeout)
+                except queue.Empty:
+                    hedge = launch()
+                    if hedge is not None:
+                        target = self.candidates[hedge][0]
+                        logger.info(f"Hedging: nessuna risposta dal primario dopo {delay:.2f}s, avvio {target.provider.name}/{target.model}")
+                        self.hedged = True
+                        running += 1
+                    continue
+                if error is not None:
+                    running -= 1
+                    failed.add(index)
+                    self._failed(index, error)
+                    if should_failover(error) and launch() is not None:
+                        running += 1
+                    elif running == 0:
+                        raise error
+                    continue
+                winner, first = index, delta
+
+            self._won(winner, starts[winner])
+            if winner != 0 and 0 not in failed:
+                # Il primario battuto dalla riserva era lento almeno quanto il tempo trascorso:
+                # senza questo campione il percentile scenderebbe e l'hedging diventerebbe più aggressivo
+                self.router.tracker(self.operation).record(time.monotonic() - starts[0])
+            for index, cancel in cancels.items():
+                if index != winner:
+                    cancel.set()
+
+            delta = first
+            while delta is not _END:
+                yield delta
+                while True:
+                    index, delta, error = events.get()
+                    if index == winner:
+                        break
+                if error is not None:
+                    raise error
+        finally:
+            for cancel in cancels.values():
+                cancel.set()
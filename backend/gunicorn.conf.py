@@ -0,0 +1,25 @@
+"""
+Configurazione Gunicorn (gunicorn -c gunicorn.conf.py app:app)
+
+Di default usa worker gevent: socket, time.sleep e threading diventano
+cooperativi (monkey patching applicato da gunicorn prima di importare l'app),
+quindi uno stream SSE verso Gemini o un fan-out in attesa non bloccano il
+processo e ogni worker può servire centinaia di connessioni contemporanee.
+Con GUNICORN_WORKER_CLASS=sync si torna ai worker sincroni (un client per worker).
+
+Le attese sui file condivisi tra worker (lock SQLite dei backend `sqlite`,
+indice lessicale, fcntl.flock del mirror dei chunk) restano invece chiamate C
+bloccanti anche con il monkey patching: vengono eseguite nel threadpool
+dell'hub gevent (shared_state.blocking_io) per non fermare il worker intero.
+"""
+import os
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.getenv('GUNICORN_WORKERS', '4'))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+# Connessioni contemporanee per worker (solo worker asincroni)
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '1000'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+loglevel = os.getenv('GUNICORN_LOG_LEVEL', 'info')
+accesslog = os.getenv('GUNICORN_ACCESS_LOG', '-')
+errorlog = os.getenv('GUNICORN_ERROR_LOG', '-')
@@ -0,0 +1,291 @@
+"""
+Ingestion massiva di documenti: job con pool di worker, concorrenza adattiva
+e backpressure sui 429 di uploadToFileSearchStore.
+
+Lo stato di ogni job viene salvato in un file JSON (scrittura atomica) così
+che qualsiasi worker gunicorn dell'host possa rispondere alle richieste di
+avanzamento, anche se il job è eseguito da un altro processo.
+"""
+import json
+import logging
+import os
+import shutil
+import tarfile
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+import requests
+from werkzeug.utils import secure_filename
+
+from retry_policy import RetryPolicy
+
+logger = logging.getLogger(__name__)
+
+
+class ArchiveLimitError(ValueError):
+    """Archivio oltre i limiti di file o di byte estratti (messaggio mostrabile all'utente)"""
+
+
+def _copy_limited(src, dst, limit: int) -> int:
+    """Copia al massimo `limit` byte; oltre il limite solleva ArchiveLimitError (dimensioni dichiarate false)"""
+    copied = 0
+    while True:
+        block = src.read(1024 * 1024)
+        if not block:
+            return copied
+        copied += len(block)
+        if copied > limit:
+            raise ArchiveLimitError('Archivio troppo grande una volta estratto')
+        dst.write(block)
+
+
+def extract_archive(archive_path: str, target_dir: str, max_files=10000, max_bytes=1024 ** 3) -> list:
+    """
+    Estrae i file regolari di un archivio zip/tar nella cartella indicata.
+    I percorsi interni vengono appiattiti con secure_filename (niente path traversal).
+    Prima di estrarre conta tutti i file e somma le dimensioni dichiarate: oltre
+    max_files o max_bytes l'archivio viene rifiutato; il limite di byte viene
+    verificato di nuovo durante la copia (dimensioni dichiarate non affidabili).
+    Returns: lista di (percorso_locale, nome_originale)
+    Raises: ArchiveLimitError se l'archivio supera i limiti
+    """
+    extracted = []
+
+    def target_for(member_name):
+        base = secure_filename(os.path.basename(member_name)) or 'file'
+        path = os.path.join(target_dir, f"{len(extracted):05d}_{base}")
+        return path, os.path.basename(member_name)
+
+    def check_limits(sizes):
+        if len(sizes) > max_files:
+            raise ArchiveLimitError(f'Troppi file nell\'archivio (max {max_files})')
+        if sum(sizes) > max_bytes:
+            raise ArchiveLimitError(f'Archivio troppo grande una volta estratto (max {max_bytes} byte)')
+
+    remaining = max_bytes
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as archive:
+            members = [info for info in archive.infolist() if not info.is_dir()]
+            check_limits([info.file_size for info in members])
+            for info in members:
+                path, original = target_for(info.filename)
+                with archive.open(info) as src, open(path, 'wb') as dst:
+                    remaining -= _copy_limited(src, dst, remaining)
+                extracted.append((path, original))
+    elif tarfile.is_tarfile(archive_path):
+        with tarfile.open(archive_path) as archive:
+            members = [member for member in archive.getmembers() if member.isfile()]
+            check_limits([member.size for member in members])
+            for member in members:
+                path, original = target_for(member.name)
+                src = archive.extractfile(member)
+                with src, open(path, 'wb') as dst:
+                    remaining -= _copy_limited(src, dst, remaining)
+                extracted.append((path, original))
+    else:
+        raise ValueError('Formato archivio non supportato (usa zip o tar)')
+
+    return extracted
+
+
+class AdaptiveLimiter:
+    """
+    Limite di concorrenza adattivo (AIMD): dimezza su 429, cresce di uno a ogni
+    successo fino al massimo configurato. Un 429 sospende tutti i worker fino a
+    Retry-After (o al backoff calcolato).
+    """
+
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self.active = 0
+        self.paused_until = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                wait = self.paused_until - time.time()
+                if wait <= 0 and self.active < self.limit:
+                    self.active += 1
+                    return
+                self.condition.wait(timeout=wait if wait > 0 else None)
+
+    def release(self, throttled=False, pause_seconds=0.0):
+        with self.condition:
+            self.active -= 1
+            if throttled:
+                self.limit = max(1, self.limit // 2)
+                self.paused_until = max(self.paused_until, time.time() + pause_seconds)
+            elif self.limit < self.max_concurrency:
+                self.limit += 1
+            self.condition.notify_all()
+
+
+class IngestionJobManager:
+    """Gestisce i job di caricamento massivo con un pool di worker condiviso"""
+
+    def __init__(self, upload_fn: Callable[[str, str, dict], dict], jobs_dir: str,
+                 max_workers=4, max_attempts=5, retry_policy: RetryPolicy = None, on_uploaded: Callable = None,
+                 save_interval=1.0):
+        """
+        upload_fn(path, filename, metadata) -> operation_data (senza retry propri)
+        retry_policy: backoff e budget di retry condivisi con le altre chiamate upstream
+        on_uploaded(operation_data) viene chiamata dopo ogni upload riuscito
+        save_interval: secondi minimi tra due salvataggi su disco dello stato di un job
+        (lo stato finale viene sempre salvato)
+        """
+        self.upload_fn = upload_fn
+        self.jobs_dir = jobs_dir
+        self.max_attempts = max_attempts
+        self.retry_policy = retry_policy or RetryPolicy(base_delay=2.0, max_delay=60.0)
+        self.on_uploaded = on_uploaded
+        self.save_interval = save_interval
+        self.saved_at = {}  # {job_id: ultimo salvataggio su disco}
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='bulk-upload')
+        self.limiter = AdaptiveLimiter(max_workers)
+        self.jobs = {}  # {job_id: status} dei job eseguiti da questo processo
+        self.lock = threading.Lock()
+        os.makedirs(jobs_dir, exist_ok=True)
+
+    def prune(self, max_age_seconds=24 * 3600):
+        """Rimuove gli stati dei job conclusi da più di max_age_seconds"""
+        cutoff = time.time() - max_age_seconds
+        for name in os.listdir(self.jobs_dir):
+            path = os.path.join(self.jobs_dir, name)
+            if name.endswith('.json') and os.path.getmtime(path) < cutoff:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        with self.lock:
+            for job_id in [j for j, s in self.jobs.items() if s.get('finished_at', time.time()) < cutoff]:
+                del self.jobs[job_id]
+                self.saved_at.pop(job_id, None)
+
+    def new_job_dir(self) -> tuple:
+        """Crea la cartella di lavoro per un nuovo job: (job_id, percorso)"""
+        self.prune()
+        job_id = uuid.uuid4().hex
+        path = os.path.join(self.jobs_dir, job_id)
+        os.makedirs(path, exist_ok=True)
+        return job_id, path
+
+    def _status_path(self, job_id):
+        return os.path.join(self.jobs_dir, f"{job_id}.json")
+
+    def _save(self, job_id):
+        """Salva lo stato del job in modo atomico (lock già acquisito)"""
+        status = self.jobs[job_id]
+        tmp_path = self._status_path(job_id) + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(status, f, ensure_ascii=False)
+        os.replace(tmp_path, self._status_path(job_id))
+        self.saved_at[job_id] = time.monotonic()
+
+    def submit(self, job_id: str, job_dir: str, items: list, skipped: list = None) -> dict:
+        """
+        Avvia un job
+        items: lista di (percorso_locale, nome_file, metadata)
+        skipped: lista di (nome_file, motivo) già scartati in validazione
+        """
+        status = {
+            'job_id': job_id,
+            'state': 'RUNNING' if items else 'DONE',
+            'created_at': time.time(),
+            'total': len(items) + len(skipped or []),
+            'uploaded': 0,
+            'failed': 0,
+            'skipped': len(skipped or []),
+            'pending': len(items),
+            'items': [
+                {'filename': filename, 'status': 'PENDING'} for _, filename, _ in items
+            ] + [
+                {'filename': filename, 'status': 'SKIPPED', 'error': reason} for filename, reason in (skipped or [])
+            ]
+        }
+        with self.lock:
+            self.jobs[job_id] = status
+            self._save(job_id)
+
+        if not items:
+            shutil.rmtree(job_dir, ignore_errors=True)
+        for index, item in enumerate(items):
+            self.executor.submit(self._run_item, job_id, job_dir, index, *item)
+
+        logger.info(f"Job di ingestion {job_id} avviato: {len(items)} file, {len(skipped or [])} scartati")
+        return self.get_status(job_id)
+
+    def _update_item(self, job_id, index, job_dir, **changes):
+        with self.lock:
+            status = self.jobs[job_id]
+            status['items'][index].update(changes)
+            if changes.get('status') in ('UPLOADED', 'FAILED'):
+                status['pending'] -= 1
+                status['uploaded' if changes['status'] == 'UPLOADED' else 'failed'] += 1
+                if status['pending'] == 0:
+                    status['state'] = 'DONE'
+                    status['finished_at'] = time.time()
+                    shutil.rmtree(job_dir, ignore_errors=True)
+                    logger.info(f"Job di ingestion {job_id} completato: {status['uploaded']} caricati, {status['failed']} falliti")
+            # Con migliaia di file riscrivere il JSON a ogni transizione costerebbe O(N²):
+            # su disco al più un salvataggio ogni save_interval, più quello finale
+            if status['state'] == 'DONE' or time.monotonic() - self.saved_at.get(job_id, 0.0) >= self.save_interval:
+                self._save(job_id)
+
+    def _run_item(self, job_id, job_dir, index, path, filename, metadata):
+        """Carica un file con retry e backpressure sui 429"""
+        self._update_item(job_id, index, job_dir, status='UPLOADING')
+        error = None
+        pause = 0.0
+        for attempt in range(1, self.max_attempts + 1):
+            self.limiter.acquire()
+            throttled = False
+            try:
+                operation_data = self.upload_fn(path, filename, metadata)
+            except requests.exceptions.HTTPError as e:
+                response = e.response
+                if response is not None and response.status_code in (429, 503):
+                    throttled = True
+                    pause = self.retry_policy.backoff(pause, response.headers.get('Retry-After'))
+                    if attempt < self.max_attempts and not self.retry_policy.allow_retry():
+                        # Budget esaurito: il job non si ferma ma rallenta al massimo
+                        pause = max(pause, self.retry_policy.max_delay)
+                    logger.warning(f"Ingestion {filename}: {response.status_code}, pausa di {pause:.1f}s (tentativo {attempt}/{self.max_attempts})")
+                error = str(e)
+                self.limiter.release(throttled=throttled, pause_seconds=pause)
+                if not throttled:
+                    break
+            except Exception as e:
+                error = str(e)
+                self.limiter.release()
+                break
+            else:
+                self.limiter.release()
+                # Il file è già caricato: un errore qui non deve marcarlo FAILED
+                if self.on_uploaded:
+                    try:
+                        self.on_uploaded(operation_data)
+                    except Exception as e:
+                        logger.warning(f"Errore nella gestione dell'upload di {filename}: {str(e)}")
+                self._update_item(job_id, index, job_dir, status='UPLOADED',
+                                  operationName=operation_data.get('name', ''), attempts=attempt)
+                return
+
+        logger.error(f"Ingestion {filename} fallita: {error}")
+        self._update_item(job_id, index, job_dir, status='FAILED', error=error)
+
+    def get_status(self, job_id: str) -> Optional[dict]:
+        """Stato del job (anche se eseguito da un altro worker dell'host)"""
+        with self.lock:
+            if job_id in self.jobs:
+                return json.loads(json.dumps(self.jobs[job_id]))
+        try:
+            with open(self._status_path(job_id), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
@@ -0,0 +1,243 @@
+"""
+Indice lessicale locale (termine -> documenti) per preselezionare i documenti
+da interrogare prima del fan-out verso File Search.
+
+L'indice viene alimentato con il testo visto dal backend: il testo dei file
+testuali caricati (registrato sotto l'operazione di upload e assegnato al
+documento quando l'operazione termina) e i chunk restituiti dalle query e
+dall'elenco chunk. Ogni testo viene contato una sola volta per documento
+(impronta CRC32). È persistito in SQLite (WAL), quindi condiviso dai worker e
+conservato tra i riavvii.
+
+Per una query i documenti indicizzati vengono ordinati con BM25 a livello di
+documento e si interrogano solo i migliori top_k. Può essere escluso solo un
+documento completo, di cui l'indice ha visto tutto il testo (file testuale
+caricato per intero o elenco completo dei chunk); quelli mai visti o visti solo
+in parte (alcuni chunk dalle query) vengono sempre interrogati, così un indice
+parziale riduce le chiamate upstream senza mai escludere documenti rilevanti.
+"""
+import math
+import time
+import zlib
+from collections import Counter
+
+from shared_state import SQLiteStore, blocking_io
+from text_processing import normalize_text
+
+# Prefisso dei testi registrati per un'operazione di upload non ancora conclusa
+PENDING_PREFIX = 'pending:'
+# Termini presenti in più di questa quota dei documenti non servono a distinguerli
+MAX_DF_RATIO = 0.5
+
+
+def index_terms(text: str) -> list:
+    """Termini indicizzati: parole normalizzate di almeno 2 caratteri"""
+    return [term for term in normalize_text(text).split() if len(term) > 1]
+
+
+class LexicalIndex:
+    """Postings (termine, documento, frequenza) su SQLite con lunghezza di ogni documento"""
+
+    def __init__(self, path: str, k1: float = 1.2, b: float = 0.75):
+        self.store = SQLiteStore(path)
+        self.k1 = k1
+        self.b = b
+        conn = self.store.connection()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS lexical_postings (
+                term TEXT NOT NULL,
+                document TEXT NOT NULL,
+                tf INTEGER NOT NULL,
+                PRIMARY KEY (term, document)
+            ) WITHOUT ROWID
+        """)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_lexical_postings_document ON lexical_postings(document)')
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS lexical_documents (
+                document TEXT PRIMARY KEY,
+                length INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS lexical_seen (
+                document TEXT NOT NULL,
+                fingerprint INTEGER NOT NULL,
+                PRIMARY KEY (document, fingerprint)
+            ) WITHOUT ROWID
+        """)
+        conn.execute('CREATE TABLE IF NOT EXISTS lexical_complete (document TEXT PRIMARY KEY) WITHOUT ROWID')
+
+    @blocking_io
+    def add_texts(self, document: str, texts: list, complete: bool = False) -> int:
+        """
+        Aggiunge i testi di un documento (quelli già visti vengono ignorati)
+        complete: i testi sono l'intero contenuto del documento
+        Returns: numero di testi nuovi indicizzati
+        """
+        conn = self.store.connection()
+        added = 0
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            counts = Counter()
+            for text in texts:
+                terms = index_terms(text)
+                if not terms:
+                    continue
+                fingerprint = zlib.crc32(' '.join(terms).encode('utf-8'))
+                cursor = conn.execute(
+                    'INSERT OR IGNORE INTO lexical_seen (document, fingerprint) VALUES (?, ?)',
+                    (document, fingerprint)
+                )
+                if cursor.rowcount:
+                    counts.update(terms)
+                    added += 1
+            if counts:
+                conn.executemany("""
+                    INSERT INTO lexical_postings (term, document, tf) VALUES (?, ?, ?)
+                    ON CONFLICT(term, document) DO UPDATE SET tf = tf + excluded.tf
+                """, [(term, document, tf) for term, tf in counts.items()])
+                conn.execute("""
+                    INSERT INTO lexical_documents (document, length, updated_at) VALUES (?, ?, ?)
+                    ON CONFLICT(document) DO UPDATE SET length = length + excluded.length, updated_at = excluded.updated_at
+                """, (document, sum(counts.values()), time.time()))
+            if complete:
+                conn.execute('INSERT OR IGNORE INTO lexical_complete (document) VALUES (?)', (document,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return added
+
+    @blocking_io
+    def mark_complete(self, document: str):
+        """Registra che l'indice ha visto tutto il testo del documento (es. elenco completo dei chunk)"""
+        self.store.connection().execute('INSERT OR IGNORE INTO lexical_complete (document) VALUES (?)', (document,))
+
+    @blocking_io
+    def remove(self, document: str):
+        """Elimina un documento dall'indice"""
+        conn = self.store.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for table in ('lexical_postings', 'lexical_documents', 'lexical_seen', 'lexical_complete'):
+                conn.execute(f'DELETE FROM {table} WHERE document = ?', (document,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    @blocking_io
+    def rename(self, old: str, new: str):
+        """Assegna al documento definitivo i testi registrati sotto un altro nome (es. l'operazione di upload)"""
+        conn = self.store.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute("""
+                INSERT INTO lexical_postings (term, document, tf)
+                SELECT term, ?, tf FROM lexical_postings WHERE document = ?
+                ON CONFLICT(term, document) DO UPDATE SET tf = tf + excluded.tf
+            """, (new, old))
+            conn.execute("""
+                INSERT INTO lexical_documents (document, length, updated_at)
+                SELECT ?, length, ? FROM lexical_documents WHERE document = ?
+                ON CONFLICT(document) DO UPDATE SET length = length + excluded.length, updated_at = excluded.updated_at
+            """, (new, time.time(), old))
+            conn.execute('INSERT OR IGNORE INTO lexical_seen SELECT ?, fingerprint FROM lexical_seen WHERE document = ?', (new, old))
+            conn.execute('INSERT OR IGNORE INTO lexical_complete SELECT ? FROM lexical_complete WHERE document = ?', (new, old))
+            for table in ('lexical_postings', 'lexical_documents', 'lexical_seen', 'lexical_complete'):
+                conn.execute(f'DELETE FROM {table} WHERE document = ?', (old,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    @blocking_io
+    def prune_pending(self, max_age_seconds=24 * 3600):
+        """Elimina i testi di upload la cui operazione non è mai stata collegata a un documento"""
+        cutoff = time.time() - max_age_seconds
+        rows = self.store.connection().execute(
+            'SELECT document FROM lexical_documents WHERE document LIKE ? AND updated_at < ?',
+            (PENDING_PREFIX + '%', cutoff)
+        ).fetchall()
+        for (document,) in rows:
+            self.remove(document)
+
+    @blocking_io
+    def indexed_documents(self) -> set:
+        rows = self.store.connection().execute('SELECT document FROM lexical_documents').fetchall()
+        return {document for (document,) in rows if not document.startswith(PENDING_PREFIX)}
+
+    @blocking_io
+    def complete_documents(self) -> set:
+        """Documenti indicizzati per intero: gli unici che la preselezione può escludere"""
+        rows = self.store.connection().execute("""
+            SELECT c.document FROM lexical_complete c JOIN lexical_documents d ON d.document = c.document
+        """).fetchall()
+        return {document for (document,) in rows if not document.startswith(PENDING_PREFIX)}
+
+    @blocking_io
+    def scores(self, query_text: str, documents: set = None) -> dict:
+        """Score BM25 della query per i documenti indicizzati (solo quelli con almeno un termine)"""
+        terms = sorted(set(index_terms(query_text)))
+        if not terms:
+            return {}
+        conn = self.store.connection()
+        total, avg_length = conn.execute(
+            'SELECT COUNT(*), AVG(length) FROM lexical_documents WHERE document NOT LIKE ?',
+            (PENDING_PREFIX + '%',)
+        ).fetchone()
+        if not total:
+            return {}
+        placeholders = ','.join('?' * len(terms))
+        df = dict(conn.execute(
+            f'SELECT term, COUNT(*) FROM lexical_postings WHERE term IN ({placeholders}) AND document NOT LIKE ? GROUP BY term',
+            terms + [PENDING_PREFIX + '%']
+        ).fetchall())
+        # I termini troppo comuni non discriminano e hanno le liste più lunghe: si saltano
+        selective = [t for t in terms if 0 < df.get(t, 0) <= max(1, MAX_DF_RATIO * total)]
+        if not selective:
+            return {}
+
+        placeholders = ','.join('?' * len(selective))
+        rows = conn.execute(f"""
+            SELECT p.term, p.document, p.tf, d.length
+            FROM lexical_postings p JOIN lexical_documents d ON d.document = p.document
+            WHERE p.term IN ({placeholders}) AND p.document NOT LIKE ?
+        """, selective + [PENDING_PREFIX + '%']).fetchall()
+
+        avg_length = avg_length or 1.0
+        scores = {}
+        for term, document, tf, length in rows:
+            if documents is not None and document not in documents:
+                continue
+            idf = math.log1p((total - df[term] + 0.5) / (df[term] + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * length / avg_length)
+            scores[document] = scores.get(document, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        return scores
+
+    @blocking_io
+    def select_documents(self, query_text: str, documents: list, top_k: int) -> list:
+        """
+        Documenti da interrogare: i top_k completi con lo score migliore più
+        tutti quelli non indicizzati per intero (mai visti o visti solo in parte).
+        Senza segnale (nessun termine noto) ritorna tutti i documenti.
+        """
+        if top_k <= 0 or len(documents) <= top_k:
+            return documents
+        complete = self.complete_documents()
+        names = {doc.get('name') for doc in documents}
+        scores = self.scores(query_text, names & complete)
+        if not scores:
+            return documents
+        best = set(sorted(scores, key=scores.get, reverse=True)[:top_k])
+        return [doc for doc in documents if doc.get('name') in best or doc.get('name') not in complete]
+
+    @blocking_io
+    def stats(self) -> dict:
+        conn = self.store.connection()
+        documents, = conn.execute(
+            'SELECT COUNT(*) FROM lexical_documents WHERE document NOT LIKE ?', (PENDING_PREFIX + '%',)
+        ).fetchone()
+        postings, = conn.execute('SELECT COUNT(*) FROM lexical_postings').fetchone()
+        return {'documents': documents, 'postings': postings}
@@ -0,0 +1,246 @@
+"""
+Filtro sui metadati custom dei documenti per restringere il fan-out delle query.
+
+Sintassi (sottoinsieme di AIP-160, la stessa famiglia dei filtri Google):
+    cantiere = "Milano Nord" AND (anno >= 2023 OR tipo != "bozza")
+    NOT archiviato = "si"
+Operatori: = != < <= > >=, AND, OR, NOT e parentesi. I valori sono stringhe tra
+virgolette o numeri; l'uguaglianza tra stringhe ignora maiuscole e spazi ai
+bordi, i confronti d'ordine sono numerici quando entrambi i lati sono numeri.
+
+Il MetadataIndex è costruito dal catalogo documenti (customMetadata di ogni
+documento) e risponde con insiemi di nomi: l'uguaglianza è una lookup
+chiave -> valore -> documenti, i confronti d'ordine scorrono solo i valori
+distinti della chiave. Il filtro si valuta interamente in memoria, prima di
+qualunque chiamata upstream.
+"""
+import math
+import re
+import threading
+from typing import Optional
+
+# Lunghezza massima di un'espressione di filtro
+MAX_FILTER_LENGTH = 500
+
+COMPARISONS = ('=', '!=', '<', '<=', '>', '>=')
+
+_TOKEN_RE = re.compile(r"""
+    \s*(?:
+        (?P<lparen>\() | (?P<rparen>\)) |
+        (?P<op>!=|<=|>=|=|<|>) |
+        (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*') |
+        (?P<number>-?\d+(?:\.\d+)?(?![\w.])) |
+        (?P<word>[\w.\-]+)
+    )
+""", re.VERBOSE | re.UNICODE)
+
+
+class MetadataFilterError(ValueError):
+    """Espressione di filtro non valida (messaggio mostrabile all'utente)"""
+
+
+def _number(value) -> Optional[float]:
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if math.isfinite(number) else None
+
+
+def normalize_value(value) -> str:
+    """Forma canonica di un valore: i numeri come numero (2023 == 2023.0), le stringhe senza maiuscole"""
+    number = _number(value)
+    if number is not None:
+        return str(int(number)) if number.is_integer() else repr(number)
+    return str(value).strip().casefold()
+
+
+def metadata_values(document: dict) -> dict:
+    """customMetadata di un documento come {chiave: [valori normalizzati]}"""
+    values = {}
+    for entry in document.get('customMetadata', []) or []:
+        key = entry.get('key')
+        if not key:
+            continue
+        if 'stringListValue' in entry:
+            raw = (entry['stringListValue'] or {}).get('values', [])
+        elif 'numericValue' in entry:
+            raw = [entry['numericValue']]
+        else:
+            raw = [entry.get('stringValue', '')]
+        values.setdefault(key, []).extend(normalize_value(v) for v in raw)
+    return values
+
+
+def _tokenize(expression: str) -> list:
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = _TOKEN_RE.match(expression, position)
+        if not match or match.end() == position:
+            raise MetadataFilterError(f"Filtro metadati non valido vicino a: {expression[position:position + 20]!r}")
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == 'string':
+            text = re.sub(r'\\(.)', r'\1', text[1:-1])
+        elif kind == 'word' and text.upper() in ('AND', 'OR', 'NOT'):
+            kind = text.upper()
+        tokens.append((kind, text))
+        position = match.end()
+    return tokens
+
+
+class _Parser:
+    """Discesa ricorsiva: or := and (OR and)* ; and := not (AND not)* ; not := NOT not | primario"""
+
+    def __init__(self, tokens: list):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self) -> Optional[str]:
+        return self.tokens[self.position][0] if self.position < len(self.tokens) else None
+
+    def take(self, *kinds) -> tuple:
+        if self.peek() not in kinds:
+            found = self.tokens[self.position][1] if self.position < len(self.tokens) else 'fine espressione'
+            raise MetadataFilterError(f"Filtro metadati non valido: atteso {'/'.join(kinds)}, trovato {found!r}")
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def parse(self) -> tuple:
+        node = self.parse_or()
+        if self.peek() is not None:
+            raise MetadataFilterError(f"Filtro metadati non valido: testo inatteso {self.tokens[self.position][1]!r}")
+        return node
+
+    def parse_or(self) -> tuple:
+        nodes = [self.parse_and()]
+        while self.peek() == 'OR':
+            self.take('OR')
+            nodes.append(self.parse_and())
+        return nodes[0] if len(nodes) == 1 else ('or', tuple(nodes))
+
+    def parse_and(self) -> tuple:
+        nodes = [self.parse_not()]
+        while self.peek() == 'AND':
+            self.take('AND')
+            nodes.append(self.parse_not())
+        return nodes[0] if len(nodes) == 1 else ('and', tuple(nodes))
+
+    def parse_not(self) -> tuple:
+        if self.peek() == 'NOT':
+            self.take('NOT')
+            return ('not', self.parse_not())
+        if self.peek() == 'lparen':
+            self.take('lparen')
+            node = self.parse_or()
+            self.take('rparen')
+            return node
+        _, key = self.take('word', 'string')
+        _, op = self.take('op')
+        _, value = self.take('string', 'number', 'word')
+        return ('cmp', key, op, normalize_value(value))
+
+
+def parse_filter(expression: str) -> tuple:
+    """
+    Compila un'espressione di filtro in un albero di tuple
+    ('cmp', chiave, operatore, valore) / ('and'|'or', figli) / ('not', figlio)
+    Raises: MetadataFilterError se l'espressione non è valida
+    """
+    if not isinstance(expression, str) or not expression.strip():
+        raise MetadataFilterError("Filtro metadati vuoto")
+    if len(expression) > MAX_FILTER_LENGTH:
+        raise MetadataFilterError(f"Filtro metadati troppo lungo (max {MAX_FILTER_LENGTH} caratteri)")
+    return _Parser(_tokenize(expression)).parse()
+
+
+def _compare(left: str, op: str, right: str) -> bool:
+    """Confronto d'ordine: numerico se entrambi i valori sono numeri, altrimenti lessicografico"""
+    a, b = _number(left), _number(right)
+    if (a is None) != (b is None):
+        return False
+    if a is None:
+        a, b = left, right
+    return {'<': a < b, '<=': a <= b, '>': a > b, '>=': a >= b}[op]
+
+
+class MetadataIndex:
+    """Indice in-memory chiave -> valore -> nomi dei documenti, aggiornato insieme al catalogo"""
+
+    def __init__(self):
+        self.postings = {}  # {chiave: {valore: set(nomi)}}
+        self.documents = {}  # {nome: {chiave: [valori]}}
+        self.lock = threading.Lock()
+
+    def _add(self, name: str, values: dict):
+        self.documents[name] = values
+        for key, key_values in values.items():
+            for value in key_values:
+                self.postings.setdefault(key, {}).setdefault(value, set()).add(name)
+
+    def _remove(self, name: str):
+        for key, key_values in self.documents.pop(name, {}).items():
+            by_value = self.postings.get(key, {})
+            for value in key_values:
+                names = by_value.get(value)
+                if names is not None:
+                    names.discard(name)
+                    if not names:
+                        del by_value[value]
+            if not by_value:
+                self.postings.pop(key, None)
+
+    def rebuild(self, documents):
+        """Ricostruisce l'indice da tutti i documenti del catalogo"""
+        with self.lock:
+            self.postings = {}
+            self.documents = {}
+            for document in documents:
+                if document.get('name'):
+                    self._add(document['name'], metadata_values(document))
+
+    def upsert(self, document: dict):
+        with self.lock:
+            self._remove(document.get('name'))
+            self._add(document.get('name'), metadata_values(document))
+
+    def remove(self, name: str):
+        with self.lock:
+            self._remove(name)
+
+    def _matching(self, node: tuple, universe: set) -> set:
+        kind = node[0]
+        if kind == 'and':
+            result = universe
+            for child in node[1]:
+                result = result & self._matching(child, universe)
+                if not result:
+                    break
+            return result
+        if kind == 'or':
+            result = set()
+            for child in node[1]:
+                result |= self._matching(child, universe)
+            return result
+        if kind == 'not':
+            return universe - self._matching(node[1], universe)
+
+        _, key, op, value = node
+        by_value = self.postings.get(key, {})
+        if op == '=':
+            return by_value.get(value, set()) & universe
+        if op == '!=':
+            # Documenti che hanno la chiave con almeno un valore diverso
+            return {name for other, names in by_value.items() if other != value for name in names} & universe
+        return {name for other, names in by_value.items() if _compare(other, op, value) for name in names} & universe
+
+    def matching(self, node: tuple, names) -> set:
+        """Nomi (tra quelli dati) dei documenti che soddisfano il filtro compilato"""
+        with self.lock:
+            return self._matching(node, set(names))
+
+    def stats(self) -> dict:
+        return {'documents': len(self.documents), 'keys': len(self.postings)}
@@ -0,0 +1,208 @@
+"""
+Tracker lato server delle operazioni di upload (Long-Running Operation).
+
+Un unico thread in background interroga Google per le operazioni in corso con
+backoff adattivo; i client leggono lo stato dal tracker (polling, long-poll o
+SSE) senza generare nuove richieste upstream. Il traffico verso Google cresce
+quindi con il numero di operazioni aperte, non con i client collegati.
+
+Un'operazione che upstream non esiste (404), che fallisce max_failures polling
+consecutivi o che non si completa entro max_age_seconds viene abbandonata: il
+tracker la chiude con un errore (i client in attesa lo ricevono come stato
+finale) e smette di interrogarla.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class OperationTracker:
+    """Registro delle operazioni con polling upstream in background"""
+
+    def __init__(self, fetch_fn: Callable[[str], dict], on_done: Callable[[dict], None] = None,
+                 min_interval=1.0, max_interval=30.0, backoff_factor=1.5,
+                 max_workers=4, retention_seconds=600, max_failures=5, max_age_seconds=24 * 3600):
+        """
+        fetch_fn(operation_name) -> operation_data (GET upstream)
+        on_done(operation_data) viene chiamata una sola volta al completamento
+        (non per le operazioni abbandonate)
+        """
+        self.fetch_fn = fetch_fn
+        self.on_done = on_done
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff_factor = backoff_factor
+        self.retention_seconds = retention_seconds
+        self.max_failures = max_failures
+        self.max_age_seconds = max_age_seconds
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='operation-poll')
+        self.operations = {}  # {name: {'operation', 'done', 'version', 'next_poll', 'interval', 'updated_at'}}
+        self.version = 0
+        self.condition = threading.Condition()
+        self.thread = None
+        self.upstream_polls = 0
+        self.abandoned = 0
+
+    def _ensure_thread(self):
+        """Avvia il thread di polling al primo utilizzo (lock già acquisito)"""
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._run, name='operation-tracker', daemon=True)
+            self.thread.start()
+
+    def register(self, name: str, operation_data: dict = None):
+        """Inizia a tracciare un'operazione (idempotente)"""
+        with self.condition:
+            if name not in self.operations:
+                self.operations[name] = {
+                    'operation': None,
+                    'done': False,
+                    'version': 0,
+                    'next_poll': time.time() + self.min_interval,
+                    'interval': self.min_interval,
+                    'updated_at': 0.0,
+                    'registered_at': time.time(),
+                    'failures': 0
+                }
+            if operation_data:
+                self._apply(name, operation_data)
+            self._ensure_thread()
+            self.condition.notify_all()
+
+    def _apply(self, name, operation_data):
+        """Aggiorna lo stato di un'operazione (lock già acquisito); ritorna True se appena completata"""
+        entry = self.operations[name]
+        just_done = bool(operation_data.get('done')) and not entry['done']
+        if operation_data != entry['operation']:
+            self.version += 1
+            entry['version'] = self.version
+        entry['operation'] = operation_data
+        entry['done'] = bool(operation_data.get('done'))
+        entry['updated_at'] = time.time()
+        return just_done
+
+    def _record(self, name, operation_data):
+        """Salva il risultato di un polling e notifica chi è in attesa"""
+        with self.condition:
+            if name not in self.operations:
+                return
+            just_done = self._apply(name, operation_data)
+            self.operations[name]['failures'] = 0
+            self.condition.notify_all()
+        if just_done and self.on_done:
+            try:
+                self.on_done(operation_data)
+            except Exception as e:
+                logger.warning(f"Errore nella gestione del completamento di {name}: {str(e)}")
+
+    def refresh(self, name: str) -> dict:
+        """Interroga subito Google per un'operazione e aggiorna il tracker"""
+        operation_data = self.fetch_fn(name)
+        self.upstream_polls += 1
+        self.register(name)
+        self._record(name, operation_data)
+        return operation_data
+
+    def get(self, name: str) -> Optional[dict]:
+        """Ultimo stato noto dell'operazione (None se mai ricevuto)"""
+        with self.condition:
+            entry = self.operations.get(name)
+            return entry['operation'] if entry else None
+
+    def wait_for_changes(self, names: list, since_version: int, timeout: float) -> tuple:
+        """
+        Long-poll: attende che una delle operazioni cambi dopo since_version
+        Returns: (versione_corrente, {name: operation_data} cambiate)
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                changed = {
+                    name: self.operations[name]['operation']
+                    for name in names
+                    if name in self.operations
+                    and self.operations[name]['operation'] is not None
+                    and self.operations[name]['version'] > since_version
+                }
+                remaining = deadline - time.time()
+                if changed or remaining <= 0:
+                    return self.version, changed
+                self.condition.wait(timeout=remaining)
+
+    def all_done(self, names: list) -> bool:
+        with self.condition:
+            return all(self.operations.get(name, {}).get('done') for name in names)
+
+    def _abandon(self, name, message):
+        """Chiude un'operazione con un errore senza chiamare on_done (lock già acquisito)"""
+        entry = self.operations.get(name)
+        if entry is None or entry['done']:
+            return
+        logger.warning(f"Operazione {name} abbandonata: {message}")
+        self._apply(name, {'name': name, 'done': True, 'error': {'message': message}})
+        self.abandoned += 1
+        self.condition.notify_all()
+
+    def _poll(self, name):
+        try:
+            operation_data = self.fetch_fn(name)
+            self.upstream_polls += 1
+        except Exception as e:
+            logger.warning(f"Polling operazione {name} fallito: {str(e)}")
+            status = getattr(getattr(e, 'response', None), 'status_code', None)
+            with self.condition:
+                entry = self.operations.get(name)
+                if entry is None:
+                    return
+                entry['failures'] += 1
+                if status == 404:
+                    self._abandon(name, 'Operazione non trovata')
+                elif entry['failures'] >= self.max_failures:
+                    self._abandon(name, f'Stato non disponibile dopo {entry["failures"]} tentativi: {str(e)}')
+            return
+        self._record(name, operation_data)
+
+    def _run(self):
+        """Ciclo di polling: interroga in parallelo le operazioni scadute, poi dorme fino alla prossima"""
+        while True:
+            with self.condition:
+                now = time.time()
+                # Rimuovi le operazioni concluse da più di retention_seconds
+                for name in [n for n, e in self.operations.items()
+                             if e['done'] and now - e['updated_at'] > self.retention_seconds]:
+                    del self.operations[name]
+                # Le operazioni mai completate non vengono interrogate per sempre
+                for name in [n for n, e in self.operations.items()
+                             if not e['done'] and now - e['registered_at'] > self.max_age_seconds]:
+                    self._abandon(name, f'Operazione non completata entro {int(self.max_age_seconds)} secondi')
+
+                due = []
+                next_poll = now + self.max_interval
+                for name, entry in self.operations.items():
+                    if entry['done']:
+                        continue
+                    if entry['next_poll'] <= now:
+                        due.append(name)
+                        entry['interval'] = min(self.max_interval, entry['interval'] * self.backoff_factor)
+                        entry['next_poll'] = now + entry['interval']
+                    next_poll = min(next_poll, entry['next_poll'])
+
+                if not due:
+                    self.condition.wait(timeout=max(0.05, next_poll - now))
+                    continue
+
+            # Un unico giro di polling per tutte le operazioni scadute
+            list(self.executor.map(self._poll, due))
+
+    def stats(self) -> dict:
+        with self.condition:
+            pending = sum(1 for e in self.operations.values() if not e['done'])
+            return {
+                'tracked': len(self.operations),
+                'pending': pending,
+                'upstream_polls': self.upstream_polls,
+                'abandoned': self.abandoned
+            }
@@ -0,0 +1,277 @@
+"""
+Costruzione del prompt di generazione condivisa da /api/chat/generate e
+/api/chat/generate-stream.
+
+Prima della selezione i chunk recuperati vengono compattati: i testi quasi
+identici vengono scartati e i chunk adiacenti dello stesso documento (che
+condividono l'overlap del chunking) vengono fusi in un unico frammento.
+I chunk vengono poi selezionati per rilevanza e inseriti finché non si
+esaurisce un budget di token di contesto (stimato localmente), invece di
+usarne un numero fisso. Il prompt viene composto con un'unica join.
+"""
+import re
+import zlib
+from collections import Counter
+
+from text_processing import normalize_text, shingle_hashes, word_shingles
+
+SYSTEM_INSTRUCTION = """Sei un assistente AI che risponde basandosi SOLO sui documenti forniti.
+Rispondi in modo chiaro, conciso ed estrai solo le informazioni rilevanti."""
+
+_TOKEN_PIECE_RE = re.compile(r'\w+|[^\w\s]', re.UNICODE)
+_WORD_RE = re.compile(r'\S+')
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Stima locale del numero di token (approssima un tokenizer SentencePiece):
+    ogni parola o segno di punteggiatura vale un token, le parole lunghe
+    vengono spezzate in sotto-parole di circa 7 caratteri.
+    """
+    if not text:
+        return 0
+    return sum(1 + len(piece) // 7 for piece in _TOKEN_PIECE_RE.findall(text))
+
+
+def get_chunk_text(chunk: dict) -> str:
+    """Testo di un chunk: supporta sia il formato nidificato che quello piatto"""
+    return chunk.get('chunk', {}).get('data', {}).get('stringValue', '') or chunk.get('stringValue', '')
+
+
+def rank_score(chunk: dict) -> float:
+    """Score per l'ordinamento: quello del re-ranking locale se presente, altrimenti lo score upstream"""
+    score = chunk.get('rerankScore')
+    return chunk.get('chunkRelevanceScore', 0) if score is None else score
+
+
+def _with_text(chunk: dict, text: str, best: dict) -> dict:
+    """Copia di un chunk con il testo sostituito e gli score del chunk best (stesso formato dell'originale)"""
+    new_chunk = dict(chunk)
+    new_chunk['chunkRelevanceScore'] = best.get('chunkRelevanceScore', 0)
+    if 'rerankScore' in best:
+        new_chunk['rerankScore'] = best['rerankScore']
+    if 'chunk' in chunk:
+        inner = dict(chunk['chunk'])
+        inner['data'] = dict(inner.get('data', {}), stringValue=text)
+        new_chunk['chunk'] = inner
+    else:
+        new_chunk['stringValue'] = text
+    return new_chunk
+
+
+def _analyze(chunk: dict, shingle_words: int) -> dict:
+    """Parole normalizzate, offset e hash degli shingle di un chunk"""
+    text = get_chunk_text(chunk)
+    matches = list(_WORD_RE.finditer(text))
+    keys = [normalize_text(m.group()) or m.group() for m in matches]
+    return {
+        'chunk': chunk,
+        'text': text,
+        'keys': keys,
+        'starts': [m.start() for m in matches],
+        'score': rank_score(chunk),
+        'source': chunk.get('source_document', ''),
+        'hashes': shingle_hashes(word_shingles(keys, shingle_words)),
+        # Hash dell'inizio del chunk (anche saltando la prima parola, che può essere tagliata)
+        'heads': [
+            (start, zlib.crc32(' '.join(keys[start:start + shingle_words]).encode('utf-8')))
+            for start in (0, 1) if len(keys) - start >= shingle_words
+        ]
+    }
+
+
+def _overlap(a: dict, b: dict, shingle_words: int):
+    """
+    Cerca una sovrapposizione tra la coda di a e l'inizio di b
+    Returns: (indice parola in a, indice parola in b) da cui inizia l'overlap, oppure None
+    """
+    keys_a, keys_b = a['keys'], b['keys']
+    for start_b, head_hash in b['heads']:
+        if head_hash not in a['hashes']:
+            continue
+        head = keys_b[start_b:start_b + shingle_words]
+        # La prima occorrenza dà l'overlap più lungo
+        for start_a in range(len(keys_a) - shingle_words + 1):
+            if keys_a[start_a:start_a + shingle_words] != head:
+                continue
+            tail = keys_a[start_a:]
+            other = keys_b[start_b:start_b + len(tail)]
+            # b deve proseguire oltre la fine di a, altrimenti non aggiunge nulla
+            if len(keys_b) - start_b <= len(tail):
+                continue
+            # L'ultima parola di a può essere tagliata a metà dal chunking
+            if tail[:-1] == other[:-1] and other[-1].startswith(tail[-1]):
+                return start_a, start_b
+    return None
+
+
+def compact_chunks(relevant_chunks: list, dedup_threshold: float = 0.9, shingle_words: int = 8) -> list:
+    """
+    Compatta il contesto prima della generazione usando shingle di parole
+    - scarta i chunk il cui testo è contenuto quasi interamente in un altro
+      (quota di shingle condivisi >= dedup_threshold), anche tra documenti diversi
+    - fonde i chunk dello stesso documento la cui coda coincide con l'inizio di un altro
+      (l'overlap del chunking) in un unico frammento senza ripetizioni
+    Il frammento risultante mantiene lo score migliore. dedup_threshold <= 0 disattiva la compattazione.
+    """
+    if dedup_threshold <= 0:
+        return list(relevant_chunks)
+
+    items = [_analyze(chunk, shingle_words) for chunk in relevant_chunks if get_chunk_text(chunk)]
+    items.sort(key=lambda item: item['score'], reverse=True)
+
+    # 1) Quasi duplicati: indice invertito hash -> chunk tenuti
+    kept = []
+    owners = {}
+    for item in items:
+        shared = Counter(index for h in item['hashes'] for index in owners.get(h, ()))
+        duplicate_of = None
+        for index, count in shared.most_common():
+            if count / min(len(item['hashes']), len(kept[index]['hashes'])) >= dedup_threshold:
+                duplicate_of = index
+                break
+        if duplicate_of is None:
+            for h in item['hashes']:
+                owners.setdefault(h, set()).add(len(kept))
+            kept.append(item)
+            continue
+        survivor = kept[duplicate_of]
+        if len(item['hashes']) > len(survivor['hashes']):
+            # Il chunk meno rilevante contiene più testo: tienilo, con lo score migliore
+            replacement = _analyze(_with_text(item['chunk'], item['text'], survivor['chunk']), shingle_words)
+            for h in replacement['hashes']:
+                owners.setdefault(h, set()).add(duplicate_of)
+            kept[duplicate_of] = replacement
+
+    # 2) Fusione dei chunk adiacenti dello stesso documento
+    by_source = {}
+    for item in kept:
+        by_source.setdefault(item['source'], []).append(item)
+
+    compacted = []
+    for group in by_source.values():
+        merged = True
+        while merged:
+            merged = False
+            for a in group:
+                for b in group:
+                    if a is b:
+                        continue
+                    found = _overlap(a, b, shingle_words)
+                    if found is None:
+                        continue
+                    start_a, start_b = found
+                    text = a['text'][:a['starts'][start_a]] + b['text'][b['starts'][start_b]:]
+                    best = a if a['score'] >= b['score'] else b
+                    combined = _analyze(_with_text(best['chunk'], text, best['chunk']), shingle_words)
+                    group = [item for item in group if item is not a and item is not b] + [combined]
+                    merged = True
+                    break
+                if merged:
+                    break
+        compacted.extend(item['chunk'] for item in group)
+
+    compacted.sort(key=rank_score, reverse=True)
+    return compacted
+
+
+def select_chunks(relevant_chunks: list, min_score: float, max_chunks: int, token_budget: int) -> tuple:
+    """
+    Seleziona i chunk da inviare al modello
+    - scarta i chunk sotto min_score (se nessuno la supera usa i migliori disponibili)
+    - ordina per rilevanza (rerankScore se presente) e inserisce i chunk finché rientrano in token_budget
+    - non supera comunque max_chunks
+    Returns: (chunks_to_use, numero_chunk_sopra_soglia, token_contesto)
+    """
+    with_text = [chunk for chunk in relevant_chunks if get_chunk_text(chunk)]
+    high_score_chunks = [
+        chunk for chunk in with_text
+        if chunk.get('chunkRelevanceScore', 0) >= min_score
+    ]
+    # Se non ci sono chunk con score alto, usa comunque i migliori disponibili
+    candidates = high_score_chunks or with_text
+    candidates = sorted(candidates, key=rank_score, reverse=True)
+
+    chunks_to_use = []
+    used_tokens = 0
+    for chunk in candidates:
+        if len(chunks_to_use) >= max_chunks:
+            break
+        tokens = estimate_tokens(get_chunk_text(chunk))
+        # Un chunk troppo grande viene saltato, ma quelli successivi più piccoli possono entrare
+        if used_tokens + tokens > token_budget and chunks_to_use:
+            continue
+        chunks_to_use.append(chunk)
+        used_tokens += tokens
+
+    return chunks_to_use, len(high_score_chunks), used_tokens
+
+
+def recent_user_questions(chat_history: list, max_history: int) -> list:
+    """
+    Domande precedenti dell'utente (le risposte dell'assistente non vengono inviate),
+    limitate alle ultime max_history * 2 e senza duplicati
+    """
+    user_questions = [msg.get('text', '') for msg in chat_history if msg.get('role') == 'user']
+
+    # Moltiplica per 2 perché contiamo solo i messaggi user
+    max_history_messages = max_history * 2
+    recent_questions = user_questions[-max_history_messages:]
+
+    # Rimuovi duplicati (a volte il frontend invia la stessa domanda 2 volte)
+    unique_questions = []
+    seen = set()
+    for q in recent_questions:
+        if q and q not in seen:
+            unique_questions.append(q)
+            seen.add(q)
+    return unique_questions
+
+
+def build_prompt(query_text: str, chunks_to_use: list, questions: list) -> str:
+    """
+    Prompt unico: system instruction + contesto documenti + domande precedenti + domanda corrente
+    """
+    parts = [SYSTEM_INSTRUCTION, "\n\n"]
+
+    # Contesto dei documenti
+    if chunks_to_use:
+        parts.append("CONTESTO DOCUMENTI:\n\n")
+        for i, chunk in enumerate(chunks_to_use, 1):
+            source = chunk.get('source_document', 'documento')
+            parts.extend((f"[Frammento {i} da {source}]:\n", get_chunk_text(chunk), "\n\n"))
+
+    # Cronologia domande precedenti (se ci sono)
+    if questions:
+        parts.append("\n\nCONTESTO CONVERSAZIONE - Domande precedenti dell'utente:\n")
+        parts.extend(f"{i}. {q}\n" for i, q in enumerate(questions, 1))
+        parts.append("\n")
+
+    # Domanda corrente
+    parts.extend(("DOMANDA CORRENTE: ", query_text, "\n\nRISPOSTA:"))
+    return ''.join(parts)
+
+
+def prepare_generation(query_text: str, relevant_chunks: list, chat_history: list,
+                       min_score: float, max_chunks: int, token_budget: int, max_history: int,
+                       dedup_threshold: float = 0.9, shingle_words: int = 8) -> dict:
+    """
+    Compattazione, selezione dei chunk e costruzione del prompt in un unico passaggio
+    Returns: dict con prompt, chunks_to_use, high_score_count, compacted_count,
+             context_tokens, prompt_tokens e questions
+    """
+    compacted = compact_chunks(relevant_chunks, dedup_threshold, shingle_words)
+    chunks_to_use, high_score_count, context_tokens = select_chunks(
+        compacted, min_score, max_chunks, token_budget
+    )
+    questions = recent_user_questions(chat_history, max_history)
+    prompt = build_prompt(query_text, chunks_to_use, questions)
+    return {
+        'prompt': prompt,
+        'chunks_to_use': chunks_to_use,
+        'high_score_count': high_score_count,
+        'compacted_count': len(compacted),
+        'context_tokens': context_tokens,
+        'prompt_tokens': estimate_tokens(prompt),
+        'questions': questions
+    }
@@ -0,0 +1,261 @@
+"""
+Registro dei provider di generazione (Gemini, DeepSeek, OpenAI).
+
+Ogni provider viene creato una sola volta per processo e mantiene un client di
+lunga durata (sessione HTTP condivisa o client OpenAI con pool di connessioni),
+così le chiamate riusano connessioni e sessioni TLS. Tutti espongono la stessa
+interfaccia: generate() per la risposta completa e stream() per i frammenti di
+testo man mano che vengono generati.
+"""
+import json
+import logging
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional
+
+import requests
+
+from retry_policy import RetryPolicy, RETRY_STATUS_CODES
+from sse import iter_sse_payloads
+
+logger = logging.getLogger(__name__)
+
+# Testo (completo o frammento) e finishReason normalizzato al formato Gemini (None se non ancora noto)
+Generation = namedtuple('Generation', 'text finish_reason')
+
+# finish_reason OpenAI -> finishReason Gemini
+_OPENAI_FINISH_REASONS = {
+    'stop': 'STOP',
+    'length': 'MAX_TOKENS',
+    'content_filter': 'SAFETY',
+}
+
+
+class ProviderError(Exception):
+    """Errore del provider di generazione (status_code None per errori di connessione)"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None, retry_after: Optional[str] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class GenerationProvider:
+    """Interfaccia comune dei provider"""
+
+    name = ''
+
+    def __init__(self, default_model: str):
+        self.default_model = default_model
+
+    def generate(self, messages: list, model: str = None, max_tokens=4096, temperature=0.7) -> Generation:
+        """Risposta completa; messages = [{'role': 'user'|'assistant', 'content': 'testo'}]"""
+        raise NotImplementedError
+
+    def stream(self, messages: list, model: str = None, max_tokens=4096, temperature=0.7) -> Iterator[Generation]:
+        """Frammenti di testo della risposta man mano che arrivano"""
+        raise NotImplementedError
+
+
+class GeminiProvider(GenerationProvider):
+    """Gemini via REST sulla sessione HTTP condivisa dell'applicazione"""
+
+    name = 'gemini'
+
+    def __init__(self, session: requests.Session, base_url: str, headers_fn: Callable[[], dict],
+                 default_model: str, timeout=60, retry_policy: RetryPolicy = None, max_attempts: int = None):
+        super().__init__(default_model)
+        self.session = session
+        self.base_url = base_url
+        self.headers_fn = headers_fn
+        self.timeout = timeout
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.max_attempts = max_attempts  # None = quelli della politica di retry
+
+    @staticmethod
+    def _payload(messages, max_tokens, temperature) -> dict:
+        return {
+            'contents': [
+                {
+                    # Gemini chiama "model" il ruolo dell'assistente
+                    'role': 'model' if msg.get('role') == 'assistant' else msg.get('role', 'user'),
+                    'parts': [{'text': msg.get('content', '')}]
+                }
+                for msg in messages
+            ],
+            'generationConfig': {
+                'temperature': temperature,
+                'topK': 40,
+                'topP': 0.95,
+                'maxOutputTokens': max_tokens,
+            }
+        }
+
+    def _post(self, url: str, payload: dict, stream=False) -> requests.Response:
+        """POST tramite la politica di retry (429/503, errori di connessione); errori come ProviderError"""
+        operation = 'gemini:' + url.rsplit(':', 1)[-1].split('?')[0]
+        try:
+            response = self.retry_policy.send(
+                lambda: self.session.post(url, headers=self.headers_fn(), json=payload, stream=stream, timeout=self.timeout),
+                operation, self.max_attempts
+            )
+        except requests.exceptions.RequestException as e:
+            raise ProviderError(str(e))
+        try:
+            response.raise_for_status()
+        except requests.exceptions.HTTPError as he:
+            response.close()
+            raise ProviderError(str(he), response.status_code, response.headers.get('Retry-After'))
+        return response
+
+    def generate(self, messages, model=None, max_tokens=4096, temperature=0.7) -> Generation:
+        url = f"{self.base_url}/models/{model or self.default_model}:generateContent"
+        result = self._post(url, self._payload(messages, max_tokens, temperature)).json()
+        candidates = result.get('candidates', [])
+        if not candidates:
+            raise ValueError('Nessuna risposta generata dal modello')
+        candidate = candidates[0]
+        parts = (candidate.get('content') or {}).get('parts') or [{}]
+        return Generation(parts[0].get('text', ''), candidate.get('finishReason'))
+
+    def stream(self, messages, model=None, max_tokens=4096, temperature=0.7) -> Iterator[Generation]:
+        # alt=sse per ricevere Server-Sent Events
+        url = f"{self.base_url}/models/{model or self.default_model}:streamGenerateContent?alt=sse"
+        response = self._post(url, self._payload(messages, max_tokens, temperature), stream=True)
+        try:
+            for payload in iter_sse_payloads(response.iter_content(chunk_size=None)):
+                try:
+                    chunk_data = json.loads(payload)
+                except ValueError as e:
+                    logger.warning(f"Errore parsing chunk streaming: {str(e)}, evento: {payload[:100]!r}")
+                    continue
+                candidates = chunk_data.get('candidates')
+                if not candidates:
+                    continue
+                candidate = candidates[0]
+                parts = (candidate.get('content') or {}).get('parts')
+                text = (parts[0].get('text') or '') if parts else ''
+                finish_reason = candidate.get('finishReason')
+                if text or finish_reason:
+                    yield Generation(text, finish_reason)
+        except requests.exceptions.RequestException as e:
+            raise ProviderError(str(e))
+        finally:
+            response.close()
+
+
+class OpenAICompatibleProvider(GenerationProvider):
+    """
+    Provider con API compatibile OpenAI (OpenAI, DeepSeek). Richiede `pip install openai`.
+    Il client (con il suo pool di connessioni httpx) viene creato alla prima chiamata e riusato;
+    i retry interni dell'SDK sono disattivati a favore della politica di retry condivisa.
+    """
+
+    def __init__(self, name: str, api_key: str, default_model: str, base_url: str = None, timeout=60,
+                 retry_policy: RetryPolicy = None):
+        super().__init__(default_model)
+        self.name = name
+        self.api_key = api_key
+        self.base_url = base_url
+        self.timeout = timeout
+        self.retry_policy = retry_policy or RetryPolicy()
+        self._client = None
+        self._lock = threading.Lock()
+
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    import openai
+                    self._client = openai.OpenAI(api_key=self.api_key, base_url=self.base_url,
+                                                 timeout=self.timeout, max_retries=0)
+        return self._client
+
+    @contextmanager
+    def _errors(self):
+        """Converte le eccezioni dell'SDK in ProviderError"""
+        import openai
+        try:
+            yield
+        except openai.APIStatusError as e:
+            raise ProviderError(str(e), e.status_code, e.response.headers.get('retry-after'))
+        except openai.OpenAIError as e:
+            # APIError (connessione, timeout) o client non configurato (es. chiave mancante)
+            raise ProviderError(str(e))
+
+    @staticmethod
+    def _retryable(result, error) -> tuple:
+        """Classificazione per la politica di retry: status ritentabili ed errori di connessione"""
+        if error is None:
+            return False, None
+        import openai
+        if isinstance(error, openai.APIStatusError):
+            return error.status_code in RETRY_STATUS_CODES, error.response.headers.get('retry-after')
+        return isinstance(error, openai.APIConnectionError) and not isinstance(error, openai.APITimeoutError), None
+
+    def _create(self, **params):
+        return self.retry_policy.call(
+            lambda: self.client().chat.completions.create(**params),
+            self._retryable, f"{self.name}:chat.completions"
+        )
+
+    @staticmethod
+    def _messages(messages) -> list:
+        return [{'role': msg.get('role'), 'content': msg.get('content', '')} for msg in messages]
+
+    def generate(self, messages, model=None, max_tokens=4096, temperature=0.7) -> Generation:
+        with self._errors():
+            response = self._create(
+                model=model or self.default_model,
+                messages=self._messages(messages),
+                max_tokens=max_tokens,
+                temperature=temperature
+            )
+        choice = response.choices[0]
+        return Generation(choice.message.content or '', _OPENAI_FINISH_REASONS.get(choice.finish_reason, choice.finish_reason))
+
+    def stream(self, messages, model=None, max_tokens=4096, temperature=0.7) -> Iterator[Generation]:
+        with self._errors():
+            response = self._create(
+                model=model or self.default_model,
+                messages=self._messages(messages),
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stream=True
+            )
+            try:
+                for chunk in response:
+                    if not chunk.choices:
+                        continue
+                    choice = chunk.choices[0]
+                    text = (choice.delta.content or '') if choice.delta else ''
+                    finish_reason = _OPENAI_FINISH_REASONS.get(choice.finish_reason, choice.finish_reason)
+                    if text or finish_reason:
+                        yield Generation(text, finish_reason)
+            finally:
+                response.close()
+
+
+class ProviderRegistry:
+    """Provider per nome, istanziati alla prima richiesta e poi riusati da tutte le chiamate"""
+
+    def __init__(self):
+        self.factories = {}
+        self.instances = {}
+        self.lock = threading.Lock()
+
+    def register(self, name: str, factory: Callable[[], GenerationProvider]):
+        self.factories[name] = factory
+
+    def get(self, name: str) -> GenerationProvider:
+        provider = self.instances.get(name)
+        if provider is None:
+            if name not in self.factories:
+                raise ValueError(f"Provider di generazione sconosciuto: {name}")
+            with self.lock:
+                provider = self.instances.get(name)
+                if provider is None:
+                    provider = self.factories[name]()
+                    self.instances[name] = provider
+        return provider
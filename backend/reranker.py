@@ -0,0 +1,92 @@
+"""
+Re-ranking locale dei chunk recuperati (ibrido upstream + BM25).
+
+I chunkRelevanceScore arrivano da chiamate :query separate, una per documento,
+e non sono calibrati tra documenti diversi: ordinare l'unione solo su quello
+score rende rumoroso il taglio ai primi N. Prima del taglio ogni chunk riceve
+un rerankScore che combina
+- lo score upstream normalizzato sull'insieme (min-max globale)
+- lo score upstream normalizzato all'interno del proprio documento
+- lo score BM25 della query calcolato sui testi dei chunk restituiti
+  (IDF e lunghezza media sul solo insieme recuperato)
+Tutti i calcoli sono vettorizzati con NumPy; lo score upstream originale resta
+invariato (la soglia MIN_RELEVANCE_SCORE continua a riferirsi a quello).
+"""
+from collections import Counter
+
+import numpy as np
+
+from prompt_builder import get_chunk_text
+from text_processing import normalize_text
+
+
+def _minmax(values: np.ndarray) -> np.ndarray:
+    """Normalizza in [0, 1]; un insieme costante vale 1 (nessuna informazione per ordinare)"""
+    if values.size == 0:
+        return values
+    low, high = values.min(), values.max()
+    if high - low < 1e-12:
+        return np.ones_like(values)
+    return (values - low) / (high - low)
+
+
+def bm25_scores(query_text: str, texts: list, k1: float = 1.2, b: float = 0.75) -> np.ndarray:
+    """Score BM25 della query per ogni testo, con statistiche calcolate sui soli testi dati"""
+    terms = sorted(set(normalize_text(query_text).split()))
+    if not texts or not terms:
+        return np.zeros(len(texts))
+
+    tokenized = [normalize_text(text).split() for text in texts]
+    lengths = np.array([len(tokens) for tokens in tokenized], dtype=float)
+    # Matrice chunk x termini della query (solo i termini che servono)
+    tf = np.array([[counts[t] for t in terms] for counts in map(Counter, tokenized)], dtype=float)
+
+    n = len(texts)
+    df = (tf > 0).sum(axis=0)
+    idf = np.log1p((n - df + 0.5) / (df + 0.5))
+    avg_length = lengths.mean() or 1.0
+    norm = k1 * (1 - b + b * lengths / avg_length)
+    return (tf * (k1 + 1) / (tf + norm[:, None])) @ idf
+
+
+def per_document_normalize(scores: np.ndarray, sources: list) -> np.ndarray:
+    """
+    Min-max dello score all'interno di ogni documento. I documenti con un solo
+    chunk (o score tutti uguali) mantengono lo score normalizzato globale.
+    """
+    if scores.size == 0:
+        return scores
+    _, groups = np.unique([str(s) for s in sources], return_inverse=True)
+    count = groups.max() + 1
+    low = np.full(count, np.inf)
+    high = np.full(count, -np.inf)
+    np.minimum.at(low, groups, scores)
+    np.maximum.at(high, groups, scores)
+    span = (high - low)[groups]
+    fallback = _minmax(scores)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        normalized = (scores - low[groups]) / span
+    return np.where(span > 1e-12, normalized, fallback)
+
+
+def rerank_chunks(query_text: str, chunks: list, bm25_weight: float = 0.4,
+                  doc_norm_weight: float = 0.2, k1: float = 1.2, b: float = 0.75) -> list:
+    """
+    Ordina i chunk per rerankScore decrescente (copie con il campo aggiunto)
+    rerankScore = w_upstream * upstream_globale + doc_norm_weight * upstream_per_documento
+                  + bm25_weight * bm25 (tutti in [0, 1]), con w_upstream = 1 - gli altri due pesi
+    """
+    if not chunks:
+        return []
+    upstream = np.array([c.get('chunkRelevanceScore', 0) or 0 for c in chunks], dtype=float)
+    sources = [c.get('source_document', '') for c in chunks]
+    bm25 = bm25_scores(query_text, [get_chunk_text(c) for c in chunks], k1, b)
+    bm25 = bm25 / bm25.max() if bm25.max() > 0 else bm25
+
+    upstream_weight = max(0.0, 1.0 - bm25_weight - doc_norm_weight)
+    fused = (upstream_weight * _minmax(upstream)
+             + doc_norm_weight * per_document_normalize(upstream, sources)
+             + bm25_weight * bm25)
+
+    order = np.argsort(-fused, kind='stable')
+    return [dict(chunks[i], rerankScore=round(float(fused[i]), 6)) for i in order]
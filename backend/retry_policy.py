@@ -0,0 +1,195 @@
+"""
+Politica di retry condivisa da tutte le chiamate upstream (File Search, Gemini,
+provider di generazione, ingestion massiva).
+
+- backoff con decorrelated jitter: l'attesa è casuale tra base_delay e il
+  triplo dell'attesa precedente (max max_delay), così i client che hanno
+  ricevuto lo stesso errore non ritentano tutti nello stesso istante
+- l'header Retry-After del server ha la precedenza sul backoff calcolato; se
+  chiede un'attesa oltre max_delay non si ritenta e l'errore torna al chiamante
+- budget globale di retry (per processo): ogni richiesta originale accumula
+  una frazione di credito e ogni retry ne consuma uno, quindi durante
+  un'interruzione upstream i retry restano una piccola quota del traffico
+  invece di moltiplicare i 429
+
+Le richieste non idempotenti (es. upload) si ritentano solo se la richiesta
+non è mai partita (connessione non stabilita): un timeout o un 5xx dopo l'invio
+potrebbero aver già creato la risorsa upstream.
+
+L'HTTPAdapter della sessione non ritenta (max_retries=0): un solo livello di retry.
+"""
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Callable, Optional
+
+import requests
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+logger = logging.getLogger(__name__)
+
+# Status ritentabili: rate limit e indisponibilità temporanea (non i 500, di solito deterministici)
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Interpreta l'header Retry-After (secondi oppure data HTTP)"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def failed_before_sending(error: Exception) -> bool:
+    """True se la richiesta non ha raggiunto il server (connessione rifiutata, DNS, connect timeout)"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if not isinstance(error, requests.exceptions.ConnectionError):
+        return False
+    reason = error.args[0] if error.args else None
+    reason = getattr(reason, 'reason', reason)  # MaxRetryError di urllib3 -> causa originale
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+class RetryBudget:
+    """
+    Crediti di retry: ogni richiesta ne aggiunge `ratio`, ogni retry ne consuma uno.
+    Una riserva minima si ricarica nel tempo (min_per_second) per il traffico scarso.
+    """
+
+    def __init__(self, ratio=0.2, min_per_second=1.0, capacity=10.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.capacity = capacity
+        self.credits = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.credits = min(self.capacity, self.credits + (now - self.updated_at) * self.min_per_second)
+        self.updated_at = now
+
+    def deposit(self):
+        """Una richiesta originale"""
+        with self.lock:
+            self._refill(time.monotonic())
+            self.credits = min(self.capacity, self.credits + self.ratio)
+
+    def withdraw(self) -> bool:
+        """Consuma il credito di un retry; False se il budget è esaurito"""
+        with self.lock:
+            self._refill(time.monotonic())
+            if self.credits < 1:
+                return False
+            self.credits -= 1
+            return True
+
+    def available(self) -> float:
+        with self.lock:
+            self._refill(time.monotonic())
+            return self.credits
+
+
+class RetryPolicy:
+    """Decide se e dopo quanto ritentare una chiamata upstream"""
+
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=20.0, budget: RetryBudget = None,
+                 retry_statuses=RETRY_STATUS_CODES, sleep: Callable[[float], None] = time.sleep):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget or RetryBudget()
+        self.retry_statuses = retry_statuses
+        self.sleep = sleep
+        self.counters = {'requests': 0, 'retries': 0, 'budget_exhausted': 0, 'retry_after_too_long': 0}
+        self.lock = threading.Lock()
+
+    def _count(self, name: str):
+        with self.lock:
+            self.counters[name] += 1
+
+    def backoff(self, previous: float, retry_after: Optional[str] = None) -> float:
+        """Attesa prima del prossimo tentativo: Retry-After se presente, altrimenti decorrelated jitter"""
+        hint = parse_retry_after(retry_after)
+        if hint is not None:
+            return hint
+        return min(self.max_delay, random.uniform(self.base_delay, max(self.base_delay, previous * 3)))
+
+    def allow_retry(self) -> bool:
+        """Preleva un credito dal budget globale"""
+        if self.budget.withdraw():
+            return True
+        self._count('budget_exhausted')
+        return False
+
+    def call(self, fn: Callable, classify: Callable, operation: str = 'upstream', max_attempts: int = None):
+        """
+        Esegue fn() con retry
+        classify(risultato, eccezione) -> (ritentare, valore Retry-After o None)
+        Ritorna l'ultimo risultato o rilancia l'ultima eccezione.
+        """
+        attempts = max_attempts or self.max_attempts
+        self._count('requests')
+        self.budget.deposit()
+        delay = 0.0
+        for attempt in range(1, attempts + 1):
+            try:
+                result, error = fn(), None
+            except Exception as e:
+                result, error = None, e
+            retry, retry_after = classify(result, error)
+            if not retry or attempt == attempts:
+                break
+            wait = self.backoff(delay, retry_after)
+            if wait > self.max_delay:
+                self._count('retry_after_too_long')
+                logger.warning(f"{operation}: Retry-After di {wait:.0f}s oltre il massimo ({self.max_delay:.0f}s), nessun retry")
+                break
+            if not self.allow_retry():
+                logger.warning(f"{operation}: budget di retry esaurito, nessun retry")
+                break
+            self._count('retries')
+            reason = getattr(result, 'status_code', None) or type(error).__name__
+            logger.warning(f"{operation}: {reason}, retry {attempt}/{attempts - 1} tra {wait:.2f}s")
+            if result is not None and hasattr(result, 'close'):
+                result.close()
+            delay = wait
+            self.sleep(wait)
+        if error is not None:
+            raise error
+        return result
+
+    def _classify_response(self, response, error) -> tuple:
+        if error is not None:
+            # Solo errori di connessione: un read timeout può aver già elaborato la richiesta
+            return isinstance(error, requests.exceptions.ConnectionError), None
+        if response.status_code in self.retry_statuses:
+            return True, response.headers.get('Retry-After')
+        return False, None
+
+    @staticmethod
+    def _classify_unsent(response, error) -> tuple:
+        return error is not None and failed_before_sending(error), None
+
+    def send(self, send_fn: Callable[[], requests.Response], operation: str = 'upstream',
+             max_attempts: int = None, idempotent: bool = True) -> requests.Response:
+        """
+        Richiesta HTTP con retry su errori di connessione e status ritentabili (il chiamante fa raise_for_status)
+        idempotent=False: retry solo se la richiesta non è mai stata inviata
+        """
+        classify = self._classify_response if idempotent else self._classify_unsent
+        return self.call(send_fn, classify, operation, max_attempts)
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.counters)
+        stats['budget_available'] = round(self.budget.available(), 2)
+        return stats
@@ -0,0 +1,653 @@
+"""
+Backend di stato per cache delle query, rate limiting e circuit breaker.
+
+Il backend in-memory vale per il singolo processo; il backend SQLite usa un file
+locale condiviso da tutti i worker gunicorn dello stesso host, così ogni
+risultato viene memorizzato una sola volta e i limiti valgono per l'intero host.
+Il backend Redis (solo cache) è opzionale e richiede il pacchetto `redis`.
+
+I backend della cache lavorano su payload già serializzati (bytes): la
+serializzazione compatta è responsabilità di QueryCache.
+
+Con i worker gevent le attese su file condivisi (busy timeout di SQLite,
+BEGIN IMMEDIATE, fcntl.flock) sono chiamate C bloccanti che il monkey patching
+non rende cooperative: i metodi che le eseguono sono marcati @blocking_io e
+girano nel threadpool nativo dell'hub, così una contesa sul lock rallenta solo
+la richiesta che la incontra e non tutte quelle servite dal worker.
+"""
+import functools
+import heapq
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+try:
+    import gevent
+    from gevent.monkey import is_module_patched
+except ImportError:  # gevent non installato (sviluppo, worker sync): chiamate dirette
+    gevent = None
+
+logger = logging.getLogger(__name__)
+
+_offload_state = threading.local()
+
+
+def _run_offloaded(fn, args, kwargs):
+    _offload_state.active = True
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        _offload_state.active = False
+
+
+def blocking_io(fn):
+    """
+    Esegue il metodo nel threadpool dell'hub gevent quando il processo è
+    monkey-patched (la greenlet chiamante attende senza bloccare l'hub);
+    altrimenti, o se già dentro il threadpool, è una chiamata diretta
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if gevent is None or getattr(_offload_state, 'active', False) or not is_module_patched('threading'):
+            return fn(*args, **kwargs)
+        return gevent.get_hub().threadpool.apply(_run_offloaded, (fn, args, kwargs))
+    return wrapper
+
+
+class CacheBackend:
+    """Interfaccia comune dei backend della cache"""
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Ritorna il payload se presente e non scaduto, altrimenti None"""
+        raise NotImplementedError
+
+    def set(self, key: str, payload: bytes, ttl_seconds: float):
+        """Memorizza il payload con scadenza"""
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        """Rimuove una voce"""
+        raise NotImplementedError
+
+    def clear(self):
+        """Svuota il backend"""
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        """Ritorna occupazione e contatori del backend"""
+        return {}
+
+
+class MemoryCacheBackend(CacheBackend):
+    """
+    Backend LRU in-memory (per processo) con limite di voci e di byte.
+    Le voci scadute vengono rimosse tramite un heap ordinato per scadenza.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=50 * 1024 * 1024):
+        self.cache = OrderedDict()  # {key: (payload, expires_at)} in ordine LRU
+        self.expiry_heap = []  # [(expires_at, key)] - le voci sovrascritte vengono ignorate
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.lock = threading.Lock()
+
+    def _remove(self, key):
+        """Rimuove una voce aggiornando il conteggio dei byte (lock già acquisito)"""
+        payload, _ = self.cache.pop(key)
+        self.current_bytes -= len(payload)
+
+    def _purge_expired(self, now):
+        """Rimuove tutte le voci scadute in testa all'heap (lock già acquisito)"""
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            expires_at, key = heapq.heappop(self.expiry_heap)
+            entry = self.cache.get(key)
+            # Ignora voci dell'heap relative a valori già sovrascritti o rimossi
+            if entry is not None and entry[1] == expires_at:
+                self._remove(key)
+                self.expirations += 1
+
+    def get(self, key):
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is None:
+                return None
+
+            payload, expires_at = entry
+            if time.time() >= expires_at:
+                self._remove(key)
+                self.expirations += 1
+                return None
+
+            self.cache.move_to_end(key)
+            return payload
+
+    def set(self, key, payload, ttl_seconds):
+        if len(payload) > self.max_bytes:
+            logger.warning(f"Valore troppo grande per la cache ({len(payload)} byte), non memorizzato")
+            return
+
+        now = time.time()
+        expires_at = now + ttl_seconds
+        with self.lock:
+            self._purge_expired(now)
+
+            if key in self.cache:
+                self._remove(key)
+            self.cache[key] = (payload, expires_at)
+            self.current_bytes += len(payload)
+            heapq.heappush(self.expiry_heap, (expires_at, key))
+
+            # Evizione LRU finché non rientriamo nei limiti
+            while len(self.cache) > self.max_entries or self.current_bytes > self.max_bytes:
+                self._remove(next(iter(self.cache)))
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            if key in self.cache:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.expiry_heap.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            self._purge_expired(time.time())
+            return {
+                'backend': 'memory',
+                'entries': len(self.cache),
+                'bytes': self.current_bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
+
+
+class SQLiteStore:
+    """
+    Connessioni SQLite per thread verso un file condiviso tra processi.
+    Usa WAL per permettere letture concorrenti mentre un worker scrive.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """
+    Backend su file SQLite condiviso da tutti i worker dello stesso host.
+    L'ordine LRU è approssimato dal timestamp dell'ultimo accesso, aggiornato
+    al più una volta ogni ACCESS_RESOLUTION secondi per voce: un hit è di norma
+    una sola lettura, senza lock di scrittura.
+    """
+
+    # Ogni quante scritture applicare scadenze e limiti (costo ammortizzato)
+    PRUNE_EVERY = 50
+    # Secondi di granularità di last_access
+    ACCESS_RESOLUTION = 30.0
+
+    def __init__(self, path: str, max_entries=1000, max_bytes=50 * 1024 * 1024, table='query_cache'):
+        if not re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*', table):
+            raise ValueError(f"Nome tabella non valido: {table}")
+        self.store = SQLiteStore(path)
+        self.table = table
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self.writes = 0
+        self.store.connection().execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                key TEXT PRIMARY KEY,
+                payload BLOB NOT NULL,
+                expires_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self.store.connection().execute(
+            f'CREATE INDEX IF NOT EXISTS idx_{table}_access ON {table}(last_access)'
+        )
+
+    @blocking_io
+    def get(self, key):
+        conn = self.store.connection()
+        now = time.time()
+        row = conn.execute(
+            f'SELECT payload, last_access FROM {self.table} WHERE key = ? AND expires_at > ?', (key, now)
+        ).fetchone()
+        if row is None:
+            return None
+        if now - row[1] >= self.ACCESS_RESOLUTION:
+            conn.execute(f'UPDATE {self.table} SET last_access = ? WHERE key = ?', (now, key))
+        return bytes(row[0])
+
+    @blocking_io
+    def set(self, key, payload, ttl_seconds):
+        if len(payload) > self.max_bytes:
+            logger.warning(f"Valore troppo grande per la cache ({len(payload)} byte), non memorizzato")
+            return
+
+        now = time.time()
+        conn = self.store.connection()
+        conn.execute(
+            f'INSERT OR REPLACE INTO {self.table} (key, payload, expires_at, last_access) VALUES (?, ?, ?, ?)',
+            (key, sqlite3.Binary(payload), now + ttl_seconds, now)
+        )
+        self.writes += 1
+        if self.writes % self.PRUNE_EVERY == 0:
+            self.prune()
+
+    @blocking_io
+    def prune(self):
+        """Rimuove le voci scadute e applica i limiti di voci e byte (LRU)"""
+        conn = self.store.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(f'DELETE FROM {self.table} WHERE expires_at <= ?', (time.time(),))
+            entries, total_bytes = conn.execute(
+                f'SELECT COUNT(*), COALESCE(SUM(LENGTH(payload)), 0) FROM {self.table}'
+            ).fetchone()
+            if entries > self.max_entries or total_bytes > self.max_bytes:
+                # Scorri dal meno recente e rimuovi finché non rientriamo nei limiti
+                victims = []
+                for key, size in conn.execute(
+                    f'SELECT key, LENGTH(payload) FROM {self.table} ORDER BY last_access'
+                ):
+                    if entries <= self.max_entries and total_bytes <= self.max_bytes:
+                        break
+                    victims.append((key,))
+                    entries -= 1
+                    total_bytes -= size
+                conn.executemany(f'DELETE FROM {self.table} WHERE key = ?', victims)
+                self.evictions += len(victims)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    @blocking_io
+    def delete(self, key):
+        self.store.connection().execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+
+    @blocking_io
+    def clear(self):
+        self.store.connection().execute(f'DELETE FROM {self.table}')
+
+    @blocking_io
+    def stats(self):
+        entries, total_bytes = self.store.connection().execute(
+            f'SELECT COUNT(*), COALESCE(SUM(LENGTH(payload)), 0) FROM {self.table} WHERE expires_at > ?',
+            (time.time(),)
+        ).fetchone()
+        return {
+            'backend': 'sqlite',
+            'path': self.store.path,
+            'entries': entries,
+            'bytes': total_bytes,
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes,
+            'evictions': self.evictions
+        }
+
+
+class RedisCacheBackend(CacheBackend):
+    """
+    Backend Redis (opzionale, richiede `pip install redis`).
+    Scadenze ed evizione sono delegate a Redis (SETEX + maxmemory-policy).
+    """
+
+    def __init__(self, url: str, prefix='gfs:query_cache:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.url = url
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, payload, ttl_seconds):
+        self.client.setex(self.prefix + key, max(1, int(ttl_seconds)), payload)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+    def stats(self):
+        return {'backend': 'redis', 'url': self.url}
+
+
+def create_cache_backend(kind: str, path: str = None, redis_url: str = None,
+                         max_entries=1000, max_bytes=50 * 1024 * 1024, name='query_cache') -> CacheBackend:
+    """
+    Crea il backend della cache in base alla configurazione
+    kind: 'memory' (default), 'sqlite' o 'redis'
+    name: tabella SQLite / prefisso Redis, così cache diverse hanno limiti e svuotamento separati
+    """
+    kind = (kind or 'memory').lower()
+    if kind == 'sqlite':
+        return SQLiteCacheBackend(path, max_entries=max_entries, max_bytes=max_bytes, table=name)
+    if kind == 'redis':
+        return RedisCacheBackend(redis_url, prefix=f'gfs:{name}:')
+    return MemoryCacheBackend(max_entries=max_entries, max_bytes=max_bytes)
+
+
+class MemoryRateLimitStore:
+    """
+    Token bucket per client in-memory (per processo).
+    I client inattivi da più di idle_seconds hanno il bucket pieno e vengono
+    rimossi: lo stato resta proporzionale ai client attivi.
+    """
+
+    def __init__(self, idle_seconds=60, max_clients=100000):
+        self.buckets = OrderedDict()  # {identifier: (tokens, updated_at)} dal meno recente
+        self.idle_seconds = idle_seconds
+        self.max_clients = max_clients
+        self.lock = threading.Lock()
+
+    def _evict_idle(self, now):
+        """Rimuove i client inattivi in testa (lock già acquisito)"""
+        while self.buckets:
+            identifier, (_, updated_at) = next(iter(self.buckets.items()))
+            if now - updated_at < self.idle_seconds and len(self.buckets) <= self.max_clients:
+                break
+            del self.buckets[identifier]
+
+    def consume(self, identifier, capacity, refill_rate, now=None) -> tuple:
+        """
+        Consuma un token se disponibile
+        Returns: (allowed, tokens_rimanenti)
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            tokens, updated_at = self.buckets.pop(identifier, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * refill_rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[identifier] = (tokens, now)
+            self._evict_idle(now)
+            return allowed, tokens
+
+    def peek(self, identifier, capacity, refill_rate, now=None) -> float:
+        """Ritorna i token disponibili senza consumarli"""
+        now = time.time() if now is None else now
+        with self.lock:
+            tokens, updated_at = self.buckets.get(identifier, (capacity, now))
+            return min(capacity, tokens + (now - updated_at) * refill_rate)
+
+    def size(self):
+        """Ritorna numero client tracciati"""
+        return len(self.buckets)
+
+
+class SQLiteRateLimitStore:
+    """
+    Token bucket per client su file SQLite condiviso: il limite vale per tutti
+    i worker dell'host. Ogni controllo è una singola transazione su una riga.
+    """
+
+    # Ogni quanti controlli rimuovere i client inattivi (costo ammortizzato)
+    PRUNE_EVERY = 500
+
+    def __init__(self, path: str, idle_seconds=60):
+        self.store = SQLiteStore(path)
+        self.idle_seconds = idle_seconds
+        self.checks = 0
+        self.store.connection().execute("""
+            CREATE TABLE IF NOT EXISTS rate_limit (
+                identifier TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+
+    @blocking_io
+    def consume(self, identifier, capacity, refill_rate, now=None) -> tuple:
+        now = time.time() if now is None else now
+        conn = self.store.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT tokens, updated_at FROM rate_limit WHERE identifier = ?', (identifier,)
+            ).fetchone()
+            tokens, updated_at = row if row else (capacity, now)
+            tokens = min(capacity, tokens + max(0.0, now - updated_at) * refill_rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            conn.execute(
+                'INSERT OR REPLACE INTO rate_limit (identifier, tokens, updated_at) VALUES (?, ?, ?)',
+                (identifier, tokens, now)
+            )
+            self.checks += 1
+            if self.checks % self.PRUNE_EVERY == 0:
+                conn.execute('DELETE FROM rate_limit WHERE updated_at < ?', (now - self.idle_seconds,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return allowed, tokens
+
+    @blocking_io
+    def peek(self, identifier, capacity, refill_rate, now=None) -> float:
+        now = time.time() if now is None else now
+        row = self.store.connection().execute(
+            'SELECT tokens, updated_at FROM rate_limit WHERE identifier = ?', (identifier,)
+        ).fetchone()
+        if row is None:
+            return capacity
+        tokens, updated_at = row
+        return min(capacity, tokens + max(0.0, now - updated_at) * refill_rate)
+
+    @blocking_io
+    def size(self):
+        return self.store.connection().execute('SELECT COUNT(*) FROM rate_limit').fetchone()[0]
+
+
+def create_rate_limit_store(kind: str, path: str = None, idle_seconds=60):
+    """
+    Crea lo store del rate limiter in base alla configurazione
+    kind: 'memory' (default) o 'sqlite'
+    """
+    if (kind or 'memory').lower() == 'sqlite':
+        return SQLiteRateLimitStore(path, idle_seconds=idle_seconds)
+    return MemoryRateLimitStore(idle_seconds=idle_seconds)
+
+
+class MemoryBreakerStore:
+    """
+    Stato dei circuit breaker in-memory (per processo).
+    Ogni chiave ha: stato, numero di fallimenti, istante di apertura e
+    scadenza della chiamata di prova in HALF_OPEN.
+    """
+
+    def __init__(self):
+        self.breakers = {}  # {key: {'state', 'failures', 'opened_at', 'probe_until'}}
+        self.lock = threading.Lock()
+
+    def _get(self, key):
+        return self.breakers.setdefault(
+            key, {'state': 'CLOSED', 'failures': 0, 'opened_at': 0.0, 'probe_until': 0.0}
+        )
+
+    def acquire(self, key, timeout, probe_timeout, now=None) -> tuple:
+        """
+        Verifica se una chiamata è permessa
+        Returns: (allowed, stato_precedente); in HALF_OPEN passa una sola chiamata di prova
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            breaker = self._get(key)
+            allowed, previous = _breaker_transition(breaker, timeout, probe_timeout, now)
+            return allowed, previous
+
+    def record_success(self, key) -> str:
+        """Chiude il breaker; ritorna lo stato precedente"""
+        with self.lock:
+            breaker = self._get(key)
+            previous = breaker['state']
+            breaker.update(state='CLOSED', failures=0, probe_until=0.0)
+            return previous
+
+    def record_failure(self, key, threshold, now=None) -> tuple:
+        """Registra un fallimento; ritorna (stato, fallimenti)"""
+        now = time.time() if now is None else now
+        with self.lock:
+            breaker = self._get(key)
+            _breaker_failure(breaker, threshold, now)
+            return breaker['state'], breaker['failures']
+
+    def get(self, key) -> dict:
+        with self.lock:
+            return dict(self._get(key))
+
+
+class SQLiteBreakerStore:
+    """
+    Stato dei circuit breaker su file SQLite condiviso: un'ondata di 429 vista
+    da un worker apre il breaker per tutti, e in HALF_OPEN una sola chiamata
+    di prova viene concessa sull'intero host.
+    """
+
+    def __init__(self, path: str):
+        self.store = SQLiteStore(path)
+        self.store.connection().execute("""
+            CREATE TABLE IF NOT EXISTS circuit_breaker (
+                key TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                failures INTEGER NOT NULL,
+                opened_at REAL NOT NULL,
+                probe_until REAL NOT NULL
+            )
+        """)
+
+    def _read(self, key) -> dict:
+        """Stato di una chiave con una semplice lettura (nessun lock di scrittura)"""
+        row = self.store.connection().execute(
+            'SELECT state, failures, opened_at, probe_until FROM circuit_breaker WHERE key = ?', (key,)
+        ).fetchone()
+        return dict(zip(('state', 'failures', 'opened_at', 'probe_until'), row)) if row else \
+            {'state': 'CLOSED', 'failures': 0, 'opened_at': 0.0, 'probe_until': 0.0}
+
+    def _update(self, key, mutate):
+        """Legge, modifica e salva lo stato di una chiave in un'unica transazione"""
+        conn = self.store.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT state, failures, opened_at, probe_until FROM circuit_breaker WHERE key = ?', (key,)
+            ).fetchone()
+            breaker = dict(zip(('state', 'failures', 'opened_at', 'probe_until'), row)) if row else \
+                {'state': 'CLOSED', 'failures': 0, 'opened_at': 0.0, 'probe_until': 0.0}
+            result = mutate(breaker)
+            conn.execute(
+                'INSERT OR REPLACE INTO circuit_breaker (key, state, failures, opened_at, probe_until) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (key, breaker['state'], breaker['failures'], breaker['opened_at'], breaker['probe_until'])
+            )
+            conn.execute('COMMIT')
+            return result
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    @blocking_io
+    def acquire(self, key, timeout, probe_timeout, now=None) -> tuple:
+        now = time.time() if now is None else now
+        # Da CLOSED non serve alcuna scrittura: lettura veloce senza lock di scrittura
+        row = self.store.connection().execute(
+            'SELECT state FROM circuit_breaker WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None or row[0] == 'CLOSED':
+            return True, 'CLOSED'
+        return self._update(key, lambda b: _breaker_transition(b, timeout, probe_timeout, now))
+
+    @blocking_io
+    def record_success(self, key) -> str:
+        # Caso comune (breaker già chiuso e senza errori): nessuna transazione di scrittura
+        current = self._read(key)
+        if current['state'] == 'CLOSED' and current['failures'] == 0:
+            return 'CLOSED'
+        def mutate(breaker):
+            previous = breaker['state']
+            breaker.update(state='CLOSED', failures=0, probe_until=0.0)
+            return previous
+        return self._update(key, mutate)
+
+    @blocking_io
+    def record_failure(self, key, threshold, now=None) -> tuple:
+        now = time.time() if now is None else now
+        def mutate(breaker):
+            _breaker_failure(breaker, threshold, now)
+            return breaker['state'], breaker['failures']
+        return self._update(key, mutate)
+
+    @blocking_io
+    def get(self, key) -> dict:
+        return self._read(key)
+
+
+def _breaker_transition(breaker: dict, timeout, probe_timeout, now) -> tuple:
+    """Logica comune di call_allowed: modifica breaker e ritorna (allowed, stato_precedente)"""
+    previous = breaker['state']
+    if previous == 'CLOSED':
+        return True, previous
+
+    if previous == 'OPEN':
+        if now - breaker['opened_at'] < timeout:
+            return False, previous
+    elif breaker['probe_until'] > now:
+        # HALF_OPEN con una chiamata di prova già in corso
+        return False, previous
+
+    # Concedi la chiamata di prova (anche se quella precedente non ha mai riportato l'esito)
+    breaker['state'] = 'HALF_OPEN'
+    breaker['probe_until'] = now + probe_timeout
+    return True, previous
+
+
+def _breaker_failure(breaker: dict, threshold, now):
+    """Logica comune di record_failure"""
+    breaker['failures'] += 1
+    if breaker['state'] == 'HALF_OPEN' or breaker['failures'] >= threshold:
+        breaker['state'] = 'OPEN'
+        breaker['opened_at'] = now
+        breaker['probe_until'] = 0.0
+
+
+def create_breaker_store(kind: str, path: str = None):
+    """
+    Crea lo store dei circuit breaker in base alla configurazione
+    kind: 'memory' (default) o 'sqlite'
+    """
+    if (kind or 'memory').lower() == 'sqlite':
+        return SQLiteBreakerStore(path)
+    return MemoryBreakerStore()
@@ -0,0 +1,79 @@
+"""
+Relay Server-Sent Events a basso overhead.
+
+Il parser lavora direttamente sui byte ricevuti da Gemini (niente decodifica
+riga per riga) e ritorna i payload `data` degli eventi completi; i frame in
+uscita vengono composti da parti pre-codificate, serializzando in JSON solo il
+testo del chunk.
+"""
+import json
+
+DONE_FRAME = b'data: {"done": true}\n\n'
+_TEXT_FRAME_START = b'data: {"text": '
+_FRAME_END = b'}\n\n'
+
+
+class SSEParser:
+    """
+    Parser incrementale di uno stream text/event-stream.
+    feed() accetta blocchi di byte arbitrari (un evento può essere spezzato tra
+    più letture) e ritorna i payload `data` degli eventi completati.
+    """
+
+    def __init__(self):
+        self.buffer = b''
+        self.data_lines = []
+
+    def _line(self, line: bytes, events: list):
+        if line.endswith(b'\r'):
+            line = line[:-1]
+        if not line:
+            # Riga vuota: fine dell'evento
+            if self.data_lines:
+                events.append(b'\n'.join(self.data_lines))
+                self.data_lines = []
+        elif line.startswith(b'data:'):
+            value = line[5:]
+            self.data_lines.append(value[1:] if value.startswith(b' ') else value)
+        # Commenti (":") e campi event/id/retry non servono al relay
+
+    def feed(self, chunk: bytes) -> list:
+        """Aggiunge byte ricevuti; ritorna i payload degli eventi completi"""
+        events = []
+        if b'\n' not in chunk:
+            self.buffer += chunk
+            return events
+        lines = (self.buffer + chunk).split(b'\n')
+        # L'ultima riga può essere incompleta: resta nel buffer
+        self.buffer = lines.pop()
+        for line in lines:
+            self._line(line, events)
+        return events
+
+    def flush(self) -> list:
+        """Fine stream: ritorna l'eventuale evento non terminato da una riga vuota"""
+        events = []
+        if self.buffer:
+            self._line(self.buffer, events)
+            self.buffer = b''
+        self._line(b'', events)
+        return events
+
+
+def iter_sse_payloads(byte_chunks):
+    """Payload `data` degli eventi SSE di un iterabile di blocchi di byte"""
+    parser = SSEParser()
+    for chunk in byte_chunks:
+        if chunk:
+            yield from parser.feed(chunk)
+    yield from parser.flush()
+
+
+def text_frame(text: str) -> bytes:
+    """Frame SSE {"text": ...} senza costruire e serializzare un dizionario"""
+    return _TEXT_FRAME_START + json.dumps(text).encode('ascii') + _FRAME_END
+
+
+def event_frame(payload: dict) -> bytes:
+    """Frame SSE generico (eventi rari: warning, error, retrieval...)"""
+    return b'data: ' + json.dumps(payload).encode('ascii') + b'\n\n'
@@ -0,0 +1,54 @@
+"""
+Test per il mirror locale dei chunk
+"""
+import sys
+import os
+
+# Aggiungi la directory backend al path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chunk_mirror import ChunkMirror, RECORD
+
+def chunk(name, text, **metadata):
+    return {'chunk': dict({'name': name, 'data': {'stringValue': text}}, **metadata), 'chunkRelevanceScore': 0.5}
+
+def test_append_dedup_and_reopen(tmp_path):
+    """Test: chunk identici non riscritti, modifiche aggiunte in coda, dati riletti dopo il riavvio"""
+    mirror = ChunkMirror(str(tmp_path))
+    assert mirror.append('doc/a', [chunk('c1', 'Penale per ritardo'), chunk('c2', 'Durata è di 12 mesi', state='STATE_ACTIVE')]) == 2
+    assert mirror.append('doc/a', [chunk('c1', 'Penale per ritardo')]) == 0
+    assert mirror.append('doc/a', [chunk('c1', 'Penale per ritardo (art. 5)')]) == 1
+
+    reopened = ChunkMirror(str(tmp_path))
+    chunks, next_start = reopened.page('doc/a', 0, 10)
+    assert next_start is None
+    assert [c['chunk']['data']['stringValue'] for c in chunks] == ['Penale per ritardo (art. 5)', 'Durata è di 12 mesi']
+    assert chunks[1]['chunk']['state'] == 'STATE_ACTIVE'
+    assert reopened.stats()['chunks'] == 2
+
+def test_complete_order_remove_and_sync_between_instances(tmp_path):
+    """Test: ordine del documento dopo l'elenco completo, tombstone e riallineamento tra processi"""
+    writer = ChunkMirror(str(tmp_path))
+    reader = ChunkMirror(str(tmp_path))
+    writer.append('doc/a', [chunk('c2', 'due'), chunk('c1', 'uno')])
+    writer.mark_complete('doc/a', ['c1', 'c2'])
+
+    assert reader.is_complete('doc/a')
+    chunks, next_start = reader.page('doc/a', 0, 1)
+    assert chunks[0]['chunk']['name'] == 'c1' and next_start == 1
+
+    writer.remove('doc/a')
+    assert not reader.is_complete('doc/a') and reader.page('doc/a', 0, 10) == ([], None)
+
+def test_truncated_index_record_is_ignored_and_repaired(tmp_path):
+    """Test: un record di indice troncato (crash) non viene letto e non sposta i record successivi"""
+    mirror = ChunkMirror(str(tmp_path))
+    mirror.append('doc/a', [chunk('c1', 'uno')])
+    with open(tmp_path / 'index.bin', 'ab') as f:
+        f.write(b'\x00' * (RECORD.size // 2))
+
+    reopened = ChunkMirror(str(tmp_path))
+    assert reopened.stats()['chunks'] == 1
+    reopened.append('doc/a', [chunk('c2', 'due')])
+    assert os.path.getsize(tmp_path / 'index.bin') == 2 * RECORD.size
+    assert [c['chunk']['name'] for c in ChunkMirror(str(tmp_path)).page('doc/a', 0, 10)[0]] == ['c1', 'c2']
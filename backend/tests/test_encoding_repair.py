@@ -0,0 +1,39 @@
+"""
+Test per la riparazione dell'encoding
+"""
+import sys
+import os
+
+# Aggiungi la directory backend al path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from encoding_repair import fix_encoding_issues, EncodingRepairer
+
+def test_fix_encoding_repairs_common_mojibake():
+    """Test: accentate, maiuscole accentate, euro e punteggiatura tipografica"""
+    assert fix_encoding_issues('perchÃ© Ã¨ cosÃ¬') == 'perché è così'
+    assert fix_encoding_issues('PIÃ™ CITTÃ€') == 'PIÙ CITTÀ'
+    assert fix_encoding_issues('10 â‚¬ lâ€™anno â€œokâ€\x9d â€¦ â€“') == '10 € l’anno “ok” … –'
+    assert fix_encoding_issues('cittÃ\xa0') == 'città'
+
+def test_fix_encoding_leaves_correct_text_unchanged():
+    """Test: un testo già corretto non viene modificato"""
+    text = "È già l'una: perché? «Città» 5° – 10 € … ñ"
+    assert fix_encoding_issues(text) == text
+    assert fix_encoding_issues('') == ''
+
+def test_space_variants_only_with_other_mojibake():
+    """Test: "Ã " e "Â " in testo corretto restano invariati; riparati solo se c'è altro mojibake"""
+    for text in ('SÃO PAULO Ã Ã BRASÍLIA', 'ĐÂ NẴNG Â B', 'Ã ', 'Â '):
+        assert fix_encoding_issues(text) == text
+    assert fix_encoding_issues('perchÃ© la cittÃ  di Roma') == 'perché la città di Roma'
+
+    repairer = EncodingRepairer()
+    assert repairer.feed('SÃO PAULO Ã ') + repairer.flush() == 'SÃO PAULO Ã '
+
+def test_repairer_joins_sequences_split_across_chunks():
+    """Test: sequenze spezzate tra chunk vengono riparate; la coda viene restituita da flush"""
+    repairer = EncodingRepairer()
+    chunks = ['Il prezzo Ã', '¨ 10 â', '‚', '¬, lâ€', '™ultimo Ã']
+    output = ''.join(repairer.feed(chunk) for chunk in chunks) + repairer.flush()
+    assert output == 'Il prezzo è 10 €, l’ultimo Ã'
@@ -0,0 +1,126 @@
+"""
+Test per failover e hedging tra i provider di generazione
+"""
+import sys
+import os
+import time
+
+import pytest
+
+# Aggiungi la directory backend al path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from providers import ProviderError, Generation
+from generation_router import GenerationRouter, GenerationTarget, LatencyTracker, NoProviderAvailable
+
+class FakeProvider:
+    def __init__(self, name, deltas=(), error=None, delay=0):
+        self.name = name
+        self.deltas = deltas
+        self.error = error
+        self.delay = delay
+        self.calls = 0
+    def stream(self, messages, model=None, **params):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        yield from self.deltas
+    def generate(self, messages, model=None, **params):
+        return Generation(''.join(d.text for d in self.stream(messages, model)), 'STOP')
+
+class FakeBreaker:
+    def __init__(self, allowed=True):
+        self.allowed = allowed
+        self.events = []
+        self.checks = 0
+    def call_allowed(self):
+        self.checks += 1
+        return self.allowed
+    def record_success(self):
+        self.events.append('success')
+    def record_failure(self):
+        self.events.append('failure')
+
+def make_router(primary, fallback, breakers, **kwargs):
+    targets = [GenerationTarget(primary, 'primario'), GenerationTarget(fallback, 'riserva')]
+    return GenerationRouter(lambda model: targets, lambda op, model: breakers[model], **kwargs)
+
+def test_failover_on_rate_limit():
+    """Test: 429 dal primario -> risposta dal provider di riserva, fallimento registrato nel breaker"""
+    primary = FakeProvider('gemini', error=ProviderError('quota', 429))
+    fallback = FakeProvider('deepseek', [Generation('Ciao', 'STOP')])
+    breakers = {'primario': FakeBreaker(), 'riserva': FakeBreaker()}
+    router = make_router(primary, fallback, breakers)
+
+    routed = router.stream('stream', router.acquire('stream'), [])
+    assert list(routed) == [Generation('Ciao', 'STOP')]
+    assert routed.target.provider is fallback
+    assert breakers['primario'].events == ['failure'] and breakers['riserva'].events == ['success']
+
+    # Errori non transitori non passano alla riserva
+    primary.error = ProviderError('richiesta non valida', 400)
+    with pytest.raises(ProviderError):
+        router.generate('generate', router.acquire('generate'), [])
+    assert fallback.calls == 1
+
+def test_open_breaker_skips_provider():
+    """Test: breaker aperto -> il primario non viene chiamato; tutti aperti -> NoProviderAvailable"""
+    primary = FakeProvider('gemini', [Generation('no', 'STOP')])
+    fallback = FakeProvider('deepseek', [Generation('sì', 'STOP')])
+    breakers = {'primario': FakeBreaker(allowed=False), 'riserva': FakeBreaker()}
+    router = make_router(primary, fallback, breakers)
+
+    result, target = router.generate('generate', router.acquire('generate'), [])
+    assert result.text == 'sì' and target.model == 'riserva'
+    assert primary.calls == 0
+
+    breakers['riserva'].allowed = False
+    with pytest.raises(NoProviderAvailable):
+        list(router.stream('stream', router.acquire('stream'), []))
+
+def test_hedged_request_uses_fastest_provider():
+    """Test: primario lento oltre la soglia -> parte la riserva e la sua risposta vince"""
+    primary = FakeProvider('gemini', [Generation('lento', 'STOP')], delay=1.0)
+    fallback = FakeProvider('deepseek', [Generation('veloce', None), Generation('!', 'STOP')])
+    breakers = {'primario': FakeBreaker(), 'riserva': FakeBreaker()}
+    router = make_router(primary, fallback, breakers, hedge_percentile=95, hedge_min_delay=0.1)
+
+    start = time.time()
+    routed = router.stream('stream', router.acquire('stream'), [])
+    assert [d.text for d in routed] == ['veloce', '!']
+    assert time.time() - start < 0.8
+    assert routed.hedged is True and routed.target.provider is fallback
+    # La latenza del primario battuto viene comunque campionata (almeno la soglia di hedging)
+    assert len(router.tracker('stream')) == 1
+    assert router.tracker('stream').percentile(50) >= 0.1
+
+def test_fallback_breaker_checked_only_when_needed():
+    """Test: se il primario risponde il breaker della riserva non viene consultato (nessuna prova HALF_OPEN consumata)"""
+    primary = FakeProvider('gemini', [Generation('ok', 'STOP')])
+    fallback = FakeProvider('deepseek', [Generation('riserva', 'STOP')])
+    breakers = {'primario': FakeBreaker(), 'riserva': FakeBreaker()}
+    router = make_router(primary, fallback, breakers)
+
+    assert router.generate('generate', router.acquire('generate'), [])[0].text == 'ok'
+    assert breakers['riserva'].checks == 0
+
+    hedging = make_router(primary, fallback, breakers, hedge_percentile=95, hedge_min_delay=0.5)
+    assert [d.text for d in hedging.stream('stream', hedging.acquire('stream'), [])] == ['ok']
+    assert breakers['riserva'].checks == 0
+
+    # Failover verso una riserva con il breaker aperto: l'errore del primario arriva al chiamante
+    primary.error = ProviderError('quota', 429)
+    breakers['riserva'].allowed = False
+    with pytest.raises(ProviderError):
+        router.generate('generate', router.acquire('generate'), [])
+    assert breakers['riserva'].checks == 1 and fallback.calls == 0
+
+def test_latency_tracker_percentile():
+    """Test: percentile nearest rank sulla finestra scorrevole"""
+    tracker = LatencyTracker(window=100)
+    assert tracker.percentile(95) is None
+    for value in range(1, 201):
+        tracker.record(value / 100)
+    assert len(tracker) == 100
+    assert tracker.percentile(50) == 1.5 and tracker.percentile(95) == 1.95
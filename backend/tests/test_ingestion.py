@@ -0,0 +1,132 @@
+"""
+Test per il caricamento massivo
+"""
+import sys
+import os
+import time
+import zipfile
+
+import pytest
+import requests
+
+# Aggiungi la directory backend al path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ingestion import IngestionJobManager, ArchiveLimitError, extract_archive
+
+def wait_done(manager, job_id, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        status = manager.get_status(job_id)
+        if status['state'] == 'DONE':
+            return status
+        time.sleep(0.02)
+    raise AssertionError('job non completato')
+
+def test_extract_archive_flattens_paths(tmp_path):
+    """Test: i percorsi interni dell'archivio non escono dalla cartella di destinazione"""
+    archive_path = tmp_path / 'docs.zip'
+    with zipfile.ZipFile(archive_path, 'w') as archive:
+        archive.writestr('../../evil.txt', 'x')
+        archive.writestr('cartella/relazione.md', '# titolo')
+        archive.writestr('cartella/', '')
+    target = tmp_path / 'out'
+    target.mkdir()
+
+    extracted = extract_archive(str(archive_path), str(target))
+    assert [name for _, name in extracted] == ['evil.txt', 'relazione.md']
+    assert all(os.path.dirname(path) == str(target) for path, _ in extracted)
+
+def test_extract_archive_rejects_archives_over_limits(tmp_path):
+    """Test: archivi oltre il numero di file o i byte estratti vengono rifiutati, non troncati"""
+    archive_path = tmp_path / 'docs.zip'
+    with zipfile.ZipFile(archive_path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for i in range(3):
+            archive.writestr(f'doc{i}.txt', '0' * 1000)
+    target = tmp_path / 'out'
+    target.mkdir()
+
+    with pytest.raises(ArchiveLimitError):
+        extract_archive(str(archive_path), str(target), max_files=2)
+    with pytest.raises(ArchiveLimitError):
+        extract_archive(str(archive_path), str(target), max_bytes=2999)
+    assert os.listdir(target) == []
+    assert len(extract_archive(str(archive_path), str(target), max_files=3, max_bytes=3000)) == 3
+
+def test_job_retries_after_429_and_reports_progress(tmp_path):
+    """Test: un 429 viene ritentato dopo Retry-After e l'avanzamento è aggregato"""
+    calls = {'a.txt': 0}
+
+    def fake_upload(path, filename, metadata):
+        if filename == 'a.txt':
+            calls['a.txt'] += 1
+            if calls['a.txt'] == 1:
+                response = requests.Response()
+                response.status_code = 429
+                response.headers['Retry-After'] = '0'
+                raise requests.exceptions.HTTPError(response=response)
+        if filename == 'rotto.txt':
+            raise RuntimeError('errore simulato')
+        return {'name': f'operations/{filename}'}
+
+    manager = IngestionJobManager(fake_upload, str(tmp_path / 'jobs'), max_workers=2)
+    job_id, job_dir = manager.new_job_dir()
+    items = []
+    for name in ('a.txt', 'b.txt', 'rotto.txt'):
+        path = os.path.join(job_dir, name)
+        with open(path, 'w') as f:
+            f.write(name)
+        items.append((path, name, {'displayName': name}))
+
+    manager.submit(job_id, job_dir, items, skipped=[('foto.png', 'Tipo di file non permesso')])
+    status = wait_done(manager, job_id)
+
+    assert (status['uploaded'], status['failed'], status['skipped']) == (2, 1, 1)
+    assert calls['a.txt'] == 2
+    assert not os.path.exists(job_dir)
+
+    # Un altro processo legge lo stato dal file JSON
+    other = IngestionJobManager(fake_upload, str(tmp_path / 'jobs'))
+    assert other.get_status(job_id)['uploaded'] == 2
+
+def test_failing_on_uploaded_keeps_item_uploaded_and_releases_once(tmp_path):
+    """Test: un errore in on_uploaded non marca FAILED il file e non rilascia due volte il limiter"""
+    def failing_on_uploaded(operation_data):
+        raise RuntimeError('registrazione fallita')
+
+    manager = IngestionJobManager(lambda path, filename, metadata: {'name': f'operations/{filename}'},
+                                  str(tmp_path / 'jobs'), max_workers=2, on_uploaded=failing_on_uploaded)
+    job_id, job_dir = manager.new_job_dir()
+    path = os.path.join(job_dir, 'a.txt')
+    with open(path, 'w') as f:
+        f.write('a')
+
+    manager.submit(job_id, job_dir, [(path, 'a.txt', {'displayName': 'a.txt'})])
+    status = wait_done(manager, job_id)
+
+    assert (status['uploaded'], status['failed']) == (1, 0)
+    assert status['items'][0]['status'] == 'UPLOADED'
+    assert manager.limiter.active == 0
+
+def test_job_status_saves_are_throttled(tmp_path, monkeypatch):
+    """Test: lo stato su disco non viene riscritto a ogni transizione, ma quello finale è sempre salvato"""
+    manager = IngestionJobManager(lambda path, filename, metadata: {'name': f'operations/{filename}'},
+                                  str(tmp_path / 'jobs'), max_workers=2, save_interval=3600)
+    saves = []
+    original_save = manager._save
+    monkeypatch.setattr(manager, '_save', lambda job_id: saves.append(job_id) or original_save(job_id))
+
+    job_id, job_dir = manager.new_job_dir()
+    items = []
+    for i in range(20):
+        path = os.path.join(job_dir, f'{i}.txt')
+        with open(path, 'w') as f:
+            f.write(str(i))
+        items.append((path, f'{i}.txt', {'displayName': f'{i}.txt'}))
+
+    manager.submit(job_id, job_dir, items)
+    wait_done(manager, job_id)
+
+    assert len(saves) == 2  # avvio e fine del job
+    other = IngestionJobManager(lambda *args: {}, str(tmp_path / 'jobs'))
+    assert other.get_status(job_id)['uploaded'] == 20
@@ -0,0 +1,66 @@
+"""
+Test per l'indice lessicale locale dei documenti
+"""
+import sys
+import os
+
+# Aggiungi la directory backend al path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lexical_index import LexicalIndex, PENDING_PREFIX
+
+def make_index(tmp_path):
+    index = LexicalIndex(str(tmp_path / 'lexical.sqlite3'))
+    index.add_texts('doc/contratti', ['Penale per ritardo nella consegna del cantiere', 'Durata del contratto'], complete=True)
+    index.add_texts('doc/sicurezza', ['Piano di sicurezza del cantiere e dispositivi di protezione'], complete=True)
+    index.add_texts('doc/ferie', ['Richiesta ferie e permessi del personale'], complete=True)
+    return index
+
+def test_select_documents_keeps_best_and_unindexed(tmp_path):
+    """Test: top_k documenti per BM25 più quelli mai indicizzati"""
+    index = make_index(tmp_path)
+    documents = [{'name': n} for n in ('doc/contratti', 'doc/sicurezza', 'doc/ferie', 'doc/nuovo')]
+
+    selected = index.select_documents('Qual è la penale per ritardo?', documents, top_k=1)
+    assert [d['name'] for d in selected] == ['doc/contratti', 'doc/nuovo']
+
+    # Nessun termine noto: nessuna preselezione
+    assert index.select_documents('fatturazione elettronica', documents, top_k=1) == documents
+
+def test_select_documents_keeps_partially_indexed(tmp_path):
+    """Test: un documento di cui sono noti solo alcuni chunk non viene escluso finché non è completo"""
+    index = make_index(tmp_path)
+    index.add_texts('doc/verbali', ['Verbale della riunione di cantiere'])
+    documents = [{'name': n} for n in ('doc/contratti', 'doc/sicurezza', 'doc/verbali')]
+
+    selected = index.select_documents('penale per ritardo', documents, top_k=1)
+    assert [d['name'] for d in selected] == ['doc/contratti', 'doc/verbali']
+
+    index.mark_complete('doc/verbali')
+    selected = index.select_documents('penale per ritardo', documents, top_k=1)
+    assert [d['name'] for d in selected] == ['doc/contratti']
+
+def test_texts_counted_once_and_persisted(tmp_path):
+    """Test: lo stesso chunk visto più volte non altera le frequenze; l'indice sopravvive al riavvio"""
+    index = make_index(tmp_path)
+    assert index.add_texts('doc/ferie', ['Richiesta ferie e permessi del personale']) == 0
+    before = index.scores('ferie')
+
+    reopened = LexicalIndex(str(tmp_path / 'lexical.sqlite3'))
+    assert reopened.scores('ferie') == before
+    assert reopened.stats()['documents'] == 3
+
+def test_upload_text_moves_to_document_and_delete(tmp_path):
+    """Test: testo registrato sotto l'operazione di upload, poi assegnato al documento ed eliminato"""
+    index = make_index(tmp_path)
+    index.add_texts(PENDING_PREFIX + 'operations/op1', ['Verbale di collaudo delle opere strutturali'], complete=True)
+    assert index.scores('collaudo') == {}
+
+    index.rename(PENDING_PREFIX + 'operations/op1', 'doc/collaudo')
+    assert set(index.scores('collaudo')) == {'doc/collaudo'}
+    assert 'doc/collaudo' in index.complete_documents()
+
+    index.remove('doc/collaudo')
+    assert index.scores('collaudo') == {}
+    assert 'doc/collaudo' not in index.indexed_documents()
+    assert 'doc/collaudo' not in index.complete_documents()
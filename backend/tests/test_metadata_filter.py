@@ -0,0 +1,52 @@
+"""
+Test per il filtro sui metadati custom dei documenti
+"""
+import sys
+import os
+
+import pytest
+
+# Aggiungi la directory backend al path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metadata_filter import MetadataIndex, MetadataFilterError, parse_filter
+
+DOCUMENTS = [
+    {'name': 'd1', 'customMetadata': [{'key': 'cantiere', 'stringValue': 'Milano Nord'}, {'key': 'anno', 'stringValue': '2022'}]},
+    {'name': 'd2', 'customMetadata': [{'key': 'cantiere', 'stringValue': 'Torino'}, {'key': 'anno', 'numericValue': 2024}]},
+    {'name': 'd3', 'customMetadata': [{'key': 'tipo', 'stringListValue': {'values': ['contratto', 'allegato']}}]},
+    {'name': 'd4'},
+]
+NAMES = [d['name'] for d in DOCUMENTS]
+
+def make_index():
+    index = MetadataIndex()
+    index.rebuild(DOCUMENTS)
+    return index
+
+def test_equality_ranges_and_boolean_operators():
+    """Test: uguaglianza senza maiuscole, confronti numerici, AND/OR/NOT e parentesi"""
+    index = make_index()
+    assert index.matching(parse_filter('cantiere = "milano nord"'), NAMES) == {'d1'}
+    assert index.matching(parse_filter('anno >= 2023'), NAMES) == {'d2'}
+    assert index.matching(parse_filter('anno = 2024.0 OR tipo = contratto'), NAMES) == {'d2', 'd3'}
+    assert index.matching(parse_filter('NOT (cantiere = Torino or anno < 2023)'), NAMES) == {'d3', 'd4'}
+    assert index.matching(parse_filter('cantiere != Torino AND anno > 2000'), NAMES) == {'d1'}
+    # Solo tra i documenti indicati (es. i soli attivi)
+    assert index.matching(parse_filter('anno > 2000'), ['d2', 'd3']) == {'d2'}
+
+def test_index_follows_catalog_updates():
+    """Test: upsert e remove aggiornano l'indice senza ricostruirlo"""
+    index = make_index()
+    index.upsert({'name': 'd1', 'customMetadata': [{'key': 'cantiere', 'stringValue': 'Torino'}]})
+    assert index.matching(parse_filter('cantiere = Torino'), NAMES) == {'d1', 'd2'}
+    assert index.matching(parse_filter('anno = 2022'), NAMES) == set()
+    index.remove('d2')
+    assert index.matching(parse_filter('cantiere = Torino'), NAMES) == {'d1'}
+    assert index.stats() == {'documents': 3, 'keys': 2}
+
+@pytest.mark.parametrize('expression', ['', 'cantiere', 'cantiere = ', '(anno > 1', 'anno > 1 AND', 'a = 1 b = 2', 'x' * 600])
+def test_invalid_expressions(expression):
+    """Test: espressioni malformate rifiutate con MetadataFilterError"""
+    with pytest.raises(MetadataFilterError):
+        parse_filter(expression)
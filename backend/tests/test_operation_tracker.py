@@ -0,0 +1,87 @@
+"""
+Test per il tracker delle operazioni di upload
+"""
+import sys
+import os
+import threading
+
+# Aggiungi la directory backend al path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from operation_tracker import OperationTracker
+
+def test_tracker_polls_in_background_and_notifies_waiters():
+    """Test: il polling upstream avviene in background e i client in attesa vengono svegliati"""
+    polls = {'op1': 0}
+    done_events = []
+
+    def fake_fetch(name):
+        polls[name] += 1
+        return {'name': name, 'done': polls[name] >= 2}
+
+    tracker = OperationTracker(fake_fetch, on_done=done_events.append, min_interval=0.01, max_interval=0.05)
+    tracker.register('op1', {'name': 'op1', 'done': False})
+
+    version = 0
+    seen_done = False
+    for _ in range(20):
+        version, changed = tracker.wait_for_changes(['op1'], version, timeout=1)
+        if changed.get('op1', {}).get('done'):
+            seen_done = True
+            break
+
+    assert seen_done
+    assert tracker.all_done(['op1'])
+    # Callback di completamento invocata una sola volta; nessun polling dopo il completamento
+    assert len(done_events) == 1
+    polls_after_done = polls['op1']
+    threading.Event().wait(0.1)
+    assert polls['op1'] == polls_after_done
+
+def test_tracker_many_clients_do_not_add_upstream_calls():
+    """Test: le letture dei client non generano chiamate upstream"""
+    calls = []
+    tracker = OperationTracker(lambda name: calls.append(name) or {'name': name, 'done': True})
+    tracker.refresh('op2')
+    for _ in range(100):
+        assert tracker.get('op2')['done'] is True
+    assert calls == ['op2']
+
+def test_tracker_abandons_missing_and_failing_operations():
+    """Test: 404 e polling falliti di fila chiudono l'operazione con errore e fermano il polling"""
+    import requests
+
+    calls = {'missing': 0, 'flaky': 0}
+    def fake_fetch(name):
+        calls[name] += 1
+        response = requests.Response()
+        response.status_code = 404 if name == 'missing' else 503
+        raise requests.exceptions.HTTPError('errore simulato', response=response)
+
+    done_events = []
+    tracker = OperationTracker(fake_fetch, on_done=done_events.append, min_interval=0.01, max_interval=0.02, max_failures=3)
+    tracker.register('missing')
+    tracker.register('flaky')
+
+    version = 0
+    closed = {}
+    for _ in range(50):
+        version, changed = tracker.wait_for_changes(['missing', 'flaky'], version, timeout=1)
+        closed.update(changed)
+        if tracker.all_done(['missing', 'flaky']):
+            break
+
+    assert closed['missing']['error']['message'] == 'Operazione non trovata'
+    assert 'error' in closed['flaky']
+    assert calls == {'missing': 1, 'flaky': 3}
+    assert done_events == [] and tracker.stats()['abandoned'] == 2
+
+def test_tracker_abandons_operations_past_max_age():
+    """Test: un'operazione mai completata viene chiusa dopo l'età massima"""
+    tracker = OperationTracker(lambda name: {'name': name, 'done': False}, min_interval=0.01, max_interval=0.02, max_age_seconds=0.05)
+    tracker.register('op')
+    for _ in range(50):
+        if tracker.all_done(['op']):
+            break
+        threading.Event().wait(0.02)
+    assert 'error' in tracker.get('op')
@@ -0,0 +1,87 @@
+"""
+Test per la costruzione del prompt di generazione
+"""
+import sys
+import os
+
+# Aggiungi la directory backend al path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prompt_builder import estimate_tokens, select_chunks, prepare_generation, compact_chunks, get_chunk_text
+
+def make_chunk(text, score, source='doc.pdf'):
+    return {'chunk': {'data': {'stringValue': text}}, 'chunkRelevanceScore': score, 'source_document': source}
+
+def test_estimate_tokens():
+    """Test: la stima cresce con parole e punteggiatura"""
+    assert estimate_tokens('') == 0
+    assert estimate_tokens('Ciao, mondo!') == 4
+    assert estimate_tokens('precipitevolissimevolmente') > 1
+
+def test_select_chunks_respects_token_budget():
+    """Test: i chunk migliori entrano finché c'è budget; quelli troppo grandi vengono saltati"""
+    chunks = [
+        make_chunk('parola ' * 50, 0.9),
+        make_chunk('parola ' * 500, 0.8),  # non entra nel budget
+        make_chunk('parola ' * 30, 0.7),
+        make_chunk('parola ' * 10, 0.1),   # sotto soglia
+    ]
+    selected, high_score_count, tokens = select_chunks(chunks, min_score=0.3, max_chunks=10, token_budget=100)
+    assert [c['chunkRelevanceScore'] for c in selected] == [0.9, 0.7]
+    assert high_score_count == 3
+    assert tokens <= 100
+
+def test_select_chunks_fallback_below_threshold():
+    """Test: se nessun chunk supera la soglia usa comunque i migliori, fino a max_chunks"""
+    chunks = [make_chunk(f'testo {i}', 0.1 * i) for i in range(3)]
+    selected, high_score_count, _ = select_chunks(chunks, min_score=0.9, max_chunks=2, token_budget=1000)
+    assert high_score_count == 0
+    assert [c['chunkRelevanceScore'] for c in selected] == [0.2, 0.1]
+
+def test_prepare_generation_prompt_layout():
+    """Test: il prompt contiene contesto, domande precedenti uniche e domanda corrente"""
+    history = [
+        {'role': 'user', 'text': 'Prima domanda'},
+        {'role': 'assistant', 'text': 'Risposta che non deve comparire'},
+        {'role': 'user', 'text': 'Prima domanda'},
+    ]
+    result = prepare_generation('Domanda attuale', [make_chunk('Contenuto rilevante', 0.9)], history,
+                                min_score=0.3, max_chunks=15, token_budget=8000, max_history=2)
+    prompt = result['prompt']
+    assert '[Frammento 1 da doc.pdf]:\nContenuto rilevante' in prompt
+    assert prompt.count('Prima domanda') == 1
+    assert 'Risposta che non deve comparire' not in prompt
+    assert prompt.endswith('DOMANDA CORRENTE: Domanda attuale\n\nRISPOSTA:')
+    assert result['prompt_tokens'] > result['context_tokens'] > 0
+
+WORDS = [f"parola{i}" for i in range(60)]
+
+def test_compact_chunks_merges_adjacent_overlap():
+    """Test: due chunk adiacenti dello stesso documento vengono fusi senza ripetere l'overlap"""
+    first = make_chunk(' '.join(WORDS[:35]), 0.6)
+    # Il secondo chunk inizia con una parola tagliata e ripete le ultime 12 parole del primo
+    second = make_chunk('ola22 ' + ' '.join(WORDS[23:60]), 0.8)
+    other_doc = make_chunk(' '.join(WORDS[20:60]), 0.5, source='altro.pdf')
+
+    compacted = compact_chunks([first, second], dedup_threshold=0.9, shingle_words=8)
+    assert len(compacted) == 1
+    assert get_chunk_text(compacted[0]).split() == WORDS
+    assert compacted[0]['chunkRelevanceScore'] == 0.8
+
+    # Documenti diversi non vengono fusi
+    assert len(compact_chunks([first, other_doc], dedup_threshold=0.9, shingle_words=8)) == 2
+
+def test_compact_chunks_drops_near_duplicates():
+    """Test: un chunk contenuto in un altro viene scartato, tenendo il testo più ampio e lo score migliore"""
+    full = make_chunk(' '.join(WORDS[:40]), 0.4, source='a.pdf')
+    contained = make_chunk(' '.join(WORDS[5:30]).upper() + '!', 0.9, source='b.pdf')
+    different = make_chunk('testo completamente diverso ' * 5, 0.5, source='a.pdf')
+
+    compacted = compact_chunks([full, contained, different], dedup_threshold=0.9, shingle_words=8)
+    texts = [get_chunk_text(c) for c in compacted]
+    assert len(compacted) == 2
+    assert texts[0] == ' '.join(WORDS[:40])
+    assert compacted[0]['chunkRelevanceScore'] == 0.9
+
+    # Soglia 0: compattazione disattivata
+    assert len(compact_chunks([full, contained], dedup_threshold=0)) == 2
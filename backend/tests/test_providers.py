@@ -0,0 +1,96 @@
+"""
+Test per il registro dei provider di generazione
+"""
+import sys
+import os
+import json
+from contextlib import nullcontext
+from types import SimpleNamespace
+
+import pytest
+
+# Aggiungi la directory backend al path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from providers import ProviderRegistry, GeminiProvider, OpenAICompatibleProvider, ProviderError, Generation
+from retry_policy import RetryPolicy
+
+def test_registry_reuses_provider_instances():
+    """Test: ogni provider viene istanziato una sola volta"""
+    created = []
+    registry = ProviderRegistry()
+    registry.register('finto', lambda: created.append(1) or OpenAICompatibleProvider('finto', 'k', 'm'))
+    assert registry.get('finto') is registry.get('finto')
+    assert len(created) == 1
+    with pytest.raises(ValueError):
+        registry.get('sconosciuto')
+
+class FakeResponse:
+    def __init__(self, status_code, body=b''):
+        self.status_code = status_code
+        self.body = body
+        self.headers = {}
+        self.closed = False
+    def raise_for_status(self):
+        import requests
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f'{self.status_code}', response=self)
+    def iter_content(self, chunk_size=None):
+        yield self.body
+    def close(self):
+        self.closed = True
+
+def test_gemini_stream_retries_and_parses_events():
+    """Test: 503 ritentato, poi eventi SSE convertiti in frammenti con finishReason"""
+    events = [
+        {'candidates': [{'content': {'parts': [{'text': 'Buon'}]}}]},
+        {'candidates': [{'content': {'parts': [{'text': 'giorno'}]}, 'finishReason': 'STOP'}]},
+    ]
+    body = b''.join(b'data: ' + json.dumps(e).encode() + b'\r\n\r\n' for e in events)
+    responses = [FakeResponse(503), FakeResponse(200, body)]
+    payloads = []
+
+    def fake_post(url, headers=None, json=None, **kwargs):
+        payloads.append(json)
+        return responses.pop(0)
+
+    provider = GeminiProvider(SimpleNamespace(post=fake_post), 'http://gemini', dict, 'modello',
+                              retry_policy=RetryPolicy(base_delay=0))
+    deltas = list(provider.stream([{'role': 'user', 'content': 'Ciao'}, {'role': 'assistant', 'content': 'x'}]))
+    assert deltas == [Generation('Buon', None), Generation('giorno', 'STOP')]
+    assert len(payloads) == 2
+    assert [c['role'] for c in payloads[0]['contents']] == ['user', 'model']
+
+def test_gemini_errors_become_provider_error():
+    """Test: un 429 persistente diventa ProviderError con status code"""
+    provider = GeminiProvider(SimpleNamespace(post=lambda *a, **k: FakeResponse(429)), 'http://gemini', dict, 'm',
+                              retry_policy=RetryPolicy(max_attempts=2, base_delay=0))
+    with pytest.raises(ProviderError) as excinfo:
+        provider.generate([{'role': 'user', 'content': 'Ciao'}])
+    assert excinfo.value.status_code == 429
+
+def test_openai_compatible_stream_uses_pooled_client():
+    """Test: lo streaming OpenAI normalizza i frammenti e riusa lo stesso client"""
+    calls = []
+
+    class FakeStream(list):
+        def close(self):
+            pass
+
+    def create(**kwargs):
+        calls.append(kwargs)
+        return FakeStream([
+            SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content='Ciao'), finish_reason=None)]),
+            SimpleNamespace(choices=[]),
+            SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=None), finish_reason='length')]),
+        ])
+
+    provider = OpenAICompatibleProvider('deepseek', 'chiave', 'deepseek-chat')
+    provider._client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    # SDK openai non necessario per il test
+    provider._errors = nullcontext
+
+    for _ in range(2):
+        deltas = list(provider.stream([{'role': 'user', 'content': 'Domanda'}], max_tokens=100))
+        assert deltas == [Generation('Ciao', None), Generation('', 'MAX_TOKENS')]
+    assert len(calls) == 2 and calls[0]['stream'] is True and calls[0]['model'] == 'deepseek-chat'
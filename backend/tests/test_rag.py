@@ -120,3 +120,454 @@ def test_chunks_page(client):
     """Test: chunks page carica"""
     response = client.get('/chunks')
     assert response.status_code == 200
+
+def test_query_documents_parallel_merges_partial_results(monkeypatch):
+    """Test: il fan-out unisce i risultati e ignora documenti in errore o oltre la deadline"""
+    import time
+    import app as app_module
+
+    def fake_query(doc, query_text, results_count):
+        if doc['name'] == 'lento':
+            time.sleep(1)
+        if doc['name'] == 'rotto':
+            raise RuntimeError('errore simulato')
+        return [{'chunkRelevanceScore': 0.5, 'source_document': doc['name']}]
+
+    monkeypatch.setattr(app_module, 'query_single_document', fake_query)
+    monkeypatch.setattr(app_module, 'QUERY_FANOUT_DEADLINE', 0.3)
+
+    documents = [{'name': 'a'}, {'name': 'b'}, {'name': 'rotto'}, {'name': 'lento'}]
+    chunks = app_module.query_documents_parallel(documents, 'test', 3)
+    assert sorted(c['source_document'] for c in chunks) == ['a', 'b']
+
+def test_document_catalog_walks_all_pages(monkeypatch):
+    """Test: il catalogo segue nextPageToken e filtra i documenti attivi"""
+    import app as app_module
+
+    pages = {
+        '': {'documents': [{'name': 'd1', 'state': 'STATE_ACTIVE'}], 'nextPageToken': 'p2'},
+        'p2': {'documents': [{'name': 'd2', 'state': 'STATE_PENDING'},
+                             {'name': 'd3', 'state': 'STATE_ACTIVE'}]},
+    }
+
+    class FakeResponse:
+        status_code = 200
+        def __init__(self, data):
+            self.data = data
+        def raise_for_status(self):
+            pass
+        def json(self):
+            return self.data
+
+    calls = []
+    def fake_get(url, headers=None, params=None, timeout=None):
+        calls.append(params.get('pageToken', ''))
+        return FakeResponse(pages[params.get('pageToken', '')])
+
+    monkeypatch.setattr(app_module.http_session, 'get', fake_get)
+    catalog = app_module.DocumentCatalog(ttl_seconds=60)
+
+    assert [d['name'] for d in catalog.get_active_documents()] == ['d1', 'd3']
+    assert calls == ['', 'p2']
+
+    # Catalogo fresco: nessuna nuova chiamata
+    catalog.get_active_documents()
+    assert len(calls) == 2
+
+    catalog.remove('d1')
+    assert [d['name'] for d in catalog.get_active_documents()] == ['d3']
+
+    catalog.invalidate()
+    catalog.get_active_documents()
+    assert len(calls) == 4
+
+def test_query_cache_lru_eviction_and_stats():
+    """Test: la cache rispetta il limite di voci con evizione LRU"""
+    from app import QueryCache
+
+    cache = QueryCache(ttl_seconds=60, max_entries=2)
+    cache.set('a', {'v': 1})
+    cache.set('b', {'v': 2})
+    assert cache.get('a') == {'v': 1}  # 'a' diventa la più recente
+    cache.set('c', {'v': 3})  # evince 'b'
+
+    assert cache.get('b') is None
+    assert cache.get('c') == {'v': 3}
+    stats = cache.stats()
+    assert stats['entries'] == 2
+    assert stats['evictions'] == 1
+    assert stats['hits'] == 2
+    assert stats['misses'] == 1
+
+def test_query_cache_expiry_and_byte_budget():
+    """Test: le voci scadute vengono rimosse e il budget in byte è rispettato"""
+    from app import QueryCache
+
+    cache = QueryCache(ttl_seconds=0, max_entries=10)
+    cache.set('old', {'v': 1})
+    cache.set('new', {'v': 2})  # la scrittura rimuove le voci scadute
+    assert cache.stats()['expirations'] >= 1
+
+    cache = QueryCache(ttl_seconds=60, max_entries=10, max_bytes=80)
+    cache.set('a', {'text': '0123456789abcdefghij'})
+    cache.set('b', {'text': 'klmnopqrstuvwxyzABCD'})
+    cache.set('c', {'text': 'EFGHIJKLMNOPQRSTUVWX'})
+    assert cache.stats()['bytes'] <= 80
+    assert cache.get('a') is None
+    big_text = ''.join(chr(0x4e00 + (i * 7919) % 2000) for i in range(200))
+    cache.set('big', {'text': big_text})  # più grande dell'intero budget: ignorato
+    assert cache.get('big') is None
+
+def test_upload_streaming_forwards_body_without_temp_file(client, monkeypatch):
+    """Test: l'upload in streaming inoltra metadati e contenuto in un unico body generato"""
+    import io
+    import json
+    import app as app_module
+
+    captured = {}
+
+    class FakeResponse:
+        status_code = 200
+        def raise_for_status(self):
+            pass
+        def json(self):
+            return {'name': 'fileSearchStores/s/upload/operations/op1'}
+
+    def fake_post(url, headers=None, data=None, **kwargs):
+        captured['content_type'] = headers['Content-Type']
+        captured['body'] = b''.join(data)
+        return FakeResponse()
+
+    monkeypatch.setattr(app_module.http_session, 'post', fake_post)
+
+    content = b'riga di testo\n' * 1000
+    response = client.post('/api/documents/upload?stream=1', data={
+        'displayName': 'Documento di prova',
+        'chunkSize': '256',
+        'metadataKeys[]': ['cantiere'],
+        'metadataValues[]': ['X'],
+        'file': (io.BytesIO(content), 'prova.txt'),
+    }, content_type='multipart/form-data')
+
+    assert response.status_code == 200
+    assert response.get_json()['operationName'].endswith('op1')
+
+    boundary = captured['content_type'].split('boundary=')[1]
+    body = captured['body']
+    assert content in body
+    assert body.endswith(f'--{boundary}--\r\n'.encode())
+    metadata = json.loads(body.split(b'\r\n\r\n', 1)[1].split(b'\r\n', 1)[0])
+    assert metadata['displayName'] == 'Documento di prova'
+    assert metadata['customMetadata'] == [{'key': 'cantiere', 'stringValue': 'X'}]
+    assert metadata['chunkingConfig']['whiteSpaceConfig']['maxTokensPerChunk'] == 256
+
+def test_bulk_upload_requires_files(client):
+    """Test: il caricamento massivo senza file risponde 400"""
+    response = client.post('/api/documents/bulk-upload', data={}, content_type='multipart/form-data')
+    assert response.status_code == 400
+
+def test_bulk_upload_rejects_archive_over_file_cap(client, monkeypatch):
+    """Test: un archivio con più file del limite viene rifiutato (nessun file scartato in silenzio)"""
+    import io
+    import zipfile
+    import app as app_module
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for i in range(3):
+            archive.writestr(f'doc{i}.txt', 'testo')
+    buffer.seek(0)
+
+    submitted = []
+    monkeypatch.setattr(app_module, 'BULK_UPLOAD_MAX_FILES', 2)
+    monkeypatch.setattr(app_module.ingestion_manager, 'submit', lambda *args: submitted.append(args))
+    response = client.post('/api/documents/bulk-upload', data={'archive': (buffer, 'docs.zip')}, content_type='multipart/form-data')
+    assert response.status_code == 400
+    assert 'max 2' in response.get_json()['error']
+    assert submitted == []
+
+def test_bulk_upload_rejects_too_many_files_before_saving(client, monkeypatch):
+    """Test: oltre BULK_UPLOAD_MAX_FILES la richiesta viene rifiutata senza creare la cartella del job"""
+    import io
+    import app as app_module
+
+    created = []
+    monkeypatch.setattr(app_module, 'BULK_UPLOAD_MAX_FILES', 2)
+    monkeypatch.setattr(app_module.ingestion_manager, 'new_job_dir', lambda: created.append(True))
+    files = [(io.BytesIO(b'testo'), f'doc{i}.txt') for i in range(3)]
+    response = client.post('/api/documents/bulk-upload', data={'files[]': files}, content_type='multipart/form-data')
+    assert response.status_code == 400
+    assert 'max 2' in response.get_json()['error']
+    assert created == []
+
+def test_bulk_upload_status_rejects_invalid_job_id(client):
+    """Test: job id non valido o sconosciuto"""
+    assert client.get('/api/documents/bulk-upload/non-valido').status_code == 400
+    assert client.get('/api/documents/bulk-upload/' + '0' * 32).status_code == 404
+
+def test_retrieval_cache_keeps_symbol_queries_apart_and_echoes_query(monkeypatch):
+    """Test: C++ e C# non condividono la voce di cache; un hit esatto riporta la query del chiamante"""
+    import app as app_module
+
+    monkeypatch.setattr(app_module, 'query_cache', app_module.QueryCache())
+    cache_key, canonical, scope, cached = app_module.retrieval_cache_lookup('C++', None, 25)
+    assert cached is None
+    app_module.retrieval_cache_store(cache_key, canonical, scope, {'success': True, 'query': 'C++', 'relevant_chunks': []})
+
+    assert app_module.retrieval_cache_lookup('C#', None, 25)[3] is None
+    assert app_module.retrieval_cache_lookup('c++?', None, 25)[3]['query'] == 'c++?'
+
+def test_generation_cache_serves_repeated_prompt(client, monkeypatch):
+    """Test: stessa domanda e stessi chunk -> una sola chiamata al modello, replay anche in streaming"""
+    import app as app_module
+    from shared_state import MemoryCacheBackend
+
+    calls = []
+
+    class FakeResponse:
+        status_code = 200
+        def raise_for_status(self):
+            pass
+        def json(self):
+            return {'candidates': [{'content': {'parts': [{'text': 'Risposta generata'}]}, 'finishReason': 'STOP'}]}
+
+    def fake_post(url, headers=None, json=None, **kwargs):
+        calls.append(url)
+        return FakeResponse()
+
+    monkeypatch.setattr(app_module.http_session, 'post', fake_post)
+    monkeypatch.setattr(app_module, 'generation_cache', app_module.QueryCache(ttl_seconds=60, backend=MemoryCacheBackend()))
+
+    body = {
+        'query': 'Qual è la scadenza del contratto?',
+        'relevant_chunks': [{'chunk': {'data': {'stringValue': 'Il contratto scade a marzo'}}, 'chunkRelevanceScore': 0.9}],
+        'model': 'modello-test'
+    }
+    first = client.post('/api/chat/generate', json=body).get_json()
+    second = client.post('/api/chat/generate', json=body).get_json()
+    assert first['response'] == second['response'] == 'Risposta generata'
+    assert 'cached' not in first and second['cached'] is True
+    assert len(calls) == 1
+
+    stream = client.post('/api/chat/generate-stream', json=body).get_data(as_text=True)
+    assert '"text": "Risposta generata"' in stream
+    assert '"cached": true' in stream
+    assert len(calls) == 1
+
+def test_ask_streams_retrieval_and_answer_with_early_start(client, monkeypatch):
+    """Test: /api/chat/ask avvia la generazione senza attendere il documento lento"""
+    import json
+    import time
+    import app as app_module
+    from shared_state import MemoryCacheBackend
+
+    def fake_query(doc, query_text, results_count):
+        if doc['name'] == 'lento':
+            time.sleep(1)
+        return [{'chunk': {'data': {'stringValue': f"Testo di {doc['name']}"}},
+                 'chunkRelevanceScore': 0.8, 'source_document': doc['name']}]
+
+    class FakeStream:
+        status_code = 200
+        def raise_for_status(self):
+            pass
+        def close(self):
+            pass
+        def iter_content(self, chunk_size=None):
+            event = {'candidates': [{'content': {'parts': [{'text': 'Ciao'}]}, 'finishReason': 'STOP'}]}
+            frame = ('data: ' + json.dumps(event) + '\r\n\r\n').encode()
+            # Evento spezzato tra due letture
+            yield frame[:10]
+            yield frame[10:]
+
+    prompts = []
+
+    def fake_post(url, headers=None, json=None, **kwargs):
+        prompts.append(json['contents'][0]['parts'][0]['text'])
+        return FakeStream()
+
+    documents = [{'name': 'a'}, {'name': 'b'}, {'name': 'lento'}]
+    monkeypatch.setattr(app_module.document_catalog, 'get_active_documents', lambda metadata_filter=None: documents)
+    monkeypatch.setattr(app_module, 'query_single_document', fake_query)
+    monkeypatch.setattr(app_module, 'ASK_EARLY_START_CHUNKS', 2)
+    monkeypatch.setattr(app_module, 'query_cache', app_module.QueryCache(ttl_seconds=60, backend=MemoryCacheBackend()))
+    monkeypatch.setattr(app_module, 'generation_cache', app_module.QueryCache(ttl_seconds=60, backend=MemoryCacheBackend()))
+    monkeypatch.setattr(app_module.http_session, 'post', fake_post)
+
+    start = time.time()
+    response = client.post('/api/chat/ask', json={'query': 'Domanda di prova', 'model': 'modello-test'})
+    events = [json.loads(line[6:]) for line in response.get_data(as_text=True).split('\n') if line.startswith('data: ')]
+    assert time.time() - start < 0.9
+
+    retrieval = events[0]['retrieval']
+    assert retrieval['early_start'] is True
+    assert retrieval['documents_searched'] == 3 and retrieval['chunks_used'] == 2
+    assert events[1] == {'text': 'Ciao'}
+    assert events[-1] == {'done': True}
+    assert 'Testo di lento' not in prompts[0]
+
+def test_query_metadata_filter_narrows_fanout(client, monkeypatch):
+    """Test: il filtro sui customMetadata restringe i documenti interrogati prima del fan-out"""
+    import time
+    import app as app_module
+    from shared_state import MemoryCacheBackend
+
+    catalog = app_module.DocumentCatalog(ttl_seconds=60)
+    catalog.last_refresh = time.time()
+    catalog.stale = False
+    for name, cantiere in (('d1', 'Milano Nord'), ('d2', 'Torino'), ('d3', 'milano nord ')):
+        catalog.upsert({'name': name, 'state': 'STATE_ACTIVE',
+                        'customMetadata': [{'key': 'cantiere', 'stringValue': cantiere}]})
+
+    queried = []
+    def fake_query(doc, query_text, results_count):
+        queried.append(doc['name'])
+        return [{'chunkRelevanceScore': 0.5, 'source_document': doc['name']}]
+
+    monkeypatch.setattr(app_module, 'document_catalog', catalog)
+    monkeypatch.setattr(app_module, 'query_single_document', fake_query)
+    monkeypatch.setattr(app_module, 'query_cache', app_module.QueryCache(ttl_seconds=60, backend=MemoryCacheBackend()))
+
+    response = client.post('/api/chat/query', json={'query': 'Penali del cantiere', 'metadata_filter': 'cantiere = "Milano Nord"'})
+    assert response.get_json()['documents_searched'] == 2
+    assert sorted(queried) == ['d1', 'd3']
+
+    response = client.post('/api/chat/query', json={'query': 'Penali del cantiere', 'metadata_filter': 'cantiere = '})
+    assert response.status_code == 400
+    response = client.post('/api/chat/query', json={'query': 'Penali del cantiere', 'metadata_filter': 'cantiere = "Genova"'})
+    assert response.status_code == 404
+
+def test_list_document_chunks_pages_and_ndjson_stream(client, monkeypatch, tmp_path):
+    """Test: enumerazione dei chunk con pageToken, streaming NDJSON, metadati dal catalogo e poi dal mirror locale"""
+    import json
+    import time
+    import app as app_module
+    from chunk_mirror import ChunkMirror
+
+    pages = {
+        '': {'chunks': [{'name': 'c1', 'data': {'stringValue': 'uno'}}, {'name': 'c2', 'data': {'stringValue': 'due'}}], 'nextPageToken': 'p2'},
+        'p2': {'chunks': [{'name': 'c3', 'data': {'stringValue': 'tre'}}]},
+    }
+
+    class FakeResponse:
+        status_code = 200
+        def __init__(self, data):
+            self.data = data
+        def raise_for_status(self):
+            pass
+        def json(self):
+            return self.data
+
+    calls = []
+    def fake_get(url, headers=None, params=None, timeout=None):
+        calls.append(url)
+        assert url.endswith('/documents/d1/chunks')
+        return FakeResponse(pages[params.get('pageToken', '')])
+
+    catalog = app_module.DocumentCatalog(ttl_seconds=60)
+    catalog.last_refresh = time.time()
+    catalog.stale = False
+    catalog.upsert({'name': 'fileSearchStores/s/documents/d1', 'displayName': 'Contratto', 'state': 'STATE_ACTIVE'})
+    monkeypatch.setattr(app_module, 'document_catalog', catalog)
+    monkeypatch.setattr(app_module, 'chunk_mirror', ChunkMirror(str(tmp_path / 'mirror')))
+    monkeypatch.setattr(app_module.http_session, 'get', fake_get)
+
+    page = client.get('/api/documents/fileSearchStores/s/documents/d1/chunks?pageSize=2').get_json()
+    assert [c['chunk']['name'] for c in page['chunks']] == ['c1', 'c2']
+    assert page['nextPageToken'] == 'p2' and page['document']['displayName'] == 'Contratto'
+
+    response = client.get('/api/documents/fileSearchStores/s/documents/d1/chunks?stream=true')
+    assert response.mimetype == 'application/x-ndjson'
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert lines[0]['document']['displayName'] == 'Contratto'
+    assert [l['chunk']['name'] for l in lines[1:-1]] == ['c1', 'c2', 'c3']
+    assert lines[-1] == {'done': True, 'totalCount': 3}
+    # Solo richieste di elenco chunk: i metadati del documento arrivano dal catalogo
+    assert len(calls) == 3
+
+    # Documento elencato per intero: le richieste successive non vanno upstream
+    app_module.local_index_executor.submit(lambda: None).result()
+    page = client.get('/api/documents/fileSearchStores/s/documents/d1/chunks?pageSize=2').get_json()
+    assert page['source'] == 'local' and page['nextPageToken'] == 'local:2'
+    assert [c['chunk']['data']['stringValue'] for c in page['chunks']] == ['uno', 'due']
+    page = client.get('/api/documents/fileSearchStores/s/documents/d1/chunks?pageSize=2&pageToken=local:2').get_json()
+    assert [c['chunk']['name'] for c in page['chunks']] == ['c3'] and page['nextPageToken'] == ''
+    assert len(calls) == 3
+
+def test_operation_done_moves_upload_text_to_document(monkeypatch, tmp_path):
+    """Test: il testo indicizzato all'upload passa al documento indicato da documentName"""
+    import app as app_module
+    from lexical_index import LexicalIndex, PENDING_PREFIX
+
+    index = LexicalIndex(str(tmp_path / 'lexical.sqlite3'))
+    monkeypatch.setattr(app_module, 'lexical_index', index)
+    index.add_texts(PENDING_PREFIX + 'fileSearchStores/s/upload/operations/op1', ['Verbale di collaudo delle opere'])
+
+    app_module.on_operation_done({
+        'name': 'fileSearchStores/s/upload/operations/op1',
+        'done': True,
+        'response': {
+            '@type': 'type.googleapis.com/google.ai.generativelanguage.v1main.UploadToFileSearchStoreResponse',
+            'parent': 'fileSearchStores/s',
+            'documentName': 'fileSearchStores/s/documents/verbale-123',
+            'mimeType': 'text/plain',
+            'sizeBytes': '31'
+        }
+    })
+    app_module.local_index_executor.submit(lambda: None).result()
+    assert index.indexed_documents() == {'fileSearchStores/s/documents/verbale-123'}
+
+def test_operations_stream_rejects_unknown_operation(client, monkeypatch):
+    """Test: un nome di operazione inesistente upstream non viene tracciato"""
+    import requests
+    import app as app_module
+
+    def fake_fetch(name):
+        response = requests.Response()
+        response.status_code = 404
+        raise requests.exceptions.HTTPError('not found', response=response)
+
+    monkeypatch.setattr(app_module.operation_tracker, 'fetch_fn', fake_fetch)
+    response = client.get('/api/operations/stream?names=fileSearchStores/s/upload/operations/inesistente')
+    assert response.status_code == 404
+    assert app_module.operation_tracker.get('fileSearchStores/s/upload/operations/inesistente') is None
+
+def test_operations_stream_closes_after_done_operation_is_pruned(client, monkeypatch):
+    """Test: lo stream si chiude anche se un'operazione conclusa esce dal tracker mentre un'altra è in corso"""
+    import json
+    import app as app_module
+    from operation_tracker import OperationTracker
+
+    tracker = OperationTracker(fetch_fn=lambda name: {'name': name}, min_interval=60, max_interval=60)
+    monkeypatch.setattr(app_module, 'operation_tracker', tracker)
+    monkeypatch.setattr(app_module, 'OPERATION_STREAM_HEARTBEAT', 0.05)
+    tracker.register('op1', {'name': 'op1', 'done': True, 'response': {}})
+    tracker.register('op2', {'name': 'op2'})
+
+    response = client.get('/api/operations/stream?names=op1,op2')
+    events = []
+    keepalives = 0
+    for chunk in response.response:
+        chunk = chunk.decode('utf-8') if isinstance(chunk, bytes) else chunk
+        if chunk.startswith(':'):
+            keepalives += 1
+            assert keepalives < 20, 'lo stream non si è chiuso'
+            continue
+        events.append(json.loads(chunk[len('data: '):]))
+        if len(events) == 1:
+            # Pulizia della retention su op1 (come in _run) e completamento di op2
+            with tracker.condition:
+                del tracker.operations['op1']
+            tracker._record('op2', {'name': 'op2', 'done': True, 'response': {}})
+
+    assert events[-1] == {'done': True}
+    assert {e.get('operationName') for e in events[:-1]} == {'op1', 'op2'}
+
+def test_generation_target_defaults_to_generation_model(monkeypatch):
+    """Test: con Gemini e nessun modello richiesto vale GENERATION_MODEL, non DEFAULT_MODEL"""
+    import app as app_module
+
+    monkeypatch.setattr(app_module, 'GENERATION_PROVIDER', 'gemini')
+    monkeypatch.setattr(app_module, 'GENERATION_MODEL', 'gemini-2.5-flash')
+    assert app_module.generation_target()[1] == 'gemini-2.5-flash'
+    assert app_module.generation_target('gemini-2.5-pro')[1] == 'gemini-2.5-pro'
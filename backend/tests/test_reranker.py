@@ -0,0 +1,51 @@
+"""
+Test per il re-ranking locale dei chunk
+"""
+import sys
+import os
+
+import numpy as np
+
+# Aggiungi la directory backend al path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from reranker import bm25_scores, per_document_normalize, rerank_chunks
+from prompt_builder import select_chunks
+
+def chunk(text, score, source):
+    return {'chunk': {'data': {'stringValue': text}}, 'chunkRelevanceScore': score, 'source_document': source}
+
+def test_bm25_prefers_rare_query_terms():
+    """Test: il testo con il termine raro della query supera quelli con soli termini comuni"""
+    texts = [
+        'Il contratto di appalto prevede una penale per ritardo',
+        'Il contratto è firmato dalle parti',
+        'Il contratto è depositato in archivio',
+    ]
+    scores = bm25_scores('penale del contratto', texts)
+    assert scores.argmax() == 0
+    assert bm25_scores('', texts).tolist() == [0, 0, 0]
+
+def test_per_document_normalization():
+    """Test: min-max per documento; documento con un solo chunk -> normalizzazione globale"""
+    scores = np.array([0.9, 0.8, 0.4, 0.35, 0.6])
+    normalized = per_document_normalize(scores, ['a', 'a', 'b', 'b', 'c'])
+    assert np.allclose(normalized[:4], [1, 0, 1, 0])
+    assert np.isclose(normalized[4], (0.6 - 0.35) / (0.9 - 0.35))
+
+def test_rerank_promotes_lexical_match_and_keeps_upstream_score():
+    """Test: il re-ranking riordina con BM25 senza alterare chunkRelevanceScore"""
+    chunks = [
+        chunk('Informazioni generali sul cantiere', 0.62, 'a'),
+        chunk('La penale per ritardo nella consegna è di 100 euro al giorno', 0.60, 'b'),
+        chunk('Orari di apertura degli uffici', 0.30, 'c'),
+    ]
+    ranked = rerank_chunks('Qual è la penale per ritardo?', chunks)
+    assert ranked[0]['source_document'] == 'b'
+    assert ranked[0]['chunkRelevanceScore'] == 0.60
+    assert ranked[0]['rerankScore'] >= ranked[1]['rerankScore'] >= ranked[2]['rerankScore']
+    assert 'rerankScore' not in chunks[0]
+
+    # La selezione per la generazione segue il rerankScore (soglia sempre sullo score upstream)
+    selected, high_score_count, _ = select_chunks(ranked, min_score=0.5, max_chunks=1, token_budget=1000)
+    assert high_score_count == 2 and selected[0]['source_document'] == 'b'
@@ -0,0 +1,102 @@
+"""
+Test per la politica di retry condivisa
+"""
+import sys
+import os
+
+import requests
+
+# Aggiungi la directory backend al path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from retry_policy import RetryPolicy, RetryBudget, parse_retry_after
+
+class FakeResponse:
+    def __init__(self, status_code, retry_after=None):
+        self.status_code = status_code
+        self.headers = {'Retry-After': retry_after} if retry_after else {}
+        self.closed = False
+    def close(self):
+        self.closed = True
+
+def test_parse_retry_after():
+    """Test: Retry-After in secondi o assente"""
+    assert parse_retry_after('3') == 3.0
+    assert parse_retry_after(None) is None
+
+def test_send_honours_retry_after_and_jitter_bounds():
+    """Test: Retry-After ha la precedenza, altrimenti attesa tra base e 3x la precedente"""
+    sleeps = []
+    responses = [FakeResponse(429, '2'), FakeResponse(503), FakeResponse(200)]
+    discarded = list(responses[:2])
+    policy = RetryPolicy(max_attempts=3, base_delay=0.5, max_delay=20, sleep=sleeps.append)
+
+    assert policy.send(lambda: responses.pop(0), 'test').status_code == 200
+    assert sleeps[0] == 2.0
+    assert 0.5 <= sleeps[1] <= 6.0
+    assert all(r.closed for r in discarded)
+    assert policy.stats()['retries'] == 2
+
+def test_no_retry_beyond_max_delay_or_on_client_errors():
+    """Test: Retry-After oltre max_delay e status non ritentabili tornano subito al chiamante"""
+    sleeps = []
+    policy = RetryPolicy(max_attempts=3, max_delay=10, sleep=sleeps.append)
+    assert policy.send(lambda: FakeResponse(429, '60')).status_code == 429
+    assert policy.send(lambda: FakeResponse(400)).status_code == 400
+    assert sleeps == [] and policy.stats()['retry_after_too_long'] == 1
+
+def test_connection_errors_are_retried_and_reraised():
+    """Test: errori di connessione ritentati, l'ultimo viene rilanciato"""
+    calls = []
+    def fail():
+        calls.append(1)
+        raise requests.exceptions.ConnectionError('rifiutata')
+    policy = RetryPolicy(max_attempts=3, base_delay=0, sleep=lambda s: None)
+    try:
+        policy.send(fail)
+        assert False, 'ConnectionError attesa'
+    except requests.exceptions.ConnectionError:
+        pass
+    assert len(calls) == 3
+
+def test_budget_limits_retries_during_outage():
+    """Test: con il budget esaurito i retry si fermano (un tentativo per richiesta)"""
+    budget = RetryBudget(ratio=0.1, min_per_second=0, capacity=2)
+    policy = RetryPolicy(max_attempts=3, base_delay=0, budget=budget, sleep=lambda s: None)
+    calls = []
+    def unavailable():
+        calls.append(1)
+        return FakeResponse(503)
+    for _ in range(5):
+        policy.send(unavailable)
+    # 2 crediti iniziali + 0.1 per richiesta: poco più di un tentativo per richiesta
+    assert len(calls) == 5 + 2
+    assert policy.stats()['budget_exhausted'] >= 4
+
+def test_non_idempotent_requests_retry_only_unsent_failures():
+    """Test: un upload viene ritentato solo se la connessione non è mai stata stabilita"""
+    from urllib3.exceptions import NewConnectionError
+
+    policy = RetryPolicy(max_attempts=3, base_delay=0, sleep=lambda s: None)
+    responses = [FakeResponse(503), FakeResponse(200)]
+    assert policy.send(lambda: responses.pop(0), idempotent=False).status_code == 503
+
+    calls = []
+    def after_sending():
+        calls.append(1)
+        raise requests.exceptions.ConnectionError('Connection aborted')
+    try:
+        policy.send(after_sending, idempotent=False)
+        assert False, 'ConnectionError attesa'
+    except requests.exceptions.ConnectionError:
+        pass
+    assert len(calls) == 1
+
+    attempts = []
+    def refused_then_ok():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise requests.exceptions.ConnectionError(NewConnectionError(None, 'connessione rifiutata'))
+        return FakeResponse(200)
+    assert policy.send(refused_then_ok, idempotent=False).status_code == 200
+    assert len(attempts) == 2
@@ -0,0 +1,155 @@
+"""
+Test per i backend di stato condiviso
+"""
+import sys
+import os
+
+# Aggiungi la directory backend al path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared_state import SQLiteCacheBackend, create_cache_backend, MemoryCacheBackend
+from app import QueryCache
+
+def test_sqlite_cache_shared_between_instances(tmp_path):
+    """Test: due istanze (come due worker) condividono lo stesso file di cache"""
+    path = str(tmp_path / 'state.sqlite3')
+    worker_a = QueryCache(ttl_seconds=60, backend=SQLiteCacheBackend(path))
+    worker_b = QueryCache(ttl_seconds=60, backend=SQLiteCacheBackend(path))
+
+    value = {'success': True, 'relevant_chunks': [{'chunkRelevanceScore': 0.9}]}
+    worker_a.set('query:None:25', value)
+    assert worker_b.get('query:None:25') == value
+    assert worker_b.stats()['entries'] == 1
+
+def test_sqlite_cache_expiry_and_lru_prune(tmp_path):
+    """Test: le voci scadute non vengono servite e prune applica il limite di voci"""
+    backend = SQLiteCacheBackend(str(tmp_path / 'state.sqlite3'), max_entries=2)
+    backend.set('scaduta', b'x', ttl_seconds=-1)
+    assert backend.get('scaduta') is None
+
+    backend.set('a', b'1', 60)
+    backend.set('b', b'2', 60)
+    backend.set('c', b'3', 60)
+    backend.prune()
+    assert backend.get('a') is None
+    assert backend.get('c') == b'3'
+    assert backend.stats()['entries'] == 2
+
+def test_create_cache_backend_default_memory():
+    """Test: il backend predefinito è in-memory"""
+    assert isinstance(create_cache_backend(None), MemoryCacheBackend)
+
+def test_memory_rate_limit_token_bucket_and_idle_eviction():
+    """Test: il bucket si esaurisce, si ricarica nel tempo e i client inattivi vengono rimossi"""
+    from shared_state import MemoryRateLimitStore
+
+    store = MemoryRateLimitStore(idle_seconds=60)
+    results = [store.consume('1.2.3.4', 3, 3 / 60, now=1000)[0] for _ in range(4)]
+    assert results == [True, True, True, False]
+
+    # Dopo 20 secondi è stato ricaricato un token
+    assert store.consume('1.2.3.4', 3, 3 / 60, now=1020)[0] is True
+
+    # Un nuovo client dopo 60s di inattività del primo ne causa la rimozione
+    store.consume('5.6.7.8', 3, 3 / 60, now=1100)
+    assert store.size() == 1
+
+def test_sqlite_rate_limit_shared_between_workers(tmp_path):
+    """Test: due store sullo stesso file condividono il limite"""
+    from shared_state import SQLiteRateLimitStore
+
+    path = str(tmp_path / 'state.sqlite3')
+    worker_a = SQLiteRateLimitStore(path)
+    worker_b = SQLiteRateLimitStore(path)
+    assert worker_a.consume('ip', 2, 0.0, now=1000)[0] is True
+    assert worker_b.consume('ip', 2, 0.0, now=1000)[0] is True
+    assert worker_a.consume('ip', 2, 0.0, now=1000)[0] is False
+    assert worker_b.peek('ip', 2, 0.0, now=1000) < 1
+
+def test_breaker_single_half_open_probe_across_workers(tmp_path):
+    """Test: dopo il timeout una sola chiamata di prova viene concessa tra tutti i worker"""
+    from shared_state import SQLiteBreakerStore
+
+    path = str(tmp_path / 'state.sqlite3')
+    worker_a = SQLiteBreakerStore(path)
+    worker_b = SQLiteBreakerStore(path)
+    key = 'generateContent:gemini-2.5-pro'
+
+    for _ in range(2):
+        worker_a.record_failure(key, threshold=2, now=1000)
+    # Il 429 visto dal worker A apre il breaker anche per il worker B
+    assert worker_b.acquire(key, timeout=60, probe_timeout=30, now=1010) == (False, 'OPEN')
+
+    # Timeout scaduto: solo il primo worker ottiene la chiamata di prova
+    assert worker_b.acquire(key, timeout=60, probe_timeout=30, now=1061)[0] is True
+    assert worker_a.acquire(key, timeout=60, probe_timeout=30, now=1062)[0] is False
+
+    # Prova senza esito: dopo probe_timeout viene concessa una nuova prova
+    assert worker_a.acquire(key, timeout=60, probe_timeout=30, now=1092)[0] is True
+    worker_a.record_success(key)
+    assert worker_b.acquire(key, timeout=60, probe_timeout=30, now=1093) == (True, 'CLOSED')
+
+def test_sqlite_hot_path_reads_do_not_write(tmp_path):
+    """Test: stato del breaker, successo a breaker chiuso e hit recenti della cache non scrivono sul file"""
+    from shared_state import SQLiteBreakerStore
+
+    path = str(tmp_path / 'state.sqlite3')
+    breaker = SQLiteBreakerStore(path)
+    key = 'generateContent:gemini-2.5-flash'
+    changes = breaker.store.connection().total_changes
+    assert breaker.record_success(key) == 'CLOSED'
+    assert breaker.get(key)['state'] == 'CLOSED'
+    assert breaker.store.connection().total_changes == changes
+
+    # Dopo un errore il successo azzera il contatore (scrittura necessaria)
+    breaker.record_failure(key, threshold=5)
+    breaker.record_success(key)
+    assert breaker.get(key)['failures'] == 0
+
+    cache = SQLiteCacheBackend(path)
+    cache.set('k', b'v', 60)
+    conn = cache.store.connection()
+    changes = conn.total_changes
+    assert cache.get('k') == b'v'
+    assert conn.total_changes == changes
+    # last_access più vecchio della risoluzione: l'accesso viene registrato
+    conn.execute('UPDATE query_cache SET last_access = last_access - 60')
+    changes = conn.total_changes
+    assert cache.get('k') == b'v'
+    assert conn.total_changes == changes + 1
+
+def test_circuit_breaker_registry_keys_by_operation_and_model():
+    """Test: breaker separati per operazione e modello"""
+    from app import CircuitBreakerRegistry
+
+    registry = CircuitBreakerRegistry(failure_threshold=1, timeout=60)
+    registry.get('generateContent', 'gemini-2.5-pro').record_failure()
+    assert registry.get('generateContent', 'gemini-2.5-pro').call_allowed() is False
+    assert registry.get('generateContent', 'gemini-2.5-flash').call_allowed() is True
+    assert registry.get('streamGenerateContent', 'gemini-2.5-pro').call_allowed() is True
+
+def test_blocking_io_runs_in_native_thread_under_gevent(tmp_path):
+    """Test: con gevent monkey-patched le chiamate SQLite girano nel threadpool, non nell'hub"""
+    import subprocess
+    import textwrap
+
+    backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    script = textwrap.dedent(f"""
+        from gevent import monkey
+        monkey.patch_all()
+        import sys
+        sys.path.insert(0, {backend_dir!r})
+        from gevent.monkey import get_original
+        from shared_state import SQLiteCacheBackend, blocking_io
+        get_ident = get_original('_thread', 'get_ident')
+
+        @blocking_io
+        def native_thread():
+            return get_ident()
+
+        backend = SQLiteCacheBackend({str(tmp_path / 'state.sqlite3')!r})
+        backend.set('k', b'v', 60)
+        print(native_thread() != get_ident(), backend.get('k') == b'v')
+    """)
+    output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, timeout=60)
+    assert output.stdout.split() == ['True', 'True'], output.stderr
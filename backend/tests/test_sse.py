@@ -0,0 +1,32 @@
+"""
+Test per il parser e i frame SSE
+"""
+import sys
+import os
+import json
+
+# Aggiungi la directory backend al path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sse import SSEParser, iter_sse_payloads, text_frame, event_frame, DONE_FRAME
+
+def test_parser_handles_events_split_across_reads():
+    """Test: eventi spezzati tra più blocchi, CRLF, commenti e data su più righe"""
+    stream = b': commento\r\ndata: {"a": 1}\r\n\r\nevent: x\ndata: riga1\ndata: riga2\n\ndata:{"b":2}\n\n'
+    parser = SSEParser()
+    events = []
+    for i in range(0, len(stream), 7):
+        events.extend(parser.feed(stream[i:i + 7]))
+    events.extend(parser.flush())
+    assert events == [b'{"a": 1}', b'riga1\nriga2', b'{"b":2}']
+
+def test_iter_payloads_flushes_unterminated_event():
+    """Test: l'ultimo evento senza riga vuota finale viene comunque restituito"""
+    assert list(iter_sse_payloads([b'data: 1\n\ndata: ', b'2'])) == [b'1', b'2']
+
+def test_frames_match_json_encoding():
+    """Test: i frame pre-codificati sono equivalenti a json.dumps"""
+    text = 'Perché "così"\nè €'
+    assert text_frame(text) == f"data: {json.dumps({'text': text})}\n\n".encode()
+    assert event_frame({'warning': 'x'}) == b'data: {"warning": "x"}\n\n'
+    assert json.loads(DONE_FRAME[6:]) == {'done': True}
@@ -0,0 +1,43 @@
+"""
+Test per le utility di elaborazione testo
+"""
+import sys
+import os
+
+# Aggiungi la directory backend al path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from text_processing import canonicalize_query, MinHashIndex
+
+def test_canonicalize_query_variants():
+    """Test: varianti di maiuscole, spazi, punteggiatura e accenti producono la stessa chiave"""
+    assert canonicalize_query("Cos'è un computo metrico?") == canonicalize_query("  cos e  un COMPUTO metrico ")
+    assert canonicalize_query("Perché?") == "perche"
+
+def test_canonicalize_query_keeps_meaningful_symbols():
+    """Test: simboli dentro le parole distinguono le query, una query di soli simboli non è vuota"""
+    keys = {canonicalize_query(q) for q in ("C++", "C#", "C")}
+    assert keys == {"c++", "c#", "c"}
+    assert canonicalize_query("Node.js e Python 3.11?") == "node.js e python 3.11"
+    assert canonicalize_query("computo metrico.") == canonicalize_query("Computo metrico")
+    assert canonicalize_query(" ?? ") == "??"
+    assert canonicalize_query("?!") != canonicalize_query("??")
+
+def test_minhash_index_finds_near_duplicates():
+    """Test: una query quasi identica viene trovata solo nello stesso scope"""
+    index = MinHashIndex()
+    index.add('k1', canonicalize_query("quali sono i costi del cantiere di milano"), scope='None:25')
+    index.add('k2', canonicalize_query("orari di apertura degli uffici"), scope='None:25')
+
+    match = index.query(canonicalize_query("quali sono i costi del cantiere a milano"), scope='None:25', threshold=0.6)
+    assert match is not None and match[0] == 'k1'
+
+    assert index.query(canonicalize_query("quali sono i costi del cantiere di milano"), scope='doc:10', threshold=0.6) is None
+    assert index.query(canonicalize_query("ricetta della pizza margherita"), scope='None:25', threshold=0.6) is None
+
+def test_minhash_index_is_bounded():
+    """Test: l'indice non supera max_entries"""
+    index = MinHashIndex(max_entries=2)
+    for i in range(5):
+        index.add(f'k{i}', f'query numero {i}')
+    assert index.size() == 2
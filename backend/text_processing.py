@@ -0,0 +1,155 @@
+"""
+Utility di elaborazione testo: normalizzazione delle query, shingle (di
+caratteri e di parole) e indice MinHash per la ricerca di query quasi duplicate.
+"""
+import random
+import re
+import threading
+import unicodedata
+import zlib
+from collections import OrderedDict
+from typing import Optional
+
+_NON_WORD_RE = re.compile(r'[\W_]+', re.UNICODE)
+# Token di una query: parole con i simboli che ne cambiano il significato
+# (c++, c#, node.js, 3.5); la punteggiatura ai bordi non fa parte del token
+_QUERY_TOKEN_RE = re.compile(r'[^\W_]+(?:[.#+]+[^\W_]+)*[#+]*', re.UNICODE)
+
+# Primo di Mersenne per le permutazioni MinHash
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+
+def strip_accents(text: str) -> str:
+    """Rimuove gli accenti (è -> e, à -> a) mantenendo le lettere base"""
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def normalize_text(text: str) -> str:
+    """
+    Forma canonica di un testo: minuscolo, senza accenti,
+    punteggiatura sostituita da spazi e spazi multipli compressi
+    """
+    if not text:
+        return ''
+    text = strip_accents(text).lower()
+    return _NON_WORD_RE.sub(' ', text).strip()
+
+
+def canonicalize_query(query: str) -> str:
+    """
+    Chiave canonica di una query: varianti di maiuscole, spazi, punteggiatura e accenti coincidono.
+    I simboli dentro o in coda a una parola restano (c, c++ e c# sono query diverse);
+    una query di soli simboli usa il testo originale senza spazi superflui.
+    """
+    if not query:
+        return ''
+    tokens = _QUERY_TOKEN_RE.findall(strip_accents(query).lower())
+    return ' '.join(tokens) if tokens else ' '.join(query.split())
+
+
+def char_shingles(text: str, size: int = 3) -> set:
+    """Insieme degli shingle di caratteri (n-grammi) di un testo già normalizzato"""
+    if len(text) <= size:
+        return {text} if text else set()
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def word_shingles(words: list, size: int = 5) -> set:
+    """Insieme degli shingle di parole (n-grammi di parole consecutive)"""
+    if len(words) <= size:
+        return {' '.join(words)} if words else set()
+    return {' '.join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def shingle_hashes(shingles) -> set:
+    """Hash stabili (uguali in ogni processo) di un insieme di shingle"""
+    return {zlib.crc32(s.encode('utf-8')) for s in shingles}
+
+
+class MinHashIndex:
+    """
+    Indice MinHash con LSH a bande sulle query recenti.
+    Ogni voce ha uno "scope" (es. documento e numero di risultati): una query
+    viene confrontata solo con voci dello stesso scope.
+    """
+
+    def __init__(self, num_perm=64, bands=16, max_entries=1000, shingle_size=3, seed=42):
+        if num_perm % bands:
+            raise ValueError("num_perm deve essere multiplo di bands")
+        rng = random.Random(seed)
+        self.permutations = [
+            (rng.randint(1, _MERSENNE_PRIME - 1), rng.randint(0, _MERSENNE_PRIME - 1))
+            for _ in range(num_perm)
+        ]
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.max_entries = max_entries
+        self.shingle_size = shingle_size
+        self.entries = OrderedDict()  # {key: (scope, signature)}
+        self.buckets = {}  # {(scope, band, band_hash): set(keys)}
+        self.lock = threading.Lock()
+
+    def signature(self, text: str) -> tuple:
+        """Firma MinHash di un testo normalizzato"""
+        hashes = shingle_hashes(char_shingles(text, self.shingle_size)) or {0}
+        return tuple(
+            min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes)
+            for a, b in self.permutations
+        )
+
+    def _band_keys(self, scope, signature):
+        for band in range(self.bands):
+            start = band * self.rows
+            yield (scope, band, hash(signature[start:start + self.rows]))
+
+    def _remove(self, key):
+        scope, signature = self.entries.pop(key)
+        for band_key in self._band_keys(scope, signature):
+            bucket = self.buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self.buckets[band_key]
+
+    def add(self, key: str, text: str, scope: str = ''):
+        """Indicizza un testo normalizzato sotto la chiave indicata"""
+        signature = self.signature(text)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (scope, signature)
+            for band_key in self._band_keys(scope, signature):
+                self.buckets.setdefault(band_key, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+
+    def discard(self, key: str):
+        """Rimuove una chiave dall'indice se presente"""
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def query(self, text: str, scope: str = '', threshold: float = 0.9) -> Optional[tuple]:
+        """
+        Cerca la voce più simile nello stesso scope
+        Returns: (key, similarità stimata) oppure None se sotto soglia
+        """
+        signature = self.signature(text)
+        with self.lock:
+            candidates = set()
+            for band_key in self._band_keys(scope, signature):
+                candidates.update(self.buckets.get(band_key, ()))
+
+            best = None
+            for key in candidates:
+                _, other = self.entries[key]
+                similarity = sum(x == y for x, y in zip(signature, other)) / len(signature)
+                if similarity >= threshold and (best is None or similarity > best[1]):
+                    best = (key, similarity)
+            return best
+
+    def size(self):
+        """Ritorna numero voci indicizzate"""
+        return len(self.entries)
@@ -5,15 +5,20 @@ import Typography from '@mui/material/Typography';
 import Chip from '@mui/material/Chip';
 import IconButton from '@mui/material/IconButton';
 import Collapse from '@mui/material/Collapse';
+import Button from '@mui/material/Button';
 import ExpandMoreIcon from '@mui/icons-material/ExpandMore';
 import ExpandLessIcon from '@mui/icons-material/ExpandLess';
 import type { Chunk } from '../../types';
 
 interface ChunksListProps {
   chunks: Chunk[];
+  // Paginazione (elenco completo di un documento): pulsante "Carica altri"
+  hasMore?: boolean;
+  isLoadingMore?: boolean;
+  onLoadMore?: () => void;
 }
 
-export default function ChunksList({ chunks }: ChunksListProps) {
+export default function ChunksList({ chunks, hasMore = false, isLoadingMore = false, onLoadMore }: ChunksListProps) {
   const [expandedChunks, setExpandedChunks] = useState<Set<string>>(new Set());
 
   const toggleExpand = (chunkName: string) => {
@@ -69,7 +74,7 @@ export default function ChunksList({ chunks }: ChunksListProps) {
     <Box>
       <Box sx={{ mb: 2, display: 'flex', justifyContent: 'space-between', alignItems: 'center' }}>
         <Typography variant="h6">
-          {chunks.length} Chunks trovati
+          {chunks.length} Chunks {hasMore ? 'caricati' : 'trovati'}
         </Typography>
         <Box sx={{ display: 'flex', gap: 1 }}>
           <Chip
@@ -111,12 +116,14 @@ export default function ChunksList({ chunks }: ChunksListProps) {
                   <Typography variant="body2" fontWeight="bold">
                     Chunk #{index + 1}
                   </Typography>
-                  <Chip
-                    label={`Score: ${((chunk.chunkRelevanceScore || chunk.relevanceScore || 0) * 100).toFixed(1)}%`}
-                    size="small"
-                    color="primary"
-                    variant="outlined"
-                  />
+                  {(chunk.chunkRelevanceScore ?? chunk.relevanceScore) !== undefined && (
+                    <Chip
+                      label={`Score: ${((chunk.chunkRelevanceScore || chunk.relevanceScore || 0) * 100).toFixed(1)}%`}
+                      size="small"
+                      color="primary"
+                      variant="outlined"
+                    />
+                  )}
                   {(chunk.chunk?.state || chunk.state) && (
                     <Chip
                       label={chunk.chunk?.state || chunk.state}
@@ -190,6 +197,14 @@ export default function ChunksList({ chunks }: ChunksListProps) {
           </Paper>
         );
       })}
+
+      {hasMore && onLoadMore && (
+        <Box sx={{ display: 'flex', justifyContent: 'center', mt: 2 }}>
+          <Button variant="outlined" onClick={onLoadMore} disabled={isLoadingMore}>
+            {isLoadingMore ? 'Caricamento...' : 'Carica altri'}
+          </Button>
+        </Box>
+      )}
     </Box>
   );
 }
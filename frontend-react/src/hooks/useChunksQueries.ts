@@ -1,4 +1,4 @@
-import { useMutation } from '@tanstack/react-query';
+import { useInfiniteQuery, useMutation } from '@tanstack/react-query';
 import { apiService } from '../services/api';
 import { useChunksStore } from '../stores';
 import type { ChunkQueryRequest } from '../types';
@@ -11,6 +11,8 @@ export const chunkKeys = {
     [...chunkKeys.queries(), { query, resultsCount }] as const,
   documentChunks: (documentName: string, query: string) =>
     [...chunkKeys.all, 'document', documentName, query] as const,
+  documentChunkPages: (documentName: string, pageSize: number) =>
+    [...chunkKeys.all, 'document', documentName, 'pages', pageSize] as const,
 };
 
 /**
@@ -70,6 +72,21 @@ export function useQueryDocumentChunks() {
   });
 }
 
+/**
+ * Hook for browsing all chunks of a document page by page (GET /documents/<name>/chunks)
+ * Each fetchNextPage call follows the nextPageToken returned by the backend
+ */
+export function useDocumentChunkPages(documentName: string | null, pageSize: number = 100) {
+  return useInfiniteQuery({
+    queryKey: chunkKeys.documentChunkPages(documentName || '', pageSize),
+    queryFn: ({ pageParam }) => apiService.listDocumentChunks(documentName!, pageParam, pageSize),
+    initialPageParam: '',
+    getNextPageParam: (lastPage) => lastPage.nextPageToken || undefined,
+    enabled: !!documentName,
+    staleTime: 30000,
+  });
+}
+
 /**
  * Hook to get cached chunks data without refetching
  */
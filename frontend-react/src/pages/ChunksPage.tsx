@@ -6,11 +6,13 @@ import CircularProgress from '@mui/material/CircularProgress';
 import AppLayout from '../components/Layout/AppLayout';
 import ChunksSearch from '../components/Chunks/ChunksSearch';
 import ChunksList from '../components/Chunks/ChunksList';
-import { useDocuments, useQueryDocumentChunks } from '../hooks';
+import { useDocuments, useDocumentChunkPages, useQueryDocumentChunks } from '../hooks';
 import { useChunksStore } from '../stores';
 
 export default function ChunksPage() {
   const [searchPerformed, setSearchPerformed] = useState(false);
+  // Con query "*" il documento viene sfogliato pagina per pagina invece che cercato
+  const [browse, setBrowse] = useState<{ documentName: string; pageSize: number } | null>(null);
   const [notification, setNotification] = useState<{
     open: boolean;
     message: string;
@@ -24,12 +26,20 @@ export default function ChunksPage() {
   // Use custom hooks
   const { data: documentsData, isLoading: documentsLoading } = useDocuments();
   const searchMutation = useQueryDocumentChunks();
+  const chunkPages = useDocumentChunkPages(browse?.documentName ?? null, browse?.pageSize);
   
   // Use store
   const chunks = useChunksStore((state) => state.chunks);
   const setChunks = useChunksStore((state) => state.setChunks);
 
   const handleSearch = (documentName: string, query: string, resultsCount: number) => {
+    if (query.trim() === '*') {
+      setBrowse({ documentName, pageSize: resultsCount });
+      setSearchPerformed(true);
+      return;
+    }
+
+    setBrowse(null);
     searchMutation.mutate(
       { documentName, query, results_count: resultsCount },
       {
@@ -56,6 +66,9 @@ export default function ChunksPage() {
     );
   };
 
+  const browsedChunks = chunkPages.data?.pages.flatMap((page) => page.chunks) ?? [];
+  const isLoading = browse ? chunkPages.isLoading : searchMutation.isPending;
+
   const handleCloseNotification = () => {
     setNotification((prev) => ({ ...prev, open: false }));
   };
@@ -76,17 +89,34 @@ export default function ChunksPage() {
             <ChunksSearch
               documents={documentsData.documents}
               onSearch={handleSearch}
-              isLoading={searchMutation.isPending}
+              isLoading={isLoading}
             />
 
-            {searchMutation.isPending && (
+            {browse && chunkPages.isError && (
+              <Alert severity="error" sx={{ mb: 3 }}>
+                {(chunkPages.error as any)?.response?.data?.error || 'Errore durante il caricamento dei chunks'}
+              </Alert>
+            )}
+
+            {isLoading && (
               <Box sx={{ display: 'flex', justifyContent: 'center', py: 4 }}>
                 <CircularProgress />
               </Box>
             )}
 
-            {searchPerformed && !searchMutation.isPending && (
-              <ChunksList chunks={chunks} />
+            {searchPerformed && !isLoading && (
+              browse ? (
+                !chunkPages.isError && (
+                  <ChunksList
+                    chunks={browsedChunks}
+                    hasMore={chunkPages.hasNextPage}
+                    isLoadingMore={chunkPages.isFetchingNextPage}
+                    onLoadMore={() => chunkPages.fetchNextPage()}
+                  />
+                )
+              ) : (
+                <ChunksList chunks={chunks} />
+              )
             )}
           </>
         )}
@@ -7,6 +7,7 @@ import type {
   OperationResponse,
   ChunkQueryRequest,
   ChunkQueryResponse,
+  ChunkPageResponse,
   ChatQueryRequest,
   ChatQueryResponse,
   ChatGenerateRequest,
@@ -91,7 +92,6 @@ export const apiService = {
 
   uploadDocument: async (data: UploadRequest): Promise<UploadResponse> => {
     const formData = new FormData();
-    formData.append('file', data.file);
     
     if (data.displayName) formData.append('displayName', data.displayName);
     if (data.mimeType) formData.append('mimeType', data.mimeType);
@@ -103,6 +103,9 @@ export const apiService = {
       data.metadataValues.forEach((value) => formData.append('metadataValues[]', value));
     }
 
+    // Il file va per ultimo: l'upload in streaming del backend legge i campi prima del file
+    formData.append('file', data.file);
+
     const response = await api.post<UploadResponse>('/documents/upload', formData, {
       headers: {
         'Content-Type': 'multipart/form-data',
@@ -134,6 +137,18 @@ export const apiService = {
     return response.data;
   },
 
+  // Elenco completo dei chunk in ordine, una pagina alla volta (nextPageToken vuoto = ultima pagina)
+  listDocumentChunks: async (
+    documentName: string,
+    pageToken: string = '',
+    pageSize: number = 100
+  ): Promise<ChunkPageResponse> => {
+    const response = await api.get<ChunkPageResponse>(`/documents/${documentName}/chunks`, {
+      params: { pageToken: pageToken || undefined, pageSize },
+    });
+    return response.data;
+  },
+
   // Chat
   queryChatChunks: async (data: ChatQueryRequest): Promise<ChatQueryResponse> => {
     const response = await api.post<ChatQueryResponse>('/chat/query', data);
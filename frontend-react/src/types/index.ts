@@ -100,6 +100,13 @@ export interface ChunkQueryResponse {
   chunks: Chunk[];
 }
 
+export interface ChunkPageResponse {
+  success: boolean;
+  chunks: Chunk[];
+  nextPageToken: string;
+  document?: Chunk['document'];
+}
+
 // Chat Types
 export interface ChatMessage {
   id: string;
@@ -37,12 +37,13 @@ fi
 
 # Configurazione server
 WORKERS=4
+WORKER_CLASS="${GUNICORN_WORKER_CLASS:-gevent}"  # gevent: stream SSE non bloccanti (sync per tornare ai worker sincroni)
 HOST="0.0.0.0"
 PORT=5000
 TIMEOUT=120
 
 echo "Configurazione:"
-echo "- Workers: $WORKERS"
+echo "- Workers: $WORKERS ($WORKER_CLASS)"
 echo "- Host: $HOST"
 echo "- Port: $PORT"
 echo "- Timeout: ${TIMEOUT}s"
@@ -59,7 +60,9 @@ echo ""
 
 # Avvia Gunicorn
 cd backend
-gunicorn -w $WORKERS \
+gunicorn -c gunicorn.conf.py \
+         -w $WORKERS \
+         -k $WORKER_CLASS \
          -b $HOST:$PORT \
          --timeout $TIMEOUT \
          --access-logfile ../logs/access.log \